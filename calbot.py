@@ -23,10 +23,6 @@ import logging
 import os
 import sys
 
-from raven.handlers.logging import SentryHandler
-from raven.conf import setup_logging
-
-from calbot.bot import run_bot
 from calbot.conf import Config
 
 
@@ -36,10 +32,13 @@ def main():
     else:
         configfile = os.path.join(os.path.dirname(__file__), 'calbot.cfg')
     config = Config(configfile)
+    from calbot.bot import run_bot  # imports python-telegram-bot, only when the bot is really started
     run_bot(config)
 
 
 if __name__ == '__main__':
+    from raven.handlers.logging import SentryHandler
+    from raven.conf import setup_logging
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     setup_logging(SentryHandler(level=logging.WARNING))
     main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Retries of failed calendar reads.
+
+Errors are either transient (timeouts, connection failures, 5xx) or permanent (404, parse errors).
+A calendar failed with a transient error is retried after the exponentially growing delay with jitter.
+A host which fails many reads in a row is skipped by the circuit breaker for a while.
+"""
+
+import logging
+import random
+import socket
+import threading
+from datetime import timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+
+__all__ = ['is_transient', 'retry_delay', 'CircuitBreaker']
+
+logger = logging.getLogger('backoff')
+
+
+def is_transient(error):
+    """
+    Checks whether the calendar read error can disappear by itself.
+    :param error: the exception
+    :return: True for timeouts, connection errors and server side HTTP errors
+    """
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code in (408, 429)
+    if isinstance(error, URLError):
+        return isinstance(error.reason, OSError)    # str reasons are like 'unknown url type'
+    return isinstance(error, (socket.timeout, TimeoutError, ConnectionError))
+
+
+def retry_delay(errors_count, interval, max_interval):
+    """
+    Returns the delay before the next attempt to read the calendar.
+    The delay is doubled with each error, and randomized between the half and the full value.
+    :param errors_count: how many errors in a row were observed, including the current one
+    :param interval: the usual calendars read interval, in seconds
+    :param max_interval: maximum delay, in seconds
+    :return: timedelta
+    """
+    delay = min(interval * 2 ** max(errors_count - 1, 0), max_interval)
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+class CircuitBreaker:
+    """
+    Tracks the failures of reads by the host.
+    After the threshold of failures in a row the circuit of the host is open and reads are skipped.
+    After the cooldown one read is allowed, its success closes the circuit,
+    its failure opens the circuit again with the doubled cooldown.
+    The trial read which ended without either, is expired after one more cooldown, and the next read is allowed.
+    """
+
+    def __init__(self, failures_threshold, cooldown, max_cooldown=86400):
+        self.failures_threshold = failures_threshold
+        """number of failures in a row which opens the circuit"""
+        self.cooldown = cooldown
+        """seconds to keep the circuit open first time"""
+        self.max_cooldown = max_cooldown
+        """maximum seconds to keep the circuit open"""
+        self.hosts = {}
+        """HostState by the host name"""
+        self.lock = threading.Lock()
+
+    def allow(self, url, now):
+        """
+        Checks whether the calendar can be read now.
+        :param url: URL of the calendar
+        :param now: current time, in seconds
+        :return: False if the circuit of the host is open
+        """
+        with self.lock:
+            state = self.hosts.get(_host(url))
+            if state is None or state.open_until is None:
+                return True
+            if now < state.open_until:
+                return False
+            state.trial = True      # half-open: let one read through
+            state.open_until = now + state.cooldown     # till the trial ends or expires
+            return True
+
+    def success(self, url):
+        """
+        Registers the successful read, closes the circuit.
+        :param url: URL of the calendar
+        :return: None
+        """
+        with self.lock:
+            self.hosts.pop(_host(url), None)
+
+    def failure(self, url, now):
+        """
+        Registers the failed read, opens the circuit if necessary.
+        :param url: URL of the calendar
+        :param now: current time, in seconds
+        :return: None
+        """
+        host = _host(url)
+        with self.lock:
+            state = self.hosts.setdefault(host, HostState())
+            state.failures += 1
+            if state.trial:
+                state.cooldown = min(state.cooldown * 2, self.max_cooldown)
+            elif state.failures >= self.failures_threshold and state.open_until is None:
+                state.cooldown = self.cooldown
+            else:
+                return
+            state.trial = False
+            state.open_until = now + state.cooldown
+            logger.warning('Circuit of %s is open for %s seconds after %s failures', host, state.cooldown, state.failures)
+
+
+class HostState:
+    """
+    Failures of the host, as seen by the circuit breaker.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        """number of failures in a row"""
+        self.open_until = None
+        """when the circuit can be tried to close, in seconds, None if the circuit is closed"""
+        self.cooldown = 0
+        """seconds the circuit is kept open"""
+        self.trial = False
+        """the read is allowed to try to close the circuit"""
+
+
+def _host(url):
+    return urlparse(url).hostname or ''
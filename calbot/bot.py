@@ -18,6 +18,7 @@
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
 import logging
+from datetime import datetime, timedelta
 
 from telegram.ext import CommandHandler
 from telegram.ext import Filters
@@ -25,12 +26,26 @@ from telegram.ext import MessageHandler
 from telegram.ext import Updater
 
 from calbot import stats
+from calbot import ical
+from calbot import dedup
+from calbot import metrics
+from calbot.backoff import CircuitBreaker
+from calbot.locks import configure_locks
+from calbot.outbox import configure_outbox, drain_outboxes
 from calbot.commands import add as add_command
 from calbot.commands import cal as cal_command
 from calbot.commands import format as format_command
 from calbot.commands import lang as lang_command
 from calbot.commands import advance as advance_command
-from calbot.processing import update_calendars_job
+from calbot.commands import profile as profile_command
+from calbot.profiler import Profiler
+from calbot.processing import update_calendars, update_calendars_on_workers, notify_due_events, warmup_calendar
+from calbot.refresh import Refresher
+from calbot.scheduler import save_next_pass, first_pass_delay, plan_warmup
+from calbot.slowlane import SlowLane
+from calbot.supervisor import Supervisor
+from calbot.verification import Verifier
+from calbot.wheel import NotificationWheel
 
 __all__ = ['run_bot']
 
@@ -54,6 +69,8 @@ def run_bot(config):
     :param config: main bot configuration
     :return: None
     """
+    configure_locks(config.file_locks)
+    configure_outbox(config.outbox_max_attempts, config.outbox_retry_interval)
     updater = Updater(config.token)
 
     dispatcher = updater.dispatcher
@@ -61,17 +78,23 @@ def run_bot(config):
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('help', start))
 
-    dispatcher.add_handler(add_command.create_handler(config))
+    verifier = Verifier(config, config.verify_workers, config.verify_per_user)
+    dispatcher.add_handler(add_command.create_handler(config, verifier))
 
     def list_calendars_from_config(bot, update):
         list_calendars(bot, update, config)
     dispatcher.add_handler(CommandHandler('list', list_calendars_from_config))
 
-    dispatcher.add_handler(cal_command.create_handler(config))
+    refresher = Refresher(config, config.refresh_workers, config.refresh_per_hour)
+    metrics.QUEUE_SIZE.set_function(refresher.__len__, queue='refresh')
+    dispatcher.add_handler(cal_command.create_handler(config, verifier, refresher))
     dispatcher.add_handler(format_command.create_handler(config))
     dispatcher.add_handler(lang_command.create_handler(config))
     dispatcher.add_handler(advance_command.create_handler(config))
 
+    profiler = Profiler()
+    dispatcher.add_handler(profile_command.create_handler(config, profiler, refresher))
+
     def get_stats_with_config(bot, update):
         get_stats(bot, update, config)
     dispatcher.add_handler(CommandHandler('stats', get_stats_with_config))
@@ -100,10 +123,78 @@ def run_bot(config):
                               )
         logger.info('Started polling')
 
-    updater.job_queue.run_repeating(update_calendars_job, config.interval, first=0, context=config)
+    if config.metrics_port > 0:
+        metrics.QUEUE_SIZE.set_function(updater.update_queue.qsize, queue='updates')
+        metrics.QUEUE_SIZE.set_function(updater.job_queue.queue.qsize, queue='jobs')
+        metrics.start_metrics_server(config.metrics_listen, config.metrics_port)
+
+    ical.configure_expansion_budget(config.expansion_cpu_time, config.expansion_occurrences)
+    if config.parse_workers > 0:
+        ical.start_parse_pool(config.parse_workers, config.parse_tasks_per_worker)
+    if config.feeds_mode in ('record', 'replay'):
+        ical.start_feed_store(config.feeds_dir, config.feeds_max_size, replay=(config.feeds_mode == 'replay'))
+        logger.info('Feeds %s mode in %s', config.feeds_mode, config.feeds_dir)
+    if config.dedup_window > 0:
+        dedup.start_channel_dedup(config.vardir, config.dedup_window)
+
+    wheel = None
+    if config.notify_tick > 0:
+        wheel = NotificationWheel(config)
+        wheel.restore()
+        metrics.QUEUE_SIZE.set_function(wheel.__len__, queue='notifications')
+        refresher.wheel = wheel     # the refreshes requested before are processed without the wheel
+
+        def notify_due_events_with_config(bot, job):
+            notify_due_events(bot, config, wheel)
+        updater.job_queue.run_repeating(notify_due_events_with_config, config.notify_tick, first=0)
+
+    def drain_outboxes_with_config(bot, job):
+        drain_outboxes(bot, config)
+    updater.job_queue.run_repeating(drain_outboxes_with_config, config.outbox_retry_interval, first=0)
+
+    first = first_pass_delay(config)
+    if config.workers > 0:
+        supervisor = Supervisor(config, config.workers)
+        supervisor.start(updater.bot)
+        slow_lane = None    # the workers process their shards as a whole
+        if first >= config.interval:
+            first = 0   # the workers process whole shards, the overdue calendars can't be warmed up one by one
+
+        def update_calendars_with_config(bot, job):
+            save_next_pass(config, datetime.utcnow() + timedelta(seconds=config.interval))
+            with profiler.profile_pass(bot):
+                update_calendars_on_workers(config, supervisor, wheel)
+    else:
+        supervisor = None
+        breaker = CircuitBreaker(config.circuit_failures, config.circuit_cooldown)
+        slow_lane = SlowLane(config, wheel, breaker) if config.slow_lane else None
+        if slow_lane is not None:
+            metrics.QUEUE_SIZE.set_function(slow_lane.__len__, queue='slow_lane')
+
+        def warmup_calendar_with_config(bot, job):
+            warmup_calendar(bot, config, job.context, wheel, breaker)
+        for delay, calendar in plan_warmup(config):
+            updater.job_queue.run_once(warmup_calendar_with_config, delay, context=calendar)
+
+        def update_calendars_with_config(bot, job):
+            save_next_pass(config, datetime.utcnow() + timedelta(seconds=config.interval))
+            with profiler.profile_pass(bot):
+                update_calendars(bot, config, wheel, breaker, slow_lane)
+    logger.info('First processing of all calendars in %s seconds', first)
+    updater.job_queue.run_repeating(update_calendars_with_config, config.interval, first=first)
 
     updater.idle()
 
+    verifier.stop()
+    refresher.stop()
+    if supervisor is not None:
+        supervisor.stop()
+    if slow_lane is not None:
+        slow_lane.stop()
+    ical.stop_parse_pool()
+    ical.stop_feed_store()
+    dedup.stop_channel_dedup()
+
 
 def start(bot, update):
     """
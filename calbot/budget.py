@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Limits of the work spent to expand the recurring events of one calendar.
+
+A rule like FREQ=MINUTELY started years ago, or tens of thousands of overrides, can take minutes to expand.
+The expansion counts the VEVENT components and every occurrence of the rules it iterates,
+including the occurrences before the read window, and checks the CPU time of the thread.
+The expansion over any of the limits is aborted with ExpansionBudgetExceeded.
+
+The calendars which use a large part of the budget on several reads in a row are processed in the slow lane,
+see calbot.slowlane.
+"""
+
+import time
+
+__all__ = ['ExpansionBudget', 'ExpansionBudgetExceeded', 'BudgetedRule', 'HEAVY_FRACTION', 'SLOW_LANE_READS']
+
+CHECK_EVERY = 1024
+"""number of the occurrences between the checks of the CPU time"""
+
+HEAVY_FRACTION = 0.5
+"""the read which used so much of the budget is heavy"""
+
+SLOW_LANE_READS = 3
+"""the calendar is moved to the slow lane after so many heavy reads, more than light ones"""
+
+
+class ExpansionBudgetExceeded(Exception):
+    """
+    The expansion of the calendar took too much.
+    """
+    pass
+
+
+class ExpansionBudget:
+    """
+    Counts the occurrences and the CPU time of the expansion of one calendar.
+    """
+
+    def __init__(self, cpu_time=0, occurrences=0):
+        self.cpu_time = cpu_time
+        """maximum CPU time of the expansion, in seconds, 0 for no limit"""
+        self.occurrences = occurrences
+        """maximum number of the iterated components and occurrences, 0 for no limit"""
+        self.count = 0
+        """number of the iterated components and occurrences"""
+        self.spent = 0.0
+        """CPU time of the expansion before the last resume, in seconds"""
+        self.started = time.thread_time()
+        """CPU time of the thread when the expansion was started or resumed, None if it's paused"""
+
+    def tick(self, count=1):
+        """
+        Counts the iterated components or occurrences.
+        :param count: how many were iterated
+        :return: None
+        :raise ExpansionBudgetExceeded: if the budget is over
+        """
+        previous = self.count
+        self.count += count
+        if self.occurrences and self.count > self.occurrences:
+            raise ExpansionBudgetExceeded('Expansion of the calendar exceeded the limit of %s occurrences'
+                                          % self.occurrences)
+        if self.cpu_time and previous // CHECK_EVERY != self.count // CHECK_EVERY:
+            if self.elapsed() > self.cpu_time:
+                raise ExpansionBudgetExceeded('Expansion of the calendar exceeded the limit of %s seconds'
+                                              % self.cpu_time)
+
+    def used(self):
+        """
+        Returns the part of the budget used, by the limit which is the closest to be over.
+        :return: float, 0 if there are no limits
+        """
+        used = 0.0
+        if self.occurrences:
+            used = max(used, self.count / self.occurrences)
+        if self.cpu_time:
+            used = max(used, self.elapsed() / self.cpu_time)
+        return used
+
+    def elapsed(self):
+        """
+        Returns the CPU time of the expansion, without the time it was paused.
+        :return: float, in seconds
+        """
+        if self.started is None:
+            return self.spent
+        return self.spent + time.thread_time() - self.started
+
+    def pause(self):
+        """
+        Stops counting the CPU time, while the thread does other work between the parts of the expansion.
+        :return: None
+        """
+        if self.started is not None:
+            self.spent += time.thread_time() - self.started
+            self.started = None
+
+    def resume(self):
+        """
+        Continues counting the CPU time of the thread.
+        :return: None
+        """
+        if self.started is None:
+            self.started = time.thread_time()
+
+
+class BudgetedRule:
+    """
+    Replacement of dateutil.rrule.rruleset of recurring_ical_events.RepeatedEvent which counts the occurrences.
+    """
+
+    def __init__(self, rule, budget):
+        self.rule = rule
+        """the original rruleset"""
+        self.budget = budget
+        """ExpansionBudget to count the occurrences"""
+
+    def between(self, after, before, inc=False):
+        """
+        Returns the occurrences in the window, as rruleset.between() does.
+        """
+        result = []
+        for occurrence in self.rule:
+            self.budget.tick()
+            if inc:
+                if occurrence > before:
+                    break
+                if occurrence >= after:
+                    result.append(occurrence)
+            else:
+                if occurrence >= before:
+                    break
+                if occurrence > after:
+                    result.append(occurrence)
+        return result
+
+    def __iter__(self):
+        for occurrence in self.rule:
+            self.budget.tick()
+            yield occurrence
+
+    def __getattr__(self, name):
+        return getattr(self.rule, name)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Global index of the calendars of all users, `var/calendars.idx`.
+
+It's a text file of tab-separated records, one per line:
+
+```
++ user_id calendar_id enabled next_due url - the calendar was added or changed
+- user_id calendar_id - the calendar was deleted
+```
+
+`enabled` is 1 or 0, `next_due` is the naive UTC time of the next processing, empty if the calendar
+was never processed. The later records override the earlier ones.
+
+The writers of calbot.conf append the records after they change `calendars.cfg`,
+the readers get all calendars in one sequential read, without listing and parsing the files of every user.
+The file is compacted when the number of records becomes much larger than the number of calendars.
+It's rebuilt from the `calendars.cfg` files when it's missing, so delete it to rebuild it.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from calbot.locks import index_lock
+
+__all__ = ['IndexEntry', 'read_index', 'rebuild_index', 'index_calendar', 'unindex_calendar']
+
+logger = logging.getLogger('calindex')
+
+INDEX_FILE = 'calendars.idx'
+
+COMPACT_SLACK = 1000
+"""number of the stale records which are tolerated before the compaction, in addition to the calendars count"""
+
+
+class IndexEntry:
+    """
+    Indexed calendar.
+    """
+
+    def __init__(self, **kwargs):
+        self.user_id = kwargs['user_id']
+        """ID of the user"""
+        self.calendar_id = kwargs['calendar_id']
+        """ID of the calendar"""
+        self.url = kwargs['url']
+        """URL of the calendar"""
+        self.enabled = kwargs.get('enabled', True)
+        """the calendar is enabled"""
+        self.next_due = kwargs.get('next_due')
+        """naive UTC datetime when the calendar should be processed next time, None if it was never processed"""
+
+    @classmethod
+    def of(cls, calendar):
+        """
+        Creates the entry of the calendar.
+        :param calendar: CalendarConfig instance
+        :return: IndexEntry instance
+        """
+        return cls(
+            user_id=calendar.user_id,
+            calendar_id=calendar.id,
+            url=calendar.url,
+            enabled=calendar.enabled,
+            next_due=calendar_due_at(calendar),
+        )
+
+    @property
+    def key(self):
+        return self.user_id, self.calendar_id
+
+    def record(self):
+        return '\t'.join(('+', self.user_id, self.calendar_id, '1' if self.enabled else '0',
+                          self.next_due.isoformat() if self.next_due is not None else '',
+                          _escape(self.url))) + '\n'
+
+
+def calendar_due_at(calendar):
+    """
+    Returns when the calendar should be processed next time.
+    :param calendar: CalendarConfig instance
+    :return: naive UTC datetime, None if the calendar was never processed
+    """
+    if calendar.next_attempt_at is not None:
+        return _parse(calendar.next_attempt_at)
+    if calendar.last_process_at is None:
+        return None
+    return _parse(calendar.last_process_at) + timedelta(seconds=calendar.retry_interval)
+
+
+def index_calendar(calendar):
+    """
+    Adds or updates the calendar in the index. Call it after the calendar is written to calendars.cfg.
+    :param calendar: CalendarConfig instance
+    :return: None
+    """
+    _append(calendar.vardir, IndexEntry.of(calendar).record())
+
+
+def unindex_calendar(vardir, user_id, calendar_id):
+    """
+    Removes the calendar from the index. Call it after the calendar is removed from calendars.cfg.
+    :param vardir: basic var dir
+    :param user_id: ID of the user
+    :param calendar_id: ID of the calendar
+    :return: None
+    """
+    _append(vardir, '\t'.join(('-', user_id, calendar_id)) + '\n')
+
+
+def read_index(config):
+    """
+    Reads all indexed calendars. Rebuilds the index if it's missing.
+    :param config: main config
+    :return: list of IndexEntry
+    """
+    path = _index_path(config.vardir)
+    with index_lock(config.vardir):
+        try:
+            with open(path, 'rt', encoding='UTF-8') as f:
+                entries, records = _replay(f)
+        except FileNotFoundError:
+            return rebuild_index(config)
+        if records > 2 * len(entries) + COMPACT_SLACK:
+            logger.info('Compacting calendars index: %s records of %s calendars', records, len(entries))
+            _write(path, entries.values())
+    return list(entries.values())
+
+
+def rebuild_index(config):
+    """
+    Rebuilds the index from calendars.cfg files of all users.
+    :param config: main config
+    :return: list of IndexEntry
+    """
+    entries = []
+    with index_lock(config.vardir):
+        for name in (os.listdir(config.vardir) if os.path.isdir(config.vardir) else []):
+            if os.path.isdir(os.path.join(config.vardir, name)):
+                user_id = name
+                try:
+                    for calendar in config.load_calendars(user_id):
+                        entries.append(IndexEntry.of(calendar))
+                except Exception:
+                    logger.warning('Failed to index calendars of user %s', user_id, exc_info=True)
+        _write(_index_path(config.vardir), entries)
+    logger.info('Rebuilt calendars index of %s calendars', len(entries))
+    return entries
+
+
+def _replay(lines):
+    entries = OrderedDict()
+    records = 0
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        records += 1
+        if fields[0] == '+' and len(fields) == 6:
+            entry = IndexEntry(
+                user_id=fields[1],
+                calendar_id=fields[2],
+                enabled=(fields[3] == '1'),
+                next_due=_parse(fields[4]) if fields[4] else None,
+                url=_unescape(fields[5]),
+            )
+            entries[entry.key] = entry
+        elif fields[0] == '-' and len(fields) == 3:
+            entries.pop((fields[1], fields[2]), None)
+        else:
+            logger.warning('Skipping broken calendars index record: %r', line)
+    return entries, records
+
+
+def _append(vardir, record):
+    path = _index_path(vardir)
+    with index_lock(vardir):
+        if not os.path.exists(path):
+            return      # the index is rebuilt from calendars.cfg files on the next read
+        with open(path, 'at', encoding='UTF-8') as f:
+            f.write(record)
+
+
+def _write(path, entries):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wt', encoding='UTF-8') as f:
+        for entry in entries:
+            f.write(entry.record())
+    os.replace(temp_path, path)
+
+
+def _index_path(vardir):
+    return os.path.join(vardir, INDEX_FILE)
+
+
+def _escape(value):
+    return value.replace('%', '%25').replace('\t', '%09').replace('\n', '%0A').replace('\r', '%0D')
+
+
+def _unescape(value):
+    return value.replace('%0D', '\r').replace('%0A', '\n').replace('%09', '\t').replace('%25', '%')
+
+
+def _parse(value):
+    try:    # the times are written by isoformat(), strptime() is much faster than dateutil
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        from dateutil.parser import parse   # imported on first use, it's slow to import
+        return parse(value)
@@ -24,8 +24,6 @@ from telegram.ext import CommandHandler
 from telegram.ext import MessageHandler
 from telegram.ext import Filters
 
-from calbot.processing import update_calendar
-
 __all__ = ['create_handler']
 
 logger = logging.getLogger('commands.add')
@@ -35,14 +33,16 @@ ENTERING_CHANNEL = 1
 END = ConversationHandler.END
 
 
-def create_handler(config):
+def create_handler(config, verifier):
     """
     Creates handler for /add command.
+    :param config: main config
+    :param verifier: Verifier to verify the added calendar in background
     :return: ConversationHandler
     """
 
     def add_calendar_with_config(bot, update, chat_data):
-        return add_calendar(bot, update, chat_data, config)
+        return add_calendar(bot, update, chat_data, config, verifier)
 
     return ConversationHandler(
         entry_points=[CommandHandler('add', start)],
@@ -79,7 +79,7 @@ def enter_url(bot, update, chat_data):
         return END
 
 
-def add_calendar(bot, update, chat_data, config):
+def add_calendar(bot, update, chat_data, config, verifier):
     message = update.message
     user_id = str(message.chat_id)
     url = chat_data['calendar_url']
@@ -88,7 +88,7 @@ def add_calendar(bot, update, chat_data, config):
         calendar = config.add_calendar(user_id, url, channel_id)
         message.reply_text(
             'The new calendar is queued for verification.\nWait for messages here and in the %s.' % channel_id)
-        update_calendar(bot, calendar)
+        verifier.submit(bot, calendar)
     except Exception as e:
         logger.warning('Failed to add calendar for user %s', user_id, exc_info=True)
         try:
@@ -24,12 +24,11 @@ from telegram.ext import CommandHandler
 from telegram.ext import RegexHandler
 
 from calbot.conf import CalendarConfig
+from calbot.refresh import COALESCED, LIMITED
 
 
 __all__ = ['create_handler']
 
-from calbot.processing import update_calendar
-
 logger = logging.getLogger('commands.cal')
 
 EDITING = 0
@@ -38,9 +37,12 @@ EDITING_CHANNEL = 2
 END = ConversationHandler.END
 
 
-def create_handler(config):
+def create_handler(config, verifier, refresher):
     """
     Creates handler for /calX command.
+    :param config: main config
+    :param verifier: Verifier to verify the changed calendar in background
+    :param refresher: Refresher to process the calendar in background on request
     :return: ConversationHandler
     """
 
@@ -56,17 +58,26 @@ def create_handler(config):
     def disable_cal_with_config(bot, update, chat_data):
         return disable_cal(bot, update, chat_data, config)
 
+    def digest_cal_with_config(bot, update, chat_data):
+        return digest_cal(bot, update, chat_data, config, True)
+
+    def nodigest_cal_with_config(bot, update, chat_data):
+        return digest_cal(bot, update, chat_data, config, False)
+
+    def refresh_cal_with_config(bot, update, chat_data):
+        return refresh_cal(bot, update, chat_data, config, refresher)
+
     def start_edit_cal_url_with_config(bot, update, chat_data):
         return start_edit_cal_url(bot, update, chat_data, config)
 
     def edit_cal_url_with_config(bot, update, chat_data):
-        return edit_cal_url(bot, update, chat_data, config)
+        return edit_cal_url(bot, update, chat_data, config, verifier)
 
     def start_edit_cal_channel_with_config(bot, update, chat_data):
         return start_edit_cal_channel(bot, update, chat_data, config)
 
     def edit_cal_channel_with_config(bot, update, chat_data):
-        return edit_cal_channel(bot, update, chat_data, config)
+        return edit_cal_channel(bot, update, chat_data, config, verifier)
 
     return ConversationHandler(
         entry_points=[RegexHandler(r'^/cal(\d+)', get_cal_with_config, pass_groups=True, pass_chat_data=True)],
@@ -76,6 +87,9 @@ def create_handler(config):
                 CommandHandler('channel', start_edit_cal_channel_with_config, pass_chat_data=True),
                 CommandHandler('enable', enable_cal_with_config, pass_chat_data=True),
                 CommandHandler('disable', disable_cal_with_config, pass_chat_data=True),
+                CommandHandler('digest', digest_cal_with_config, pass_chat_data=True),
+                CommandHandler('nodigest', nodigest_cal_with_config, pass_chat_data=True),
+                CommandHandler('refresh', refresh_cal_with_config, pass_chat_data=True),
                 CommandHandler('delete', del_cal_with_config, pass_chat_data=True, pass_job_queue=True),
             ],
             EDITING_URL: [MessageHandler(Filters.text, edit_cal_url_with_config, pass_chat_data=True)],
@@ -101,13 +115,20 @@ URL: %s
 Channel: %s
 Verified: %s
 Enabled: %s
+Digest: %s
 Last processed: %s
 Last error: %s
-Errors count: %s''' % (calendar.id, calendar.name, calendar.url, calendar.channel_id,
-                       calendar.verified, calendar.enabled,
-                       calendar.last_process_at, calendar.last_process_error, calendar.last_errors_count))
-        message.reply_text('Edit the calendar /url or /channel, or %s it, or /delete, or /cancel' %
-                           ('/disable' if calendar.enabled else '/enable'))
+Errors count: %s
+Next attempt: %s
+Processing cost: %s''' % (calendar.id, calendar.name, calendar.url, calendar.channel_id,
+                          calendar.verified, calendar.enabled, calendar.digest,
+                          calendar.last_process_at, calendar.last_process_error, calendar.last_errors_count,
+                          calendar.next_attempt_at or 'next processing',
+                          calendar.profile or 'unknown'))
+        toggle = '/disable' if calendar.enabled else '/enable'
+        digest = '/nodigest separate messages' if calendar.digest else '/digest'
+        message.reply_text('Edit the calendar /url or /channel, or %s it, or send events as %s, '
+                           'or /refresh it now, or /delete, or /cancel' % (toggle, digest))
         return EDITING
     except Exception as e:
         logger.warning('Failed to load calendar %s for user %s', calendar_id, user_id, exc_info=True)
@@ -157,7 +178,7 @@ def start_edit_cal_url(bot, update, chat_data, config):
         return END
 
 
-def edit_cal_url(bot, update, chat_data, config):
+def edit_cal_url(bot, update, chat_data, config, verifier):
     message = update.message
     user_id = str(message.chat_id)
     calendar_id = chat_data['calendar_id']
@@ -166,7 +187,7 @@ def edit_cal_url(bot, update, chat_data, config):
         url = message.text.strip()
         calendar = config.change_calendar_url(user_id, calendar_id, url)
         message.reply_text('The updated calendar is queued for verification.\nWait for messages here.')
-        update_calendar(bot, calendar)
+        verifier.submit(bot, calendar)
     except Exception as e:
         logger.warning('Failed to change url of calendar %s for user %s', calendar_id, user_id, exc_info=True)
         try:
@@ -193,7 +214,7 @@ def start_edit_cal_channel(bot, update, chat_data, config):
         return END
 
 
-def edit_cal_channel(bot, update, chat_data, config):
+def edit_cal_channel(bot, update, chat_data, config, verifier):
     message = update.message
     user_id = str(message.chat_id)
     calendar_id = chat_data['calendar_id']
@@ -202,7 +223,7 @@ def edit_cal_channel(bot, update, chat_data, config):
         channel_id = message.text.strip()
         calendar = config.change_calendar_channel(user_id, calendar_id, channel_id)
         message.reply_text('The updated calendar is queued for verification.\nWait for messages here.')
-        update_calendar(bot, calendar)
+        verifier.submit(bot, calendar)
     except Exception as e:
         logger.warning('Failed to change channel of calendar %s for user %s', calendar_id, user_id, exc_info=True)
         try:
@@ -249,6 +270,54 @@ def disable_cal(bot, update, chat_data, config):
     return END
 
 
+def digest_cal(bot, update, chat_data, config, digest):
+    message = update.message
+    user_id = str(message.chat_id)
+    calendar_id = chat_data['calendar_id']
+
+    try:
+        config.set_calendar_digest(user_id, calendar_id, digest)
+        if digest:
+            message.reply_text('Events of calendar /cal%s will be sent as digests' % calendar_id)
+        else:
+            message.reply_text('Events of calendar /cal%s will be sent one by one' % calendar_id)
+    except Exception as e:
+        logger.warning('Failed to change digest of calendar %s for user %s', calendar_id, user_id, exc_info=True)
+        try:
+            message.reply_text('Failed to change digest of calendar /cal%s:\n%s' % (calendar_id, e))
+        except Exception:
+            logger.error('Failed to send reply to user %s', user_id, exc_info=True)
+
+    return END
+
+
+def refresh_cal(bot, update, chat_data, config, refresher):
+    message = update.message
+    user_id = str(message.chat_id)
+    calendar_id = chat_data['calendar_id']
+
+    try:
+        calendar = config.load_calendar(user_id, calendar_id)
+        if not calendar.enabled:
+            message.reply_text('Calendar /cal%s is disabled, /enable it first' % calendar_id)
+            return END
+        status = refresher.submit(bot, calendar)
+        if status == LIMITED:
+            message.reply_text('Too many refreshes, calendar /cal%s will be processed as usual' % calendar_id)
+        elif status == COALESCED:
+            message.reply_text('Calendar /cal%s is already queued for refresh' % calendar_id)
+        else:
+            message.reply_text('Calendar /cal%s is queued for refresh' % calendar_id)
+    except Exception as e:
+        logger.warning('Failed to refresh calendar %s for user %s', calendar_id, user_id, exc_info=True)
+        try:
+            message.reply_text('Failed to refresh calendar /cal%s:\n%s' % (calendar_id, e))
+        except Exception:
+            logger.error('Failed to send reply to user %s', user_id, exc_info=True)
+
+    return END
+
+
 def cancel(bot, update):
     message = update.message
     user_id = str(message.chat_id)
@@ -25,7 +25,7 @@ from telegram.ext import MessageHandler
 from telegram.ext import Filters
 
 from calbot.formatting import format_event
-from calbot.ical import sample_event
+from calbot.ical import get_sample_event
 
 
 __all__ = ['create_handler']
@@ -69,7 +69,7 @@ def get_format(bot, update, config):
         message.reply_text('Current format:')
         message.reply_text(user_config.format)
         message.reply_text('Sample event:')
-        message.reply_text(format_event(user_config, sample_event))
+        message.reply_text(format_event(user_config, get_sample_event()))
         message.reply_text('Type a new format string to set or /cancel')
         return SETTING
     except Exception:
@@ -85,7 +85,7 @@ def set_format(bot, update, config):
         new_format = message.text.strip()
         user_config.set_format(new_format)
         message.reply_text('Format is updated.\nSample event:')
-        message.reply_text(format_event(user_config, sample_event))
+        message.reply_text(format_event(user_config, get_sample_event()))
         return END
     except Exception as e:
         logger.warning('Failed to update format for user %s', user_id, exc_info=True)
@@ -26,7 +26,7 @@ from telegram.ext import MessageHandler
 from telegram.ext import Filters
 
 from calbot.formatting import normalize_locale, format_event
-from calbot.ical import sample_event
+from calbot.ical import get_sample_event
 
 
 __all__ = ['create_handler']
@@ -68,7 +68,7 @@ def get_lang(bot, update, config):
     try:
         user_config = config.load_user(user_id)
         message.reply_text('Current language is %s\nSample event:' % user_config.language)
-        message.reply_text(format_event(user_config, sample_event))
+        message.reply_text(format_event(user_config, get_sample_event()))
         message.reply_text('Type another language name to set or /cancel')
         return SETTING
     except Exception:
@@ -86,7 +86,7 @@ def set_lang(bot, update, config):
         normalized_locale = normalize_locale(new_lang)
         user_config.set_language(normalized_locale)
         try:
-            sample = format_event(user_config, sample_event)
+            sample = format_event(user_config, get_sample_event())
             message.reply_text('Language is updated to %s\nSample event:' % normalized_locale)
             message.reply_text(sample)
             return END
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+import logging
+
+from telegram.ext import CommandHandler
+
+from calbot.profiler import profile_calendar
+
+
+__all__ = ['create_handler']
+
+logger = logging.getLogger('commands.profile')
+
+USAGE = '''Usage:
+/profile passes N — profile the next N processing passes with cProfile
+/profile memory N — compare memory snapshots before and after the next N processing passes
+/profile cal N [USER] — profile a dry run of the calendar N of the user (yours by default), nothing is sent'''
+
+
+def create_handler(config, profiler, refresher):
+    """
+    Creates handler for /profile command.
+    :param config: main config
+    :param profiler: Profiler of the processing passes
+    :param refresher: Refresher to profile the calendar in its pool
+    :return: CommandHandler
+    """
+
+    def profile_with_config(bot, update, args):
+        return profile(bot, update, args, config, profiler, refresher)
+
+    return CommandHandler('profile', profile_with_config, pass_args=True)
+
+
+def profile(bot, update, args, config, profiler, refresher):
+    message = update.message
+    user_id = str(message.chat_id)
+    if user_id not in config.admins:
+        logger.warning('Denied /profile to user %s', user_id)
+        message.reply_text("Sorry, I don't understand this command.")
+        return
+
+    try:
+        if len(args) == 2 and args[0] in ('passes', 'memory'):
+            passes = int(args[1])
+            profiler.request_passes(user_id, passes, memory=(args[0] == 'memory'))
+            message.reply_text('The next %s processing passes will be profiled' % passes)
+        elif len(args) in (2, 3) and args[0] == 'cal':
+            calendar_user_id = args[2] if len(args) == 3 else user_id
+            calendar_config = config.load_calendar(calendar_user_id, args[1])
+            message.reply_text('Profiling calendar %s of user %s, wait for the report'
+                               % (calendar_config.id, calendar_user_id))
+            refresher.executor.submit(profile_calendar, bot, user_id, calendar_config)
+        else:
+            message.reply_text(USAGE)
+    except Exception as e:
+        logger.warning('Failed to profile for user %s', user_id, exc_info=True)
+        try:
+            message.reply_text('Failed to profile:\n%s' % e)
+        except Exception:
+            logger.error('Failed to send reply to user %s', user_id, exc_info=True)
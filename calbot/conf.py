@@ -23,11 +23,21 @@ So, under `var` directory we have the following files and folders.
 
 ```
 var/
+    calendars.idx - the global index of calendars of all users, see calbot.calindex
+    scheduler.cfg - the time of the next pass of all calendars, see calbot.scheduler
+    supervisor.cfg - the current number of the worker shards, see calbot.supervisor
+    channels/ - the notifications recently sent to each channel, see calbot.dedup
+    outboxes/ - the marks of the calendars with not sent notifications, see calbot.outbox
+    feeds/ - the recorded ical feeds, when enabled in the config, see calbot.feedstore
     user1_chat_id/
         settings.cfg - general user config like notification format
         calendars.cfg - the list of user's calendars
         calendar1_id/
-            events.cfg - the list of calendar events
+            events.idx - the index of calendar events, see calbot.eventindex
+            events.cfg - the list of calendar events, replaced by events.idx on the first save
+            cursors.cfg - the expansion cursors of the recurring events, see calbot.recurrence
+            outbox.cfg - the notifications waiting to be sent, see calbot.outbox
+            schedule.cfg - the future notifications of the timing wheel, see calbot.wheel
         calendar2_id/
         ...
     user2_chat_id/
@@ -38,8 +48,18 @@ var/
 from configparser import ConfigParser
 import logging
 import os
+import threading
+from collections import OrderedDict
 from datetime import time, datetime
 
+from calbot.backoff import retry_delay
+from calbot.budget import HEAVY_FRACTION, SLOW_LANE_READS
+from calbot.calindex import read_index, index_calendar, unindex_calendar
+from calbot.eventindex import EventIndex, event_key, write_index
+from calbot.locks import user_lock, calendar_lock
+from calbot.recurrence import Cursor, format_start, parse_start
+from calbot.timings import ProcessingProfile
+
 
 __all__ = ['Config', 'ConfigFile']
 
@@ -54,6 +74,10 @@ DEFAULT_ADVANCE = [48, 24]
 
 DEFAULT_ERRORS_COUNT_THRESHOLD = 12
 
+DEFAULT_RETRY_INTERVAL = 3600
+
+DEFAULT_RETRY_MAX_INTERVAL = 86400
+
 
 class Config:
     """
@@ -78,6 +102,63 @@ class Config:
         self.errors_count_threshold = config.getint('bot', 'errors_count_threshold',
                                                     fallback=DEFAULT_ERRORS_COUNT_THRESHOLD)
         """Disable a calendar if it processing attempts failed with so many errors"""
+        self.retry_max_interval = config.getint('bot', 'retry_max_interval', fallback=DEFAULT_RETRY_MAX_INTERVAL)
+        """the maximum delay to retry a calendar failed with a transient error, in seconds"""
+        self.circuit_failures = config.getint('bot', 'circuit_failures', fallback=3)
+        """number of failed reads in a row from a host which stops reads from the host for a while"""
+        self.circuit_cooldown = config.getint('bot', 'circuit_cooldown', fallback=600)
+        """how long to skip reads from the failed host first time, in seconds"""
+        self.admins = config.get('bot', 'admins', fallback='').split()
+        """chat ids of the users allowed to run admin commands, like /profile"""
+        self.notify_tick = config.getint('bot', 'notify_tick', fallback=60)
+        """the interval to send due notifications between calendars reads, in seconds, 0 to send only on reads"""
+        self.verify_workers = config.getint('bot', 'verify_workers', fallback=4)
+        """number of threads to verify new and changed calendars"""
+        self.verify_per_user = config.getint('bot', 'verify_per_user', fallback=1)
+        """number of calendars of one user verified at once"""
+        self.refresh_workers = config.getint('bot', 'refresh_workers', fallback=2)
+        """number of threads to refresh calendars on the users' requests"""
+        self.refresh_per_hour = config.getint('bot', 'refresh_per_hour', fallback=10)
+        """number of refreshes one user can request in an hour, 0 for no limit"""
+        self.dedup_window = config.getint('bot', 'dedup_window', fallback=0)
+        """how long to remember the notifications sent to the channel to not send the same event
+        from the other calendars, in seconds, 0 to send all notifications"""
+        self.outbox_max_attempts = config.getint('bot', 'outbox_max_attempts', fallback=10)
+        """number of failed attempts to send a notification after which it's dropped from the outbox"""
+        self.outbox_retry_interval = config.getint('bot', 'outbox_retry_interval', fallback=60)
+        """the delay before the first retry of a failed notification, and the interval to check the outboxes,
+        in seconds"""
+        self.warmup = config.getint('bot', 'warmup', fallback=600)
+        """the window to spread the processing of overdue calendars after the start, in seconds"""
+
+        self.workers = config.getint('supervisor', 'workers', fallback=0)
+        """number of worker processes to process calendars, 0 to process them in the bot process"""
+        self.file_locks = config.getboolean('supervisor', 'file_locks', fallback=self.workers > 0)
+        """lock users and calendars with files too, to guard them from the other processes"""
+
+        self.parse_workers = config.getint('processing', 'parse_workers', fallback=0)
+        """number of processes to parse ical files in, 0 to parse them in the processing thread"""
+        self.parse_tasks_per_worker = config.getint('processing', 'parse_tasks_per_worker', fallback=20)
+        """number of parsed ical files after which the parsing processes are replaced, 0 to never replace them"""
+        self.expansion_cpu_time = config.getint('processing', 'expansion_cpu_time', fallback=60)
+        """maximum CPU time to expand the repeating events of one calendar, in seconds, 0 for no limit"""
+        self.expansion_occurrences = config.getint('processing', 'expansion_occurrences', fallback=1000000)
+        """maximum number of VEVENTs and repetitions iterated to expand one calendar, 0 for no limit"""
+        self.slow_lane = config.getboolean('processing', 'slow_lane', fallback=True)
+        """process the calendars which are heavy to expand in the background thread, with the lower priority"""
+
+        self.feeds_mode = config.get('feeds', 'mode', fallback='')
+        """'record' to store the read ical files, 'replay' to read the stored files instead of urls,
+        empty to only read urls"""
+        self.feeds_dir = config.get('feeds', 'dir', fallback=os.path.join(self.vardir, 'feeds'))
+        """directory of the stored ical files"""
+        self.feeds_max_size = config.getint('feeds', 'max_size', fallback=100) * 1024 * 1024
+        """maximum size of the stored compressed ical files, in bytes, configured in megabytes, 0 for no limit"""
+
+        self.metrics_port = config.getint('metrics', 'port', fallback=0)
+        """port to listen by the /metrics HTTP endpoint, 0 to not expose the metrics"""
+        self.metrics_listen = config.get('metrics', 'listen', fallback='127.0.0.1')
+        """IP address to listen by the /metrics HTTP endpoint"""
 
         self.poll_interval = config.getfloat('polling', 'poll_interval', fallback=0.0)
         """Time to wait between polling updates from Telegram"""
@@ -104,17 +185,39 @@ class Config:
         for calendar in self.load_calendars(user_id):
             yield calendar
 
-    def all_calendars(self):
+    def all_calendars(self, enabled=False):
         """
-        Returns list of all known and monitoring calendars with events
+        Returns list of all known and monitoring calendars, their events are loaded on demand
+        :param enabled: return only enabled calendars
         :return: list of CalendarConfig
         """
-        for name in os.listdir(self.vardir):
-            if os.path.isdir(os.path.join(self.vardir, name)):
-                user_id = name
-                for calendar in self.load_calendars(user_id):
-                    calendar.load_events()
-                    yield calendar
+        entries = (entry for entry in read_index(self) if entry.enabled or not enabled)
+        for calendar in self.indexed_calendars(entries):
+            if calendar.enabled or not enabled:
+                yield calendar
+
+    def indexed_calendars(self, entries):
+        """
+        Loads the calendars of the global index entries.
+        Calendars of each user are read once.
+        Calendars which don't exist anymore are skipped and removed from the index.
+        :param entries: iterable of calbot.calindex.IndexEntry
+        :return: yields CalendarConfig instances, grouped by the user
+        """
+        users = OrderedDict()
+        for entry in entries:
+            users.setdefault(entry.user_id, set()).add(entry.calendar_id)
+        for user_id, calendar_ids in users.items():
+            try:
+                calendars = [calendar for calendar in self.load_calendars(user_id) if calendar.id in calendar_ids]
+            except Exception:
+                logger.warning('Failed to load calendars of user %s', user_id, exc_info=True)
+                continue
+            for calendar_id in calendar_ids - set(calendar.id for calendar in calendars):
+                logger.info('Removing missing calendar %s of user %s from the index', calendar_id, user_id)
+                unindex_calendar(self.vardir, user_id, calendar_id)
+            for calendar in calendars:
+                yield calendar
 
     def load_user(self, user_id):
         """
@@ -163,23 +266,25 @@ class Config:
         :param channel_id: ID of the channel where to send calendar events
         :return: CalendarConfig instance
         """
-        calendar_config_file = CalendarsConfigFile(self.vardir, user_id)
-        calendar_parser = calendar_config_file.read_parser()
-        user_parser = UserConfigFile(self.vardir, user_id).read_parser()
-        user = UserConfig.load(self, user_id, user_parser)
+        with user_lock(self.vardir, user_id):
+            calendar_config_file = CalendarsConfigFile(self.vardir, user_id)
+            calendar_parser = calendar_config_file.read_parser()
+            user_parser = UserConfigFile(self.vardir, user_id).read_parser()
+            user = UserConfig.load(self, user_id, user_parser)
 
-        next_id = str(calendar_parser.getint('settings', 'last_id', fallback=0) + 1)
-        if not calendar_parser.has_section('settings'):
-            calendar_parser.add_section('settings')
-        calendar_parser.set('settings', 'last_id', next_id)
+            next_id = str(calendar_parser.getint('settings', 'last_id', fallback=0) + 1)
+            if not calendar_parser.has_section('settings'):
+                calendar_parser.add_section('settings')
+            calendar_parser.set('settings', 'last_id', next_id)
 
-        calendar = CalendarConfig.new(user, next_id, url, channel_id)
-        calendar_parser.add_section(next_id)
-        calendar_parser.set(next_id, 'url', url)
-        calendar_parser.set(next_id, 'channel_id', channel_id)
-        calendar_parser.set(next_id, 'verified', 'false')
+            calendar = CalendarConfig.new(user, next_id, url, channel_id)
+            calendar_parser.add_section(next_id)
+            calendar_parser.set(next_id, 'url', url)
+            calendar_parser.set(next_id, 'channel_id', channel_id)
+            calendar_parser.set(next_id, 'verified', 'false')
 
-        calendar_config_file.write(calendar_parser)
+            calendar_config_file.write(calendar_parser)
+            index_calendar(calendar)
 
         return calendar
 
@@ -191,11 +296,12 @@ class Config:
         :param url: new URL of the ical file
         :return: updated CalendarConfig instance
         """
-        calendar = self.load_calendar(user_id, calendar_id)
-        calendar.url = url
-        calendar.verified = False
-        calendar.enabled = True
-        calendar.save()     # save and clear last error
+        with user_lock(self.vardir, user_id):
+            calendar = self.load_calendar(user_id, calendar_id)
+            calendar.url = url
+            calendar.verified = False
+            calendar.enabled = True
+            calendar.save()     # save and clear last error
         return calendar
 
     def change_calendar_channel(self, user_id, calendar_id, channel_id):
@@ -206,11 +312,12 @@ class Config:
         :param channel_id: new channel ID
         :return: updated CalendarConfig instance
         """
-        calendar = self.load_calendar(user_id, calendar_id)
-        calendar.channel_id = channel_id
-        calendar.verified = False
-        calendar.enabled = True
-        calendar.save()     # save and clear last error
+        with user_lock(self.vardir, user_id):
+            calendar = self.load_calendar(user_id, calendar_id)
+            calendar.channel_id = channel_id
+            calendar.verified = False
+            calendar.enabled = True
+            calendar.save()     # save and clear last error
         return calendar
 
     def delete_calendar(self, user_id, calendar_id):
@@ -220,14 +327,16 @@ class Config:
         :param calendar_id: id of the calendar
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, user_id)
-        config_parser = config_file.read_parser()
+        with user_lock(self.vardir, user_id):
+            config_file = CalendarsConfigFile(self.vardir, user_id)
+            config_parser = config_file.read_parser()
 
-        if not config_parser.has_section(calendar_id):
-            raise KeyError('%s not found' % calendar_id)
-        config_parser.remove_section(calendar_id)
+            if not config_parser.has_section(calendar_id):
+                raise KeyError('%s not found' % calendar_id)
+            config_parser.remove_section(calendar_id)
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
+            unindex_calendar(self.vardir, user_id, calendar_id)
 
     def enable_calendar(self, user_id, calendar_id, enabled):
         """
@@ -237,14 +346,35 @@ class Config:
         :param enabled: enabled flag
         :return: None
         """
-        config_file = CalendarsConfigFile(self.vardir, user_id)
-        config_parser = config_file.read_parser()
-        if not config_parser.has_section(calendar_id):
-            raise KeyError('%s not found' % calendar_id)
+        with user_lock(self.vardir, user_id):
+            config_file = CalendarsConfigFile(self.vardir, user_id)
+            config_parser = config_file.read_parser()
+            if not config_parser.has_section(calendar_id):
+                raise KeyError('%s not found' % calendar_id)
+
+            config_parser.set(calendar_id, 'enabled', str(enabled))
+            config_parser.remove_option(calendar_id, 'next_attempt_at')
+
+            config_file.write(config_parser)
+            index_calendar(self.load_calendar(user_id, calendar_id))
+
+    def set_calendar_digest(self, user_id, calendar_id, digest):
+        """
+        Sets digest flag for the calendar
+        :param user_id: id of the user
+        :param calendar_id: id of the calendar
+        :param digest: digest flag
+        :return: None
+        """
+        with user_lock(self.vardir, user_id):
+            config_file = CalendarsConfigFile(self.vardir, user_id)
+            config_parser = config_file.read_parser()
+            if not config_parser.has_section(calendar_id):
+                raise KeyError('%s not found' % calendar_id)
 
-        config_parser.set(calendar_id, 'enabled', str(enabled))
+            config_parser.set(calendar_id, 'digest', str(digest))
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
 
 
 class UserConfig:
@@ -267,6 +397,10 @@ class UserConfig:
         """ConfigParser from which this object was loaded, None if this is new a config"""
         self.errors_count_threshold = kwargs.get('errors_count_threshold', DEFAULT_ERRORS_COUNT_THRESHOLD)
         """Disable a calendar if it processing attempts failed with so many errors"""
+        self.retry_interval = kwargs.get('retry_interval', DEFAULT_RETRY_INTERVAL)
+        """Initial delay to retry a calendar failed with a transient error, in seconds"""
+        self.retry_max_interval = kwargs.get('retry_max_interval', DEFAULT_RETRY_MAX_INTERVAL)
+        """Maximum delay to retry a calendar failed with a transient error, in seconds"""
 
     @classmethod
     def new(cls, config, user_id):
@@ -282,7 +416,9 @@ class UserConfig:
             format=DEFAULT_FORMAT,
             language=None,
             advance=DEFAULT_ADVANCE,
-            errors_count_threshold=config.errors_count_threshold
+            errors_count_threshold=config.errors_count_threshold,
+            retry_interval=config.interval,
+            retry_max_interval=config.retry_max_interval,
         )
 
     @classmethod
@@ -305,6 +441,8 @@ class UserConfig:
             ),
             config_parser=config_parser,
             errors_count_threshold=config.errors_count_threshold,
+            retry_interval=config.interval,
+            retry_max_interval=config.retry_max_interval,
         )
 
     def set_format(self, format):
@@ -314,11 +452,12 @@ class UserConfig:
         :return: None
         """
         config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section('settings'):
-            parser.add_section('settings')
-        parser.set('settings', 'format', format)
-        config_file.write(parser)
+        with user_lock(self.vardir, self.id):
+            parser = config_file.read_parser()
+            if not parser.has_section('settings'):
+                parser.add_section('settings')
+            parser.set('settings', 'format', format)
+            config_file.write(parser)
         self.format = format
 
     def set_language(self, language):
@@ -328,11 +467,12 @@ class UserConfig:
         :return: None
         """
         config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section('settings'):
-            parser.add_section('settings')
-        parser.set('settings', 'language', language)
-        config_file.write(parser)
+        with user_lock(self.vardir, self.id):
+            parser = config_file.read_parser()
+            if not parser.has_section('settings'):
+                parser.add_section('settings')
+            parser.set('settings', 'language', language)
+            config_file.write(parser)
         self.language = language
 
     def set_advance(self, hours):
@@ -342,12 +482,13 @@ class UserConfig:
         :return: None
         """
         config_file = UserConfigFile(self.vardir, self.id)
-        parser = self.config_parser or config_file.read_parser()
-        if not parser.has_section('settings'):
-            parser.add_section('settings')
-        int_hours = sorted(set(map(int, hours)), reverse=True)
-        parser.set('settings', 'advance', ' '.join(map(str, int_hours)))
-        config_file.write(parser)
+        with user_lock(self.vardir, self.id):
+            parser = config_file.read_parser()
+            if not parser.has_section('settings'):
+                parser.add_section('settings')
+            int_hours = sorted(set(map(int, hours)), reverse=True)
+            parser.set('settings', 'advance', ' '.join(map(str, int_hours)))
+            config_file.write(parser)
         self.advance = int_hours
 
 
@@ -379,10 +520,18 @@ class CalendarConfig:
         """Language for the event"""
         self.advance = kwargs['advance']
         """Array of the numbers: how many hours in advance notify about the event"""
+        self.digest = kwargs.get('digest', False)
+        """Flag to join the events notified at once into as few messages as possible"""
         self.day_start = time(10, 0)
         """When the day starts if the event has no specified time"""
         self.events = {}
-        """Dictionary of known configured events"""
+        """Dictionary of known configured events, loaded from the index on demand or changed"""
+        self.index = None
+        """EventIndex of the persisted events, None if not loaded or not exists"""
+        self.events_loaded = False
+        """the persisted events were loaded, they are loaded on the first access to the events"""
+        self.cursors = None
+        """expansion cursors of the recurring events by UID, as they were loaded or saved, None if not loaded"""
         self.last_process_at = kwargs.get('last_process_at')
         """Moment when the calendar was processed last time"""
         self.last_process_error = kwargs.get('last_process_error')
@@ -390,6 +539,14 @@ class CalendarConfig:
         self.last_errors_count = kwargs.get('last_errors_count', 0)
         """How many errors were observed during last calendar processing attempts"""
         self.errors_count_threshold = kwargs.get('errors_count_threshold', DEFAULT_ERRORS_COUNT_THRESHOLD)
+        self.retry_interval = kwargs.get('retry_interval', DEFAULT_RETRY_INTERVAL)
+        self.retry_max_interval = kwargs.get('retry_max_interval', DEFAULT_RETRY_MAX_INTERVAL)
+        self.next_attempt_at = kwargs.get('next_attempt_at')
+        """Moment before which the calendar should not be read after a transient error, None to read it always"""
+        self.heavy_reads = kwargs.get('heavy_reads', 0)
+        """How many more reads used a large part of the expansion budget than not, see calbot.budget"""
+        self.profile = kwargs.get('profile')
+        """ProcessingProfile of the last successful processing, None if it's unknown"""
 
     @classmethod
     def new(cls, user_config, cal_id, url, channel_id):
@@ -414,6 +571,8 @@ class CalendarConfig:
             verified=False,
             enabled=True,
             errors_count_threshold=user_config.errors_count_threshold,
+            retry_interval=user_config.retry_interval,
+            retry_max_interval=user_config.retry_max_interval,
         )
 
     @classmethod
@@ -440,10 +599,16 @@ class CalendarConfig:
             channel_id=config_parser.get(section, 'channel_id'),
             verified=verified,
             enabled=enabled,
+            digest=config_parser.getboolean(section, 'digest', fallback=False),
             last_process_at=config_parser.get(section, 'last_process_at', fallback=None),
             last_process_error=config_parser.get(section, 'last_process_error', fallback=None),
             last_errors_count=config_parser.getint(section, 'last_errors_count', fallback=0),
-            errors_count_threshold=user_config.errors_count_threshold
+            errors_count_threshold=user_config.errors_count_threshold,
+            retry_interval=user_config.retry_interval,
+            retry_max_interval=user_config.retry_max_interval,
+            next_attempt_at=config_parser.get(section, 'next_attempt_at', fallback=None),
+            heavy_reads=config_parser.getint(section, 'heavy_reads', fallback=0),
+            profile=ProcessingProfile.load(config_parser, section),
         )
 
     def save(self, exception=None):
@@ -454,29 +619,50 @@ class CalendarConfig:
         :return: None
         """
         config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
-        self._create_section(config_parser)
+        with user_lock(self.vardir, self.user_id):
+            config_parser = config_file.read_parser()
+            self._create_section(config_parser)
 
-        config_parser.set(self.id, 'url', self.url)
-        config_parser.set(self.id, 'name', self.name)
-        config_parser.set(self.id, 'channel_id', self.channel_id)
-        config_parser.set(self.id, 'verified', str(self.verified))
-        config_parser.set(self.id, 'enabled', str(self.enabled))
+            config_parser.set(self.id, 'url', self.url)
+            config_parser.set(self.id, 'name', self.name)
+            config_parser.set(self.id, 'channel_id', self.channel_id)
+            config_parser.set(self.id, 'verified', str(self.verified))
+            config_parser.set(self.id, 'enabled', str(self.enabled))
 
-        self._update_last_process(config_parser, exception)
-        config_file.write(config_parser)
+            self._update_last_process(config_parser, exception)
+            config_file.write(config_parser)
+            index_calendar(self)
 
     def load_events(self):
         """
-        Loads the calendar events from the events.cfg file.
+        Opens the index of the calendar events, events.idx.
+        The events are read from the index on demand, the events already in memory are refreshed.
+        Reads the events.cfg file if the calendar has no index yet, or the index is broken,
+        the next save_events() rewrites the index.
+        It's called on the first access to the events, call it again to reread the changed index.
         :return: None
         """
-        config_parser = EventsConfigFile(self.vardir, self.user_id, self.id).read_parser()
-
-        for event_id in config_parser.sections():
-            event = EventConfig(self, event_id)
-            event.last_notified = config_parser.getint(event_id, 'last_notified', fallback=None)
-            self.events[event_id] = event
+        self.events_loaded = True
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        try:
+            self.index = EventIndex(self._events_index_path())
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning('Ignoring broken events index of calendar %s of user %s: %s', self.id, self.user_id, e)
+        if self.index is None:
+            config_parser = EventsConfigFile(self.vardir, self.user_id, self.id).read_parser()
+            for event_id in config_parser.sections():
+                event = EventConfig(self, event_id)
+                event.last_notified = config_parser.getint(event_id, 'last_notified', fallback=None)
+                self.events[event_id] = event
+            return
+        for event in self.events.values():
+            found, last_notified = self.index.get(event_key(event.id))
+            if found:
+                event.last_notified = last_notified
 
     def event(self, id):
         """
@@ -484,13 +670,28 @@ class CalendarConfig:
         :param id: id of the event
         :return: the EventConfig instance, read from persisted storage or a new one
         """
+        if not self.events_loaded:
+            self.load_events()
         try:
             return self.events[id]
         except KeyError:
             event = EventConfig(self, id)
+            if self.index is not None:
+                _, event.last_notified = self.index.get(event_key(id))
             self.events[id] = event
             return event
 
+    def events_count(self):
+        """
+        Returns the number of known events, persisted and in memory.
+        :return: int
+        """
+        if not self.events_loaded:
+            self.load_events()
+        if self.index is None:
+            return len(self.events)
+        return len(self.index) + sum(1 for id in self.events if event_key(id) not in self.index)
+
     def event_notified(self, event):
         """
         Marks the event in config as notified.
@@ -501,6 +702,25 @@ class CalendarConfig:
         config_event = self.event(event.id)
         config_event.last_notified = event.notified_for_advance
 
+    @property
+    def slow(self):
+        """
+        The calendar is heavy to expand, it's processed in the slow lane.
+        """
+        return self.heavy_reads >= SLOW_LANE_READS
+
+    def count_read(self, budget_used):
+        """
+        Counts the read as heavy or light by the used part of the expansion budget.
+        The count is persisted with the processing result.
+        :param budget_used: part of the expansion budget used by the read, 1 if it was over the budget
+        :return: None
+        """
+        if budget_used >= HEAVY_FRACTION:
+            self.heavy_reads = min(self.heavy_reads + 1, 2 * SLOW_LANE_READS)
+        else:
+            self.heavy_reads = max(self.heavy_reads - 1, 0)
+
     def save_calendar(self, calendar):
         """
         Saves the calendar as verified and persisted
@@ -508,47 +728,102 @@ class CalendarConfig:
         :return: None
         """
         config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
+        with user_lock(self.vardir, self.user_id):
+            config_parser = config_file.read_parser()
 
-        self._create_section(config_parser)
+            self._create_section(config_parser)
 
-        self.verified = True
-        config_parser.set(self.id, 'verified', 'true')
-        self.name = calendar.name
-        config_parser.set(self.id, 'name', calendar.name)
+            self.verified = True
+            config_parser.set(self.id, 'verified', 'true')
+            self.name = calendar.name
+            config_parser.set(self.id, 'name', calendar.name)
 
-        self._update_last_process(config_parser)
+            self._update_last_process(config_parser)
 
-        config_file.write(config_parser)
+            config_file.write(config_parser)
+            index_calendar(self)
 
     def save_events(self):
         """
-        Saves all tracked events into persisted file
+        Saves all tracked events into the index file, replaces events.cfg
         :return: None
         """
-        config_file = EventsConfigFile(self.vardir, self.user_id, self.id)
-        config_parser = ConfigParser(interpolation=None)
-
+        if not self.events_loaded:
+            self.load_events()
+        records = dict(self.index.items()) if self.index is not None else {}
         for event in self.events.values():
-            config_parser.add_section(event.id)
-            if type(event.last_notified) is int:
-                config_parser.set(event.id, 'last_notified', str(event.last_notified))
+            records[event_key(event.id)] = event.last_notified if type(event.last_notified) is int else None
 
-        config_file.write(config_parser)
+        with calendar_lock(self.vardir, self.user_id, self.id):
+            write_index(self._events_index_path(), records.items())
+            legacy_path = EventsConfigFile(self.vardir, self.user_id, self.id).path
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        if self.index is not None:
+            self.index.close()
+        self.index = EventIndex(self._events_index_path())
 
         self.save_error(None)
 
-    def save_error(self, exception):
+    def save_error(self, exception, transient=False):
         """
         Saves the last error
         :param exception: exception, can be None
+        :param transient: the error is transient, the next read is postponed
         :return: None
         """
         config_file = CalendarsConfigFile(self.vardir, self.user_id)
-        config_parser = config_file.read_parser()
-        self._create_section(config_parser)
-        self._update_last_process(config_parser, exception)
-        config_file.write(config_parser)
+        with user_lock(self.vardir, self.user_id):
+            config_parser = config_file.read_parser()
+            self._create_section(config_parser)
+            self._update_last_process(config_parser, exception, transient)
+            config_file.write(config_parser)
+            index_calendar(self)
+
+    def load_cursors(self):
+        """
+        Reads the expansion cursors of the recurring events, cursors.cfg
+        :return: dict of calbot.recurrence.Cursor by UID
+        """
+        config_parser = CursorsConfigFile(self.vardir, self.user_id, self.id).read_parser()
+        self.cursors = {}
+        for section in config_parser.sections():
+            try:
+                uid = config_parser.get(section, 'uid')
+                self.cursors[uid] = Cursor(
+                    sequence=config_parser.getint(section, 'sequence', fallback=0),
+                    digest=config_parser.get(section, 'digest'),
+                    start=parse_start(config_parser.get(section, 'start')),
+                    skipped=config_parser.getint(section, 'skipped', fallback=0),
+                )
+            except Exception:
+                logger.warning('Skipping broken cursor %s of calendar %s of user %s',
+                               section, self.id, self.user_id, exc_info=True)
+        return dict(self.cursors)
+
+    def save_cursors(self, cursors):
+        """
+        Saves the expansion cursors of the recurring events, if they are changed
+        :param cursors: dict of calbot.recurrence.Cursor by UID
+        :return: None
+        """
+        if cursors == self.cursors:
+            return
+        config_parser = ConfigParser(interpolation=None)
+        for uid, cursor in cursors.items():
+            section = event_key(uid).hex()
+            config_parser.add_section(section)
+            config_parser.set(section, 'uid', uid)
+            config_parser.set(section, 'sequence', str(cursor.sequence))
+            config_parser.set(section, 'digest', cursor.digest)
+            config_parser.set(section, 'start', format_start(cursor.start))
+            config_parser.set(section, 'skipped', str(cursor.skipped))
+        with calendar_lock(self.vardir, self.user_id, self.id):
+            CursorsConfigFile(self.vardir, self.user_id, self.id).write(config_parser)
+        self.cursors = dict(cursors)
+
+    def _events_index_path(self):
+        return os.path.join(self.vardir, self.user_id, self.id, 'events.idx')
 
     def _create_section(self, config_parser):
         if not config_parser.has_section(self.id):
@@ -556,8 +831,9 @@ class CalendarConfig:
             config_parser.set(self.id, 'url', self.url)
             config_parser.set(self.id, 'channel_id', self.channel_id)
 
-    def _update_last_process(self, config_parser, error=None):
-        self.last_process_at = datetime.utcnow().isoformat()
+    def _update_last_process(self, config_parser, error=None, transient=False):
+        now = datetime.utcnow()
+        self.last_process_at = now.isoformat()
         config_parser.set(self.id, 'last_process_at', self.last_process_at)
         self.last_process_error = error
         config_parser.set(self.id, 'last_process_error', str(self.last_process_error))
@@ -567,11 +843,26 @@ class CalendarConfig:
         else:
             self.last_errors_count += 1
             config_parser.set(self.id, 'last_errors_count', str(self.last_errors_count))
+            if transient:
+                delay = retry_delay(self.last_errors_count, self.retry_interval, self.retry_max_interval)
+                self.next_attempt_at = (now + delay).isoformat()
             if self.last_errors_count >= self.errors_count_threshold:
                 logger.warning('Disabling calendar %s of user %s due %s errors count',
                                self.id, self.user_id, self.last_errors_count)
                 self.enabled = False
                 config_parser.set(self.id, 'enabled', str(self.enabled))
+        if error is None and self.profile is not None:
+            self.profile.save(config_parser, self.id)
+        if self.heavy_reads:
+            config_parser.set(self.id, 'heavy_reads', str(self.heavy_reads))
+        else:
+            config_parser.remove_option(self.id, 'heavy_reads')
+        if error is None or not transient:
+            self.next_attempt_at = None
+        if self.next_attempt_at is None:
+            config_parser.remove_option(self.id, 'next_attempt_at')
+        else:
+            config_parser.set(self.id, 'next_attempt_at', self.next_attempt_at)
 
 
 class EventConfig:
@@ -622,12 +913,15 @@ class ConfigFile:
     def write(self, parser):
         """
         Writes the configuration to the file. Creates dirs and files if necessary
+        The file is replaced atomically, so readers in other threads never see it partially written.
         :param parser: ConfigParser to be written
         :return: None
         """
         os.makedirs(os.path.dirname(self.path), exist_ok=True)
-        with open(self.path, 'wt', encoding='UTF-8') as file:
+        temp_path = '%s.%s-%s.tmp' % (self.path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wt', encoding='UTF-8') as file:
             parser.write(file)
+        os.replace(temp_path, self.path)
 
 
 class UserConfigFile(ConfigFile):
@@ -658,6 +952,21 @@ class CalendarsConfigFile(ConfigFile):
         super().__init__(os.path.join(vardir, user_id, 'calendars.cfg'))
 
 
+class CursorsConfigFile(ConfigFile):
+    """
+    Reads and writes expansion cursors config file.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        :param user_id: user ID as string
+        :param cal_id: ID of the calendar
+        """
+        super().__init__(os.path.join(vardir, user_id, cal_id, 'cursors.cfg'))
+
+
 class EventsConfigFile(ConfigFile):
     """
     Reads and writes events config file.
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Deduplication of the notifications sent to the same channel from different calendars.
+
+The notification is the same if it has the same event UID, notification moment and advance.
+The notifications sent to the channel are remembered for the window in `var/channels/<channel>.sent`,
+a text file of tab-separated records: the key of the notification and the unix time when it's forgotten.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote
+
+from calbot.locks import channel_lock
+
+__all__ = ['ChannelDedup', 'notification_key', 'start_channel_dedup', 'stop_channel_dedup']
+
+logger = logging.getLogger('dedup')
+
+CHANNELS_DIR = 'channels'
+
+COMPACT_SLACK = 100
+"""number of the expired records which are tolerated before the file is rewritten"""
+
+
+def notification_key(event):
+    """
+    Returns the key of the event notification, the same for the same event in different calendars.
+    :param event: Event instance with notified_for_advance set
+    :return: string
+    """
+    moment = event.notify_datetime
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.timestamp()     # the same moment in the different calendar timezones
+    value = '%s\t%s\t%s' % (event.uid, moment, event.notified_for_advance)
+    return hashlib.blake2b(value.encode('UTF-8'), digest_size=8).hexdigest()
+
+
+class ChannelDedup:
+    """
+    Remembers the notifications sent to the channels.
+    """
+
+    def __init__(self, vardir, window):
+        self.vardir = vardir
+        """basic var dir"""
+        self.window = window
+        """how long to remember the sent notification, in seconds"""
+
+    def claim(self, channel_id, event, now=None):
+        """
+        Remembers the notification which is going to be sent.
+        :param channel_id: the channel
+        :param event: Event instance with notified_for_advance set
+        :param now: unix time, current by default
+        :return: True if the notification should be sent, False if it was already sent to the channel
+        """
+        claimed, _ = self.claim_all(channel_id, [event], now)
+        return bool(claimed)
+
+    def claim_all(self, channel_id, events, now=None):
+        """
+        Remembers the notifications which are going to be sent, with one read and one write of the file.
+        :param channel_id: the channel
+        :param events: iterable of Event instances with notified_for_advance set
+        :param now: unix time, current by default
+        :return: tuple of the list of the events to be sent and the list of the events already sent to the channel
+        """
+        now = time.time() if now is None else now
+        events = list(events)
+        claimed = []
+        duplicates = []
+        if not events:
+            return claimed, duplicates
+        added = {}
+        with channel_lock(self.vardir, channel_id):
+            records = self._read(channel_id)
+            expired = sum(1 for expires_at in records.values() if expires_at <= now)
+            for event in events:
+                key = notification_key(event)
+                if records.get(key, 0) > now:
+                    duplicates.append(event)
+                    continue
+                records[key] = added[key] = now + self.window
+                claimed.append(event)
+            if expired > COMPACT_SLACK:
+                self._write(channel_id, dict((key, expires_at) for key, expires_at in records.items()
+                                             if expires_at > now))
+            elif added:
+                self._append(channel_id, added)
+        return claimed, duplicates
+
+    def release(self, channel_id, event):
+        """
+        Forgets the claimed notification, because it was not sent.
+        :param channel_id: the channel
+        :param event: Event instance with notified_for_advance set
+        :return: None
+        """
+        self.release_all(channel_id, [event])
+
+    def release_all(self, channel_id, events):
+        """
+        Forgets the claimed notifications, because they were not sent, with one rewrite of the file.
+        :param channel_id: the channel
+        :param events: iterable of Event instances with notified_for_advance set
+        :return: None
+        """
+        keys = set(notification_key(event) for event in events)
+        if not keys:
+            return
+        with channel_lock(self.vardir, channel_id):
+            records = self._read(channel_id)
+            removed = [key for key in keys if records.pop(key, None) is not None]
+            if removed:
+                self._write(channel_id, records)
+
+    def _read(self, channel_id):
+        records = {}
+        try:
+            with open(self._path(channel_id), 'rt', encoding='UTF-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 2:
+                        records[fields[0]] = float(fields[1])
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _append(self, channel_id, records):
+        path = self._path(channel_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'at', encoding='UTF-8') as f:
+            f.write(''.join('%s\t%.0f\n' % (key, expires_at) for key, expires_at in records.items()))
+
+    def _write(self, channel_id, records):
+        path = self._path(channel_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wt', encoding='UTF-8') as f:
+            for key, expires_at in records.items():
+                f.write('%s\t%.0f\n' % (key, expires_at))
+        os.replace(temp_path, path)
+
+    def _path(self, channel_id):
+        return os.path.join(self.vardir, CHANNELS_DIR, quote(channel_id, safe='') + '.sent')
+
+
+channel_dedup = None
+"""ChannelDedup of the notifications, None to send all notifications"""
+
+
+def start_channel_dedup(vardir, window):
+    """
+    Starts deduplication of the notifications sent to the same channel.
+    :param vardir: basic var dir
+    :param window: how long to remember the sent notification, in seconds
+    :return: None
+    """
+    global channel_dedup
+    channel_dedup = ChannelDedup(vardir, window)
+
+
+def stop_channel_dedup():
+    """
+    Stops deduplication of the notifications.
+    :return: None
+    """
+    global channel_dedup
+    channel_dedup = None
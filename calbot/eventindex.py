@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Binary index of the notified events of the calendar, `events.idx`.
+
+```
+header: magic 'CBEI', version (2 bytes), number of records (4 bytes), Bloom filter size in bytes (4 bytes),
+        number of Bloom filter hashes (1 byte)
+Bloom filter bits
+records sorted by the key: key (8 bytes), last notified advance (2 bytes, 0xFFFF if not notified)
+```
+
+The key is the hash of the event id, all numbers are big-endian.
+The file is memory-mapped and binary-searched, the Bloom filter rejects most of the unknown ids
+without touching the records.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+__all__ = ['EventIndex', 'write_index', 'event_key']
+
+MAGIC = b'CBEI'
+VERSION = 1
+HEADER = struct.Struct('>4sHIIB')
+RECORD = struct.Struct('>8sH')
+KEY_SIZE = 8
+NOT_NOTIFIED = 0xFFFF
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+
+def event_key(event_id):
+    """
+    Returns the key of the event in the index.
+    :param event_id: id of the event
+    :return: 8 bytes
+    """
+    return hashlib.blake2b(event_id.encode('UTF-8'), digest_size=KEY_SIZE).digest()
+
+
+class EventIndex:
+    """
+    Read-only memory-mapped index.
+    """
+
+    def __init__(self, path):
+        """
+        Opens the index.
+        :param path: path to events.idx file
+        :raise ValueError: if the file is not an index, or it's empty or truncated
+        """
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)    # ValueError if the file is empty
+        try:
+            magic, version, self.count, self.bloom_size, self.hashes = HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            self.map.close()
+            raise ValueError('%s is truncated' % path)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError('%s is not events index' % path)
+        self.bloom_offset = HEADER.size
+        """position of the Bloom filter"""
+        self.records_offset = self.bloom_offset + self.bloom_size
+        """position of the first record"""
+        if len(self.map) < self.records_offset + self.count * RECORD.size:
+            self.map.close()
+            raise ValueError('%s is truncated' % path)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key):
+        """
+        Returns the last notified advance of the event.
+        :param key: key of the event, see event_key()
+        :return: (found, last_notified) tuple, last_notified is None if the event was not notified
+        """
+        position = self._find(key)
+        if position is None:
+            return False, None
+        value = RECORD.unpack_from(self.map, position)[1]
+        return True, (None if value == NOT_NOTIFIED else value)
+
+    def items(self):
+        """
+        Iterates over all records.
+        :return: yields (key, last_notified) tuples
+        """
+        for index in range(self.count):
+            key, value = RECORD.unpack_from(self.map, self.records_offset + index * RECORD.size)
+            yield key, (None if value == NOT_NOTIFIED else value)
+
+    def close(self):
+        self.map.close()
+
+    def _find(self, key):
+        if not self.count or not self._maybe_contains(key):
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = self.records_offset + middle * RECORD.size
+            middle_key = self.map[position:position + KEY_SIZE]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return position
+        return None
+
+    def _maybe_contains(self, key):
+        bits = self.bloom_size * 8
+        for bit in _bloom_bits(key, bits, self.hashes):
+            if not self.map[self.bloom_offset + bit // 8] & (1 << (bit % 8)):
+                return False
+        return True
+
+
+def write_index(path, items):
+    """
+    Writes the index file, replacing it atomically.
+    :param path: path to events.idx file
+    :param items: iterable of (key, last_notified) tuples, keys must be unique
+    :return: None
+    """
+    records = sorted(items)
+    bloom_size = max(1, (len(records) * BLOOM_BITS_PER_KEY + 7) // 8)
+    bloom = bytearray(bloom_size)
+    for key, _ in records:
+        for bit in _bloom_bits(key, bloom_size * 8, BLOOM_HASHES):
+            bloom[bit // 8] |= 1 << (bit % 8)
+
+    temp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), bloom_size, BLOOM_HASHES))
+        f.write(bloom)
+        for key, value in records:
+            f.write(RECORD.pack(key, NOT_NOTIFIED if value is None else value))
+    os.replace(temp_path, path)
+
+
+def _bloom_bits(key, bits, hashes):
+    first = int.from_bytes(key[:4], 'big')
+    second = int.from_bytes(key[4:], 'big') | 1
+    return ((first + i * second) % bits for i in range(hashes))
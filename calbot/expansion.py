@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Vectorized expansion of the recurring events, with NumPy.
+
+`recurring_ical_events` creates a datetime for every occurrence of the rule since DTSTART
+and then checks the window, EXDATE and overrides one by one.
+Here the occurrences of the common rules, HOURLY, DAILY and WEEKLY with BYDAY, BYHOUR, BYMINUTE and BYSECOND,
+are computed as int64 arrays of the local wall-clock seconds, the window, EXDATE and the dates of the overrides
+are applied to the whole arrays, and only the remaining occurrences become VEVENTs.
+
+The rules are parsed by `recurring_ical_events` and `dateutil`, so the defaults, UNTIL and timezones
+are the same. The series with other rules, RDATE or duplicated UIDs, and all the series if NumPy is not installed,
+are expanded by `recurring_ical_events`.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from calbot.budget import BudgetedRule
+
+__all__ = ['expand_between']
+
+logger = logging.getLogger('expansion')
+
+EPOCH = datetime(1970, 1, 1)
+DAY = 86400
+HOUR = 3600
+WINDOW_MARGIN = 2 * DAY
+"""the window is checked in the local time of the series first, the margin covers any UTC offset"""
+
+HOURLY = 4
+DAILY = 3
+WEEKLY = 2
+"""the frequencies of dateutil.rrule"""
+
+_numpy = None
+
+
+def expand_between(vcalendar, after, before, budget=None):
+    """
+    Returns the events and the occurrences of the recurring events in the window,
+    as recurring_ical_events.of(vcalendar).between(after, before) does.
+    :param vcalendar: icalendar.Calendar
+    :param after: start of the window, aware datetime
+    :param before: end of the window, aware datetime
+    :param budget: calbot.budget.ExpansionBudget to count the components and occurrences, can be None
+    :return: list of VEVENT components
+    :raise ExpansionBudgetExceeded: if the expansion is over the budget
+    """
+    import recurring_ical_events    # heavy, imported on first parse
+
+    np = _load_numpy()
+    if np is None:
+        return _library_between(recurring_ical_events.of(vcalendar), after, before, budget)
+
+    import icalendar
+    import x_wr_timezone
+    vcalendar = x_wr_timezone.to_standard(vcalendar)
+
+    components = {}
+    for vevent in vcalendar.walk('VEVENT'):
+        components.setdefault(str(vevent.get('UID')), []).append(vevent)
+
+    events = []
+    fallback = icalendar.Calendar()
+    for uid, vevents in components.items():
+        if budget is not None:
+            budget.tick(len(vevents))
+        vectorized = None
+        try:
+            vectorized = VectorizedSeries.of(np, vevents)
+        except Exception:
+            logger.debug('Failed to vectorize %s', uid, exc_info=True)
+        if vectorized is None:
+            for vevent in vevents:
+                fallback.add_component(vevent)
+        else:
+            events.extend(vectorized.between(after, before, budget))
+    if fallback.subcomponents:
+        events.extend(_library_between(recurring_ical_events.of(fallback), after, before, budget))
+    return events
+
+
+def _library_between(unfoldable, after, before, budget):
+    if budget is not None:
+        budget.tick(len(unfoldable.repetitions))
+        for repeated in unfoldable.repetitions:
+            repeated.rule = BudgetedRule(repeated.rule, budget)
+    return unfoldable.between(after, before)
+
+
+def _load_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            logger.info('NumPy is not installed, recurring events are expanded by recurring_ical_events')
+            _numpy = False
+    return _numpy or None
+
+
+class VectorizedSeries:
+    """
+    Recurring series of one UID: the master VEVENT with the supported rule and the overrides of its occurrences.
+    """
+
+    def __init__(self, np, master, overrides, components):
+        self.np = np
+        """numpy module"""
+        self.master = master
+        """recurring_ical_events.RepeatedEvent of the master VEVENT"""
+        self.overrides = overrides
+        """list of recurring_ical_events.RepeatedEvent of the VEVENTs with RECURRENCE-ID"""
+        self.components = components
+        """all RepeatedEvent of the UID in the calendar order"""
+        self.rule = master.rrule
+        """dateutil.rrule.rrule of the master, with its defaults filled from DTSTART"""
+
+    @classmethod
+    def of(cls, np, vevents):
+        """
+        Creates the series if all VEVENTs of the UID can be expanded with NumPy.
+        :param np: numpy module
+        :param vevents: list of VEVENT components with the same UID
+        :return: VectorizedSeries instance or None
+        """
+        from recurring_ical_events import RepeatedEvent
+        components = [RepeatedEvent(vevent) for vevent in vevents]
+        masters = [component for component in components if not component.is_recurrence()]
+        if len(masters) != 1 or not _is_supported(masters[0]):
+            return None
+        master = masters[0]
+        overrides = [component for component in components if component.is_recurrence()]
+        if any(override.rrule is not None for override in overrides):
+            return None
+        return cls(np, master, overrides, components)
+
+    def between(self, after, before, budget=None):
+        """
+        Returns the master occurrences and the overrides in the window,
+        deduplicated as recurring_ical_events does.
+        :param after: start of the window
+        :param before: end of the window
+        :param budget: ExpansionBudget to count the occurrences, can be None
+        :return: list of VEVENT components
+        """
+        events = []
+        by_date = {}
+        not_in_span = []
+        for component in self.components:
+            if component is self.master:
+                for repetition in self._repetitions(after, before, budget):
+                    _add_event(events, by_date, repetition.as_vevent())
+            else:
+                repetition = component.as_single_event()
+                vevent = repetition.as_vevent()
+                _add_event(events, by_date, vevent)
+                if not repetition.is_in_span(after, before):
+                    not_in_span.append(vevent)
+        for vevent in not_in_span:
+            try:
+                events.remove(vevent)
+            except ValueError:
+                pass
+        return events
+
+    def _repetitions(self, after, before, budget):
+        from recurring_ical_events import Repetition, compare_greater
+        walls = self._walls(after, before, budget)
+
+        master = self.master
+        span_start, span_stop = self._rule_span(after, before)
+        until = master.get_rrule_until()
+        tzinfo = self.rule._dtstart.tzinfo
+        for wall in walls.tolist():
+            start = EPOCH + timedelta(seconds=wall)
+            if tzinfo is not None:
+                start = start.replace(tzinfo=tzinfo)    # dateutil keeps the UTC offset of DTSTART
+            if not span_start <= start <= span_stop:
+                continue
+            if tzinfo is not None:
+                # the same as recurring_ical_events does for pytz, see RepeatedEvent.within_days()
+                start = tzinfo.localize(start.replace(tzinfo=None))
+                if until is not None and start > until:
+                    continue
+            if master._unify_exdate(start) in master.exdates_utc:
+                continue
+            repetition = Repetition(master.event,
+                                    master.convert_to_original_type(start),
+                                    master.convert_to_original_type(start + master.duration))
+            if compare_greater(repetition.start, before):
+                break
+            if repetition.is_in_span(after, before):
+                yield repetition
+
+    def _rule_span(self, after, before):
+        """
+        Returns the bounds of the occurrences of the rule which are checked by recurring_ical_events,
+        from the beginning of the day of the window start to the end of the day of the window end.
+        """
+        from recurring_ical_events import convert_to_datetime, compare_greater
+        master = self.master
+        span_start = convert_to_datetime(after.replace(hour=0, minute=0, second=0), master.tzinfo)
+        span_stop = convert_to_datetime(before.replace(hour=23, minute=59, second=59), master.tzinfo)
+        if compare_greater(span_start, master.start):
+            span_start -= master.duration
+        return span_start, span_stop
+
+    def _walls(self, after, before, budget):
+        """
+        Computes the occurrences in the window as local wall-clock seconds since the epoch.
+        """
+        np = self.np
+        rule = self.rule
+        dtstart = rule._dtstart
+        start_wall = _wall(dtstart)
+        offset = int(dtstart.utcoffset().total_seconds()) if dtstart.tzinfo is not None else 0
+        duration = int(self.master.duration.total_seconds())
+        low = _wall(after) - WINDOW_MARGIN - max(duration, 0)
+        high = _wall(before) + WINDOW_MARGIN
+        if rule._count:
+            low = start_wall    # the occurrences are counted from the start
+
+        until = rule._until
+        if until is not None:
+            # dateutil compares the occurrences in the timezone of DTSTART with UNTIL
+            until_wall = _wall(until) if until.tzinfo is None else int(until.timestamp()) + offset
+            high = min(high, until_wall)
+        if high < low:
+            return np.empty(0, dtype=np.int64)
+
+        walls = self._generate(start_wall, low, high)
+        if budget is not None:
+            budget.tick(len(walls))
+        walls = walls[walls >= start_wall]
+        if until is not None:
+            walls = walls[walls <= until_wall]
+        if rule._count:
+            walls = walls[:rule._count]
+        walls = np.union1d(walls, np.array([start_wall], dtype=np.int64))    # DTSTART is always an occurrence
+
+        exdates = [exdate for exdate in self.master.exdates if isinstance(exdate, datetime)]
+        if exdates:
+            if dtstart.tzinfo is not None:
+                # dateutil compares the instants, the occurrences have the UTC offset of DTSTART
+                excluded = np.array([int(exdate.timestamp()) for exdate in exdates if exdate.tzinfo is not None],
+                                    dtype=np.int64)
+                walls = walls[~np.isin(walls - offset, excluded)]
+            else:
+                excluded = np.array([_wall(exdate) for exdate in exdates if exdate.tzinfo is None], dtype=np.int64)
+                walls = walls[~np.isin(walls, excluded)]
+
+        # an override added before the master drops all its occurrences of that day in _add_event(),
+        # an override added after it replaces only the last one, so it's left to _add_event()
+        preceding = self.components[:self.components.index(self.master)]
+        override_days = np.array([_recurrence_day(override.event) for override in preceding], dtype=np.int64)
+        if len(override_days):
+            walls = walls[~np.isin(walls // DAY, override_days)]
+
+        return walls[(walls >= low) & (walls <= high)]
+
+    def _generate(self, start_wall, low, high):
+        np = self.np
+        rule = self.rule
+        interval = rule._interval
+        weekdays = np.array(sorted(rule._byweekday), dtype=np.int64) if rule._byweekday else None
+        seconds = np.array(sorted(minute * 60 + second for minute in rule._byminute for second in rule._bysecond),
+                           dtype=np.int64)
+
+        if rule._freq == HOURLY:
+            first_hour = start_wall - start_wall % HOUR
+            step = HOUR * interval
+            hours = first_hour + step * np.arange(max(0, (low - first_hour) // step), (high - first_hour) // step + 1,
+                                                  dtype=np.int64)
+            if rule._byhour:
+                hours = hours[np.isin(hours % DAY // HOUR, np.array(sorted(rule._byhour), dtype=np.int64))]
+            if weekdays is not None:
+                hours = hours[np.isin(_weekday(hours // DAY), weekdays)]
+            return (hours[:, None] + seconds[None, :]).ravel()
+
+        times = np.array(sorted(hour * HOUR + second for hour in rule._byhour for second in seconds.tolist()),
+                         dtype=np.int64)
+        first_day = start_wall // DAY
+        if rule._freq == DAILY:
+            step = interval
+            days = first_day + step * np.arange(max(0, (low // DAY - first_day) // step),
+                                                (high // DAY - first_day) // step + 1, dtype=np.int64)
+            if weekdays is not None:
+                days = days[np.isin(_weekday(days), weekdays)]
+        else:   # WEEKLY
+            first_week = first_day - (int(_weekday(first_day)) - rule._wkst) % 7
+            step = 7 * interval
+            weeks = first_week + step * np.arange(max(0, (low // DAY - first_week) // step),
+                                                  (high // DAY - first_week) // step + 1, dtype=np.int64)
+            offsets = np.array(sorted((weekday - rule._wkst) % 7 for weekday in weekdays.tolist()), dtype=np.int64)
+            days = (weeks[:, None] + offsets[None, :]).ravel()
+        return (days[:, None] * DAY + times[None, :]).ravel()
+
+
+def _is_supported(master):
+    rule = master.rrule
+    if rule is None or master.rdates or rule._freq not in (HOURLY, DAILY, WEEKLY):
+        return False
+    if rule._bysetpos or rule._bymonth or rule._byyearday or rule._byeaster or rule._byweekno \
+            or rule._bymonthday or rule._bynmonthday or rule._bynweekday:
+        return False
+    if rule._freq == WEEKLY and not rule._byweekday:
+        return False
+    dtstart = rule._dtstart
+    if dtstart.tzinfo is not None and not hasattr(dtstart.tzinfo, 'localize'):
+        return False    # only pytz timezones are re-localized as recurring_ical_events does
+    return master.start.microsecond == 0
+
+
+def _add_event(events, by_date, vevent):
+    """
+    Adds the event replacing the events of the same day, as recurring_ical_events does.
+    """
+    recurrence_id = vevent.get('RECURRENCE-ID', vevent['DTSTART']).dt
+    if isinstance(recurrence_id, datetime):
+        recurrence_id = recurrence_id.date()
+    other = by_date.get(recurrence_id)
+    if other is not None:
+        event_recurrence_id = vevent.get('RECURRENCE-ID')
+        other_recurrence_id = other.get('RECURRENCE-ID')
+        if event_recurrence_id is not None and other_recurrence_id is None:
+            events.remove(other)
+        elif event_recurrence_id is None and other_recurrence_id is not None:
+            return
+        elif vevent.get('SEQUENCE') is not None and other.get('SEQUENCE') is not None:
+            if vevent['SEQUENCE'] < other['SEQUENCE']:
+                return
+            events.remove(other)
+    by_date[recurrence_id] = vevent
+    events.append(vevent)
+
+
+def _recurrence_day(vevent):
+    recurrence_id = vevent['RECURRENCE-ID'].dt
+    day = recurrence_id.date() if isinstance(recurrence_id, datetime) else recurrence_id
+    return (day - EPOCH.date()).days
+
+
+def _wall(value):
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return int((value.replace(tzinfo=None) - EPOCH).total_seconds())
+
+
+def _weekday(days):
+    return (days + 3) % 7   # 1970-01-01 is Thursday, Monday is 0
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Store of the fetched ical feeds, to record the feeds in production and replay them offline.
+
+```
+objects/ab/abcdef....gz - the gzipped bodies, named by the SHA-256 of the content
+feeds.log               - tab-separated records, one per fetch: time, hash, size, url
+```
+
+The same body is stored once, its modification time is updated on every fetch.
+When the total size of the objects is over the limit, the least recently fetched objects are deleted
+with their records. The log is compacted to the last record of each url when it grows too long.
+
+The replay reads the last recorded body of the url, so the recorded pass is repeated exactly.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from calbot.locks import store_lock
+
+__all__ = ['FeedStore']
+
+logger = logging.getLogger('feedstore')
+
+LOG_FILE = 'feeds.log'
+OBJECTS_DIR = 'objects'
+
+EVICT_TO = 0.9
+"""the fraction of the maximum size the objects are evicted to, to not evict on every next fetch"""
+
+COMPACT_SLACK = 1000
+"""number of the stale records which are tolerated before the compaction, in addition to the urls count"""
+
+
+class FeedStore:
+    """
+    Content-addressed store of the compressed feeds.
+    """
+
+    def __init__(self, path, max_size=0):
+        self.path = path
+        """the store directory"""
+        self.max_size = max_size
+        """maximum total size of the compressed objects, in bytes, 0 for no limit"""
+        self.size = None
+        """the known total size of the objects, None if it's not calculated yet"""
+        self.records = None
+        """the known number of the log records, None if it's not counted yet"""
+        self.recorded_urls = 0
+        """number of the urls in the log when the records were counted"""
+        self.replayed = None
+        """dict of the hash of the last body by url, read once to replay"""
+
+    def record(self, url, data):
+        """
+        Stores the fetched body.
+        :param url: url of the feed
+        :param data: the fetched bytes
+        :return: hash of the body
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        with store_lock(self.path):
+            if self.size is None:
+                self.size = self._objects_size()
+            if self.records is None:
+                self._count_log()
+            if os.path.exists(path):
+                os.utime(path)      # recently fetched, evicted the last
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+                with open(temp_path, 'wb') as f:
+                    f.write(gzip.compress(data))
+                os.replace(temp_path, path)
+                self.size += os.path.getsize(path)
+            with open(self._log_path(), 'at', encoding='UTF-8') as f:
+                f.write('\t'.join((datetime.utcnow().isoformat(), digest, str(len(data)), _escape(url))) + '\n')
+            self.records += 1
+            if self.max_size and self.size > self.max_size:
+                self._evict()
+            elif self.records > 2 * self.recorded_urls + COMPACT_SLACK:
+                self._compact_log()
+        return digest
+
+    def replay(self, url):
+        """
+        Returns the last recorded body of the feed.
+        :param url: url of the feed
+        :return: bytes
+        :raise KeyError: if the feed was not recorded
+        """
+        digest = self.last_digests().get(url)
+        if digest is None:
+            raise KeyError('Feed %s is not recorded' % url)
+        with open(self._object_path(digest), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def last_digests(self):
+        """
+        Returns the last recorded hashes, read once, the replayed store is not changed.
+        :return: dict of the hash by url
+        """
+        if self.replayed is None:
+            with store_lock(self.path):
+                self.replayed = dict((url, digest) for url, (digest, _) in self._read_log()[0].items())
+        return self.replayed
+
+    def urls(self):
+        """
+        Returns the recorded urls.
+        :return: list of urls
+        """
+        return list(self.last_digests())
+
+    def _evict(self):
+        objects = []
+        for root, _, files in os.walk(os.path.join(self.path, OBJECTS_DIR)):
+            for name in files:
+                if name.endswith('.gz'):
+                    stat = os.stat(os.path.join(root, name))
+                    objects.append((stat.st_mtime, stat.st_size, name[:-len('.gz')]))
+        objects.sort()
+        self.size = sum(size for _, size, _ in objects)
+        evicted = set()
+        for _, size, digest in objects:
+            if self.size <= self.max_size * EVICT_TO:
+                break
+            os.remove(self._object_path(digest))
+            self.size -= size
+            evicted.add(digest)
+        last, _ = self._read_log()
+        self._write_log([(url, record) for url, record in last.items() if record[0] not in evicted])
+        logger.info('Evicted %s feeds from %s, %s bytes left', len(evicted), self.path, self.size)
+
+    def _count_log(self):
+        last, self.records = self._read_log()
+        self.recorded_urls = len(last)
+
+    def _compact_log(self):
+        last, records = self._read_log()     # the other processes could append to the log too
+        if records > 2 * len(last) + COMPACT_SLACK:
+            self._write_log(list(last.items()))
+        else:
+            self.records, self.recorded_urls = records, len(last)
+
+    def _read_log(self):
+        last = OrderedDict()
+        records = 0
+        try:
+            with open(self._log_path(), 'rt', encoding='UTF-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    records += 1
+                    if len(fields) != 4:
+                        logger.warning('Skipping broken feeds log record: %r', line)
+                        continue
+                    url = _unescape(fields[3])
+                    last.pop(url, None)     # keeps the order of the last fetches
+                    last[url] = (fields[1], '\t'.join(fields[:3]))
+        except FileNotFoundError:
+            pass
+        return last, records
+
+    def _write_log(self, items):
+        path = self._log_path()
+        temp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wt', encoding='UTF-8') as f:
+            for url, (_, fields) in items:
+                f.write('%s\t%s\n' % (fields, _escape(url)))
+        os.replace(temp_path, path)
+        self.records = self.recorded_urls = len(items)
+
+    def _objects_size(self):
+        size = 0
+        for root, _, files in os.walk(os.path.join(self.path, OBJECTS_DIR)):
+            size += sum(os.path.getsize(os.path.join(root, name)) for name in files if name.endswith('.gz'))
+        return size
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, OBJECTS_DIR, digest[:2], digest + '.gz')
+
+    def _log_path(self):
+        return os.path.join(self.path, LOG_FILE)
+
+
+def _escape(value):
+    return value.replace('%', '%25').replace('\t', '%09').replace('\n', '%0A').replace('\r', '%0D')
+
+
+def _unescape(value):
+    return value.replace('%0D', '\r').replace('%0A', '\n').replace('%09', '\t').replace('%25', '%')
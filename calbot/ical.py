@@ -18,16 +18,24 @@
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
 
+import heapq
 import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from urllib.request import urlopen
 import pytz
-import icalendar
-import recurring_ical_events
 
+from calbot.budget import ExpansionBudget
 from calbot.formatting import BlankFormat
+from calbot.expansion import expand_between
+from calbot.recurrence import apply_cursors
+from calbot.timings import ProcessingProfile
 
-__all__ = ['Calendar', 'sample_event']
+__all__ = ['Calendar', 'get_sample_event', 'start_parse_pool', 'stop_parse_pool', 'start_slow_parse_pool',
+           'stop_slow_parse_pool', 'start_feed_store', 'stop_feed_store', 'configure_expansion_budget',
+           'shared_downloads']
 
 
 logger = logging.getLogger('ical')
@@ -38,7 +46,7 @@ class Calendar:
     Calendar, as it was read from ical file.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, lookahead=None):
         self.url = config.url
         """url of the ical file, from persisted config"""
         self.advance = config.advance
@@ -51,49 +59,400 @@ class Calendar:
         """timezone of the calendar, from ical file"""
         self.description = None
         """description of the calendar, from ical file"""
+        self.profile = ProcessingProfile()
+        """timings and sizes of the calendar processing"""
+        self.slow = config.slow
+        """the calendar is heavy to expand, it's parsed in the slow parse pool if it's started"""
 
         after = datetime.now(tz=pytz.UTC)
-        before = after + timedelta(hours=max(self.advance))
+        before = after + timedelta(hours=max(self.advance)) + (lookahead or timedelta())
 
-        self.all_events = list(self.read_ical(self.url, after, before))
-        """list of all calendar events, from ical file"""
+        self.cursors = {}
+        """expansion cursors of the recurring series by UID, see calbot.recurrence"""
+        self.occurrences = self.fetch(self.url, after, before, config.load_cursors())
+        """all calendar events as plain tuples, see Event.to_tuple(), including the lookahead period:
+        the Expansion which expands them on each iteration, or the list returned by the parse pool"""
 
-        unnotified_events = filter_notified_events(self.all_events, config)
-        sorted_events = sort_events(unnotified_events)
-
-        self.events = list(sorted_events)
-        """list of calendar events which should be notified, filtered from ical file"""
+    def iter_events(self):
+        """
+        Streams all calendar events, including the lookahead period.
+        The events are expanded and the Event instances are created on demand, they are not kept by the calendar.
+        :return: it's generator, yields each event read from ical
+        """
+        for values in self.occurrences:
+            yield Event.from_tuple(values)
 
-    def read_ical(self, url, after, before):
+    def due_events(self, config, future=None):
+        """
+        Streams the calendar events which should be notified now, in the order of notification.
+        Only the due events are kept in memory to be ordered.
+        The calendar is expanded once, the events to be notified later can be collected on the way.
+        :param config: CalendarConfig to check which events are already notified
+        :param future: list to append the events which have notifications in the future to, can be None
+        :return: it's generator, yields each filtered event with notified_for_advance set
+        """
+        events = self.iter_events()
+        if future is not None:
+            events = _collect_future(events, future, min(self.advance))
+        expanded = self.profile.timings['expand']
+        with self.profile.phase('filter'):
+            ordered = stream_sorted_events(filter_notified_events(events, config))
+        self.profile.timings['filter'] -= self.profile.timings['expand'] - expanded     # measured by the Expansion
+        return ordered
+
+    def read_ical(self, url, after, before, cursors=None):
         """
         Reads ical file from url.
+        Updates the expansion cursors of the calendar.
         :param url: url to read
         :param after: also generate repeating events after this datetime
         :param before: also generate repeating events before this datetime
+        :param cursors: dict of known expansion cursors by UID, None to expand all series from the start
         :return: it's generator, yields each event read from ical
         """
+        for values in self.fetch(url, after, before, cursors):
+            yield Event.from_tuple(values)
+
+    def fetch(self, url, after, before, cursors=None):
+        """
+        Reads ical file from url and parses it.
+        Updates the name, timezone, profile and expansion cursors of the calendar.
+        :param url: url to read
+        :param after: also generate repeating events after this datetime
+        :param before: also generate repeating events before this datetime
+        :param cursors: dict of known expansion cursors by UID, None to expand all series from the start
+        :return: iterable of events as plain tuples, see Event.to_tuple(): the Expansion,
+            or the list if the file is parsed in the parse pool
+        :raise ExpansionBudgetExceeded: if the expansion is over the limits, also raised by the Expansion iteration
+        """
         # TODO also filter past events to avoid reading of the whole calendar
-        logger.info('Getting %s', url)
-        with urlopen(url) as f:
-            timezone_set = 'none'
-            vcalendar = icalendar.Calendar.from_ical(f.read())
-            self.name = str(vcalendar.get('X-WR-CALNAME'))
-            self.description = str(vcalendar.get('X-WR-CALDESC'))
-
-            if vcalendar.get('X-WR-TIMEZONE') is not None:
-                self.timezone = pytz.timezone(str(vcalendar.get('X-WR-TIMEZONE')))
-                timezone_set = 'x-wr-timezone'
-
-            for component in vcalendar.walk():
-                if component.name == 'VTIMEZONE' and timezone_set in ('none', 'x-wr-timezone'):
+        shared = getattr(shared_feeds, 'feeds', None)
+        if shared is not None and url in shared:
+            logger.info('Reusing %s', url)
+            data = shared[url]
+        elif feed_store is not None and feed_replay:
+            logger.info('Replaying %s', url)
+            with self.profile.phase('download'):
+                data = feed_store.replay(url)
+        else:
+            from urllib.request import urlopen     # heavy (http.client, ssl, email), imported on first read
+            logger.info('Getting %s', url)
+            connect_started = time.perf_counter()
+            with urlopen(url) as f:
+                self.profile.timings['connect'] += time.perf_counter() - connect_started
+                with self.profile.phase('download'):
+                    data = f.read()
+            if feed_store is not None:
+                with self.profile.phase('download'):
                     try:
-                        self.timezone = pytz.timezone(str(component.get('TZID')))
-                        timezone_set = 'vtimezone.tzid'
-                    except Exception as e:
-                        logger.warning(e)
+                        feed_store.record(url, data)
+                    except Exception:
+                        logger.warning('Failed to record %s', url, exc_info=True)
+        if shared is not None:
+            shared[url] = data
+        self.profile.bytes = len(data)
+
+        pool = slow_parse_pool if self.slow and slow_parse_pool is not None else parse_pool
+        if pool is not None:
+            result = pool.parse(data, after, before, self.day_start, cursors, expansion_limits)
+            self.name, self.description, self.timezone, events, stats, self.cursors = result
+            for key in ('parse', 'expand'):
+                self.profile.timings[key] += stats[key]
+            self.profile.vevents = stats['vevents']
+            self.profile.budget = stats['budget']
+            self.profile.occurrences = len(events)
+            return events
+
+        with self.profile.phase('parse'):
+            self.name, self.description, self.timezone, vcalendar = read_vcalendar(data)
+        self.profile.vevents = len(vcalendar.walk('VEVENT'))
+        with self.profile.phase('expand'):
+            budget = ExpansionBudget(*expansion_limits)
+            self.cursors = apply_cursors(vcalendar, after, cursors, budget) if cursors is not None else {}
+        budget.pause()      # resumed by the Expansion iteration
+        self.profile.budget = budget.used()
+        return Expansion(vcalendar, self.timezone, after, before, self.day_start, budget, self.profile)
+
+
+def read_vcalendar(data):
+    """
+    Parses ical file content.
+    :param data: content of the ical file
+    :return: tuple of calendar name, description, timezone and icalendar.Calendar
+    """
+    import icalendar    # imported on first parse
+    timezone_set = 'none'
+    timezone = pytz.UTC
+    vcalendar = icalendar.Calendar.from_ical(data)
+    name = str(vcalendar.get('X-WR-CALNAME'))
+    description = str(vcalendar.get('X-WR-CALDESC'))
+
+    if vcalendar.get('X-WR-TIMEZONE') is not None:
+        timezone = pytz.timezone(str(vcalendar.get('X-WR-TIMEZONE')))
+        timezone_set = 'x-wr-timezone'
+
+    for component in vcalendar.walk():
+        if component.name == 'VTIMEZONE' and timezone_set in ('none', 'x-wr-timezone'):
+            try:
+                timezone = pytz.timezone(str(component.get('TZID')))
+                timezone_set = 'vtimezone.tzid'
+            except Exception as e:
+                logger.warning(e)
+
+    return name, description, timezone, vcalendar
+
+
+class Expansion:
+    """
+    Events of the parsed ical file, expanded on each iteration.
+    The events are yielded one by one as plain tuples, see Event.to_tuple(), they are not kept in memory.
+    All iterations are counted by the same budget of the read, only while the expansion runs,
+    not while the iteration is paused at the yielded event.
+    Each iteration updates the expand timing, the number of occurrences and the used budget of the profile.
+    """
+
+    def __init__(self, vcalendar, timezone, after, before, day_start, budget, profile):
+        self.vcalendar = vcalendar
+        """parsed icalendar.Calendar"""
+        self.timezone = timezone
+        """timezone of the calendar"""
+        self.after = after
+        """also generate repeating events after this datetime"""
+        self.before = before
+        """also generate repeating events before this datetime"""
+        self.day_start = day_start
+        """when the day starts if the event has no specified time"""
+        self.budget = budget
+        """ExpansionBudget of the read"""
+        self.profile = profile
+        """ProcessingProfile to update"""
+
+    def __iter__(self):
+        count = 0
+        started = time.perf_counter()
+        self.budget.resume()
+        try:
+            for vevent in expand_between(self.vcalendar, self.after, self.before, self.budget):
+                values = Event.from_vevent(vevent, self.timezone, self.day_start).to_tuple()
+                count += 1
+                self.budget.pause()
+                self.profile.timings['expand'] += time.perf_counter() - started
+                yield values
+                started = time.perf_counter()
+                self.budget.resume()
+        finally:
+            self.budget.pause()
+        self.profile.timings['expand'] += time.perf_counter() - started
+        self.profile.occurrences = count
+        self.profile.budget = self.budget.used()
+
+
+def parse_ical(data, after, before, day_start, cursors=None, limits=(0, 0)):
+    """
+    Parses ical file content and expands repeating events.
+    Returns only plain values, so it can be called in another process.
+    :param data: content of the ical file
+    :param after: also generate repeating events after this datetime
+    :param before: also generate repeating events before this datetime
+    :param day_start: when the day starts if the event has no specified time
+    :param cursors: dict of known expansion cursors by UID, None to expand all series from the start
+    :param limits: tuple of the CPU time and the number of occurrences the expansion is limited by, 0 for no limit
+    :return: tuple of calendar name, description, timezone, list of events as tuples, see Event.to_tuple(),
+        dict of parse and expand timings, number of vevents and used part of the expansion budget,
+        and dict of the new expansion cursors
+    :raise ExpansionBudgetExceeded: if the expansion is over the limits
+    """
+    profile = ProcessingProfile()
+    with profile.phase('parse'):
+        name, description, timezone, vcalendar = read_vcalendar(data)
+    with profile.phase('expand'):
+        budget = ExpansionBudget(*limits)
+        new_cursors = apply_cursors(vcalendar, after, cursors, budget) if cursors is not None else {}
+    events = list(Expansion(vcalendar, timezone, after, before, day_start, budget, profile))
+    stats = dict(parse=profile.timings['parse'],
+                 expand=profile.timings['expand'],
+                 vevents=len(vcalendar.walk('VEVENT')),
+                 budget=profile.budget)
+    return name, description, timezone, events, stats, new_cursors
+
+
+class ParsePool:
+    """
+    Pool of processes to run parse_ical() out of the bot process.
+    The processes are started on the first parse.
+    The processes are recycled after the specified number of tasks per process,
+    to return the memory taken by huge calendars: by the executor itself on Python 3.11+,
+    by replacing the whole executor on the older versions.
+    """
+
+    def __init__(self, workers, tasks_per_worker, niceness=0):
+        self.workers = workers
+        """number of processes"""
+        self.tasks_per_worker = tasks_per_worker
+        """number of tasks after which the processes are replaced, 0 to never replace them"""
+        self.niceness = niceness
+        """how much to lower the priority of the processes, 0 to keep the priority of the bot"""
+        self.tasks = 0
+        """number of tasks submitted to the current processes, counted on Python older than 3.11"""
+        self.executor = None
+        """current ProcessPoolExecutor"""
+        self.lock = threading.Lock()
+
+    def parse(self, data, after, before, day_start, cursors=None, limits=(0, 0)):
+        """
+        Runs parse_ical() in the pool and waits for the result.
+        """
+        with self.lock:
+            if self.executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                options = {}
+                if self.tasks_per_worker and RECYCLING_EXECUTOR:
+                    options['max_tasks_per_child'] = self.tasks_per_worker
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_lower_priority, initargs=(self.niceness,),
+                                                    **options)
+            future = self.executor.submit(parse_ical, data, after, before, day_start, cursors, limits)
+            if self.tasks_per_worker and not RECYCLING_EXECUTOR:
+                self.tasks += 1
+            if self.tasks_per_worker and self.tasks >= self.workers * self.tasks_per_worker:
+                self.executor.shutdown(wait=False)      # the processes exit after the submitted tasks
+                self.executor = None
+                self.tasks = 0
+        return future.result()
+
+    def shutdown(self):
+        """
+        Stops the processes.
+        """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+RECYCLING_EXECUTOR = sys.version_info >= (3, 11)
+"""ProcessPoolExecutor can replace its processes after the number of tasks"""
+
+
+def _lower_priority(niceness):
+    if niceness:
+        import os
+        os.nice(niceness)
+
+
+parse_pool = None
+"""ParsePool to parse ical files in, None to parse them in the current thread"""
+
+slow_parse_pool = None
+"""ParsePool with the lower priority to parse ical files of the slow calendars in, None to parse them as others"""
+
+expansion_limits = (0, 0)
+"""CPU time in seconds and number of occurrences the expansion of one calendar is limited by, 0 for no limit"""
+
+
+def configure_expansion_budget(cpu_time, occurrences):
+    """
+    Limits the expansion of the calendars, see calbot.budget.
+    :param cpu_time: maximum CPU time of the expansion of one calendar, in seconds, 0 for no limit
+    :param occurrences: maximum number of the iterated components and occurrences, 0 for no limit
+    :return: None
+    """
+    global expansion_limits
+    expansion_limits = (cpu_time, occurrences)
+
+
+def start_parse_pool(workers, tasks_per_worker):
+    """
+    Starts parsing of ical files in the pool of processes.
+    :param workers: number of processes
+    :param tasks_per_worker: number of tasks after which the processes are replaced
+    :return: None
+    """
+    global parse_pool
+    parse_pool = ParsePool(workers, tasks_per_worker)
+
+
+def stop_parse_pool():
+    """
+    Returns parsing of ical files to the current thread.
+    :return: None
+    """
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown()
+        parse_pool = None
 
-            for event in recurring_ical_events.of(vcalendar).between(after, before):
-                yield Event.from_vevent(event, self.timezone, self.day_start)
+
+def start_slow_parse_pool(tasks_per_worker, niceness=10):
+    """
+    Starts parsing of ical files of the slow calendars in the process with the lower priority.
+    The process is started on the first slow calendar.
+    :param tasks_per_worker: number of tasks after which the process is replaced
+    :param niceness: how much to lower the priority of the process
+    :return: None
+    """
+    global slow_parse_pool
+    slow_parse_pool = ParsePool(1, tasks_per_worker, niceness)
+
+
+def stop_slow_parse_pool():
+    """
+    Returns parsing of ical files of the slow calendars to the usual pool or thread.
+    :return: None
+    """
+    global slow_parse_pool
+    if slow_parse_pool is not None:
+        slow_parse_pool.shutdown()
+        slow_parse_pool = None
+
+
+feed_store = None
+"""FeedStore to record the read ical files to or to replay them from, None to only read them from urls"""
+
+feed_replay = False
+"""read the ical files from feed_store instead of urls"""
+
+
+def start_feed_store(path, max_size=0, replay=False):
+    """
+    Starts recording of the read ical files, or reading them from the recorded ones.
+    :param path: the store directory
+    :param max_size: maximum size of the recorded files, in bytes, 0 for no limit
+    :param replay: read the recorded files instead of urls
+    :return: None
+    """
+    from calbot.feedstore import FeedStore
+    global feed_store, feed_replay
+    feed_store = FeedStore(path, max_size)
+    feed_replay = replay
+
+
+def stop_feed_store():
+    """
+    Returns reading of ical files to urls, without recording.
+    :return: None
+    """
+    global feed_store, feed_replay
+    feed_store = None
+    feed_replay = False
+
+
+shared_feeds = threading.local()
+"""the ical files downloaded in the shared_downloads() block of the current thread, by url"""
+
+
+@contextmanager
+def shared_downloads():
+    """
+    Downloads each url only once for all calendars read in the block in the current thread.
+    """
+    shared_feeds.feeds = {}
+    try:
+        yield
+    finally:
+        shared_feeds.feeds = None
 
 
 class Event:
@@ -184,6 +543,35 @@ class Event:
             day_start=event_day_start
         )
 
+    def to_tuple(self):
+        """
+        Converts the event to the compact tuple of plain values, to pass it between processes.
+        :return: tuple of the event properties
+        """
+        return (self.id, self.uid, self.title, self.location, self.description,
+                self.date, self.time, self.notify_datetime, self.day_start)
+
+    @classmethod
+    def from_tuple(cls, values):
+        """
+        Creates the event from the tuple returned by to_tuple()
+        :param values: tuple of the event properties
+        :return: calendar event instance
+        """
+        event_id, uid, title, location, description, event_date, event_time, notify_datetime, day_start = values
+        return cls(
+            id=event_id,
+            uid=uid,
+            instance_id=(uid, notify_datetime),
+            title=title,
+            location=location,
+            description=description,
+            date=event_date,
+            time=event_time,
+            notify_datetime=notify_datetime,
+            day_start=day_start
+        )
+
     def to_dict(self):
         """
         Converts the event to dict to be easy passed to format function.
@@ -208,14 +596,15 @@ def filter_notified_events(events, config):
     now = datetime.now(tz=pytz.UTC)
     for event in events:
         for advance in sorted(config.advance, reverse=True):
+            if event.notify_datetime > now + timedelta(hours=advance):
+                continue    # checked first, the notified events are loaded only for the due events
             notified = config.event(event.id)
             last_notified = notified is not None and notified.last_notified
             if last_notified is not None and last_notified <= advance:
                 continue
-            if event.notify_datetime <= now + timedelta(hours=advance):
-                event.notified_for_advance = advance
-                yield event
-                break
+            event.notified_for_advance = advance
+            yield event
+            break
 
 
 def sort_events(events):
@@ -224,6 +613,32 @@ def sort_events(events):
     return sorted(events, key=sort_key)
 
 
+def stream_sorted_events(events):
+    """
+    Orders the events by the notification time.
+    The events are consumed at once into the heap, so filter them before, to keep the heap small.
+    The heap is popped lazily, as the events are consumed.
+    :param events: iterable of events
+    :return: generator of the events ordered by notify_datetime, the equal ones in the original order
+    """
+    heap = [(event.notify_datetime, index, event) for index, event in enumerate(events)]
+    heapq.heapify(heap)
+    return _pop_all(heap)
+
+
+def _collect_future(events, future, min_advance, now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    for event in events:
+        if event.notify_datetime - timedelta(hours=min_advance) > now:
+            future.append(event)
+        yield event
+
+
+def _pop_all(heap):
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
 def timezoned(dt, timezone):
     if isinstance(dt, datetime):
         if dt.tzinfo is None:
@@ -236,7 +651,11 @@ def timezoned(dt, timezone):
         return dt
 
 
-def _get_sample_event():
+def get_sample_event():
+    """
+    Creates the sample event to demonstrate the formatting, happening now.
+    :return: Event instance
+    """
     now = datetime.now(tz=pytz.timezone('Asia/Omsk'))
     return Event(
         id='SAMPLE EVENT',
@@ -247,6 +666,3 @@ def _get_sample_event():
         description='The sample event is to demonstrate how the event can be formatted',
         date=now.date(),
         time=now.timetz())
-
-
-sample_event = _get_sample_event()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Locks of the persisted state of users and calendars.
+
+The user lock guards read-modify-write of `settings.cfg` and `calendars.cfg` of the user.
+The calendar lock guards the processing of the calendar and its `events.cfg`.
+The index lock guards the global index of calendars, `calendars.idx`, it's taken the last.
+The store lock guards the recorded feeds, see calbot.feedstore, it's taken without the other locks.
+The channel lock guards the notifications sent to the channel, see calbot.dedup, no other lock is taken under it.
+The locks are reentrant. The calendar lock can be taken before the user lock, never after it.
+
+The locks are in-process, and optionally also file locks, to guard the state shared with other processes,
+like the workers of the supervisor mode.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from calbot import metrics
+
+__all__ = ['user_lock', 'calendar_lock', 'index_lock', 'store_lock', 'channel_lock', 'configure_locks']
+
+logger = logging.getLogger('locks')
+
+LOCK_WAIT = metrics.Histogram('calbot_lock_wait_seconds', 'Time waited for the contended locks', labels=('kind',))
+LOCK_CONTENDED = metrics.Counter('calbot_lock_contended_total', 'Lock acquisitions which had to wait',
+                                 labels=('kind',))
+
+
+class KeyLock:
+    """
+    Reentrant lock of one user or calendar, optionally backed by the file lock.
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.RLock()
+        """in-process lock"""
+        self.path = path
+        """path of the lock file, None to not lock the file"""
+        self.depth = 0
+        """number of nested acquisitions by the owning thread"""
+        self.file = None
+        """the open lock file while the lock is held"""
+        self.holders = 0
+        """number of holds which use or wait for the lock, counted by LockManager"""
+
+    def acquire(self, kind):
+        if not self.lock.acquire(blocking=False):
+            LOCK_CONTENDED.inc(kind=kind)
+            started = time.perf_counter()
+            self.lock.acquire()
+            LOCK_WAIT.observe(time.perf_counter() - started, kind=kind)
+        if self.depth == 0 and self.path is not None:
+            try:
+                self._lock_file(kind)
+            except Exception:
+                self.lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.file is not None:
+            import fcntl
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+    def _lock_file(self, kind):
+        import fcntl    # the file locks are optional, not available on all platforms
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            LOCK_CONTENDED.inc(kind=kind)
+            started = time.perf_counter()
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            LOCK_WAIT.observe(time.perf_counter() - started, kind=kind)
+        except Exception:
+            self.file.close()
+            self.file = None
+            raise
+
+
+class LockManager:
+    """
+    Holds the locks by the user and calendar ids.
+    The lock is kept only while it's held or waited for.
+    """
+
+    def __init__(self, file_locks=False):
+        self.file_locks = file_locks
+        """also lock files, to guard the state from other processes"""
+        self.locks = {}
+        """KeyLock by the (vardir,), (vardir, user_id), (vardir, user_id, calendar_id), ('store', path)
+        or ('channel', vardir, channel_id) key, only the held and waited ones"""
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, kind, key, path):
+        with self.lock:
+            key_lock = self.locks.get(key)
+            if key_lock is None:
+                key_lock = self.locks[key] = KeyLock(path if self.file_locks else None)
+            key_lock.holders += 1
+        try:
+            key_lock.acquire(kind)
+            try:
+                yield
+            finally:
+                key_lock.release()
+        finally:
+            with self.lock:
+                key_lock.holders -= 1
+                if key_lock.holders == 0:
+                    del self.locks[key]
+
+
+manager = LockManager()
+
+
+def configure_locks(file_locks):
+    """
+    Replaces the lock manager of the process. Call it before any lock is taken.
+    :param file_locks: also lock files, to guard the state from other processes
+    :return: None
+    """
+    global manager
+    manager = LockManager(file_locks)
+
+
+def user_lock(vardir, user_id):
+    """
+    Locks the settings and calendars list of the user.
+    :param vardir: basic var dir
+    :param user_id: ID of the user
+    :return: context manager
+    """
+    return manager.hold('user', (vardir, user_id), os.path.join(vardir, user_id, '.lock'))
+
+
+def calendar_lock(vardir, user_id, calendar_id):
+    """
+    Locks the processing and the events of the calendar.
+    :param vardir: basic var dir
+    :param user_id: ID of the user
+    :param calendar_id: ID of the calendar
+    :return: context manager
+    """
+    return manager.hold('calendar', (vardir, user_id, calendar_id),
+                        os.path.join(vardir, user_id, calendar_id, '.lock'))
+
+
+def index_lock(vardir):
+    """
+    Locks the global index of calendars.
+    :param vardir: basic var dir
+    :return: context manager
+    """
+    return manager.hold('index', (vardir,), os.path.join(vardir, 'calendars.idx.lock'))
+
+
+def store_lock(path):
+    """
+    Locks the store of the recorded feeds.
+    :param path: the store directory
+    :return: context manager
+    """
+    return manager.hold('store', ('store', path), os.path.join(path, '.lock'))
+
+
+def channel_lock(vardir, channel_id):
+    """
+    Locks the sent notifications of the channel.
+    :param vardir: basic var dir
+    :param channel_id: ID of the channel
+    :return: context manager
+    """
+    from urllib.parse import quote
+    return manager.hold('channel', ('channel', vardir, channel_id),
+                        os.path.join(vardir, 'channels', quote(channel_id, safe='') + '.lock'))
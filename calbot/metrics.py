@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Live metrics of the bot in Prometheus text format.
+
+The metrics are collected in the bot process, the optional HTTP listener exposes them on `/metrics`.
+In the supervisor mode the fetch, parse and expand times of the calendars processed by the worker processes
+are not collected, the passes and the sent messages are.
+"""
+
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'REGISTRY', 'start_metrics_server', 'render', 'measure_send']
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Registry:
+    """
+    Collection of all metrics to be exposed.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    Base of the metrics, holds the values by the labels values.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        self.name = name
+        """metric name"""
+        self.documentation = documentation
+        """help text"""
+        self.labels_names = tuple(labels)
+        """names of the labels"""
+        self.values = {}
+        """values by the tuple of the labels values"""
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels_names)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labels_names, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend(self.samples())
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return ['%s%s %s' % (self.name, self._labels(key), _number(value))
+                    for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """
+    Value which can go up and down, or is calculated by the function on each scrape.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.functions = {}
+        """functions to calculate the values, by the tuple of the labels values"""
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """
+        Sets the function to calculate the value on each scrape.
+        :param function: callable without arguments returning a number
+        :param labels: values of the labels
+        :return: None
+        """
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                logger.warning('Failed to calculate %s', self.name, exc_info=True)
+                continue
+            with self.lock:
+                self.values[key] = value
+        with self.lock:
+            return ['%s%s %s' % (self.name, self._labels(key), _number(value))
+                    for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    """
+    Distribution of the observed values by the buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %s' % (self.name, self._labels(key, [('le', _number(bound))]), bucket))
+                lines.append('%s_bucket%s %s' % (self.name, self._labels(key, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %s' % (self.name, self._labels(key), _number(total)))
+                lines.append('%s_count%s %s' % (self.name, self._labels(key), count))
+        return lines
+
+
+def render(registry=REGISTRY):
+    """
+    Renders all metrics of the registry.
+    :param registry: Registry instance
+    :return: text in Prometheus exposition format
+    """
+    lines = []
+    with registry.lock:
+        metrics = list(registry.metrics)
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(listen, port):
+    """
+    Starts HTTP listener of /metrics in the background thread.
+    :param listen: IP address to listen
+    :param port: port to listen
+    :return: the server instance
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer    # not needed unless the metrics are exposed
+    from socketserver import ThreadingMixIn
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class MetricsServer6(MetricsServer):
+        address_family = socket.AF_INET6
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('UTF-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    host = listen.strip('[]')
+    server_class = MetricsServer6 if ':' in host else MetricsServer
+    server = server_class((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info('Started metrics on %s:%s', listen, port)
+    return server
+
+
+@contextmanager
+def measure_send():
+    """
+    Measures sending of the message to Telegram in the block, counts the failures.
+    The failure is a flood limit when the exception has `retry_after`, like telegram.error.RetryAfter.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        SEND_FAILURES.inc()
+        if getattr(e, 'retry_after', None) is not None:
+            SEND_FLOOD.inc()
+        raise
+    finally:
+        SEND_DURATION.observe(time.perf_counter() - started)
+
+
+def process_rss():
+    """
+    Resident set size of the current process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+PASS_DURATION = Histogram('calbot_pass_duration_seconds', 'Duration of the processing pass of all calendars')
+FETCH_DURATION = Histogram('calbot_fetch_duration_seconds', 'Time to connect and download the calendar')
+PARSE_DURATION = Histogram('calbot_parse_duration_seconds', 'Time to parse the calendar')
+EXPAND_DURATION = Histogram('calbot_expand_duration_seconds', 'Time to expand repeating events of the calendar')
+SEND_DURATION = Histogram('calbot_send_duration_seconds', 'Time to send the message to Telegram')
+SEND_FAILURES = Counter('calbot_send_failures_total', 'Messages failed to be sent')
+SEND_FLOOD = Counter('calbot_send_flood_total', 'Messages rejected by Telegram flood limits (429)')
+OUTBOX_LATENCY = Histogram('calbot_outbox_latency_seconds', 'Time the message waited in the outbox before sent')
+OUTBOX_DROPPED = Counter('calbot_outbox_dropped_total', 'Messages dropped from the outbox after too many attempts')
+CALENDARS = Gauge('calbot_calendars', 'Calendars by state, as of the last statistics update', labels=('state',))
+QUEUE_SIZE = Gauge('calbot_queue_size', 'Items waiting in the queues', labels=('queue',))
+PROCESS_RSS = Gauge('calbot_process_resident_memory_bytes', 'Resident memory of the bot process')
+PROCESS_RSS.set_function(process_rss)
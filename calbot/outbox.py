@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Persistent outbox of the notifications.
+
+The due notifications are formatted and written to `outbox.cfg` of the calendar first,
+then the events are marked as notified, then the outbox is drained: the messages are sent one by one
+and each sent message is removed from the outbox.
+A message which failed to be sent stays in the outbox and is retried later with the growing delay,
+till the maximum number of attempts, the later messages to the same chat wait for it.
+A message rejected by Telegram, like to a chat where the bot is not allowed to write, is dropped at once.
+
+The message is keyed by its notifications, so the message written again after a crash
+between the outbox write and the events save is not duplicated.
+The delivery is at least once: a crash between the send and the outbox write repeats the message.
+
+The calendars with the messages waiting are marked by the empty files in `var/outboxes`,
+so the periodic drain doesn't look into every calendar.
+
+```
+var/
+    outboxes/
+        user1_chat_id@calendar1_id - the mark of the calendar with the messages waiting
+    user1_chat_id/
+        calendar1_id/
+            outbox.cfg - the messages waiting to be sent
+```
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from configparser import ConfigParser
+from urllib.parse import quote, unquote
+
+from calbot.backoff import retry_delay
+from calbot.conf import ConfigFile
+from calbot.dedup import notification_key
+from calbot.formatting import format_event, group_messages, DIGEST_SEPARATOR
+from calbot.locks import calendar_lock
+from calbot import metrics
+from calbot.timings import ProcessingProfile
+
+__all__ = ['OutboxMessage', 'Outbox', 'format_messages', 'enqueue', 'drain', 'drain_outboxes', 'configure_outbox',
+           'is_permanent']
+
+logger = logging.getLogger('outbox')
+
+max_attempts = 10
+"""number of failed attempts to send the message after which it's dropped"""
+
+retry_interval = 60
+"""delay before the first retry of the failed message, in seconds"""
+
+RETRY_MAX_INTERVAL = 3600
+"""maximum delay between the retries of the failed message, in seconds"""
+
+OUTBOXES_DIR = 'outboxes'
+"""directory of the marks of the calendars with the messages waiting"""
+
+PERMANENT_ERRORS = ('BadRequest', 'Unauthorized', 'ChatMigrated')
+"""names of the telegram.error classes which are not fixed by the retry"""
+
+
+def configure_outbox(attempts, interval):
+    """
+    Configures the retries of the failed messages.
+    :param attempts: number of failed attempts to send the message after which it's dropped
+    :param interval: delay before the first retry, in seconds
+    :return: None
+    """
+    global max_attempts, retry_interval
+    max_attempts = attempts
+    retry_interval = interval
+
+
+class OutboxMessage:
+    """
+    Message waiting to be sent.
+    """
+
+    def __init__(self, **kwargs):
+        self.key = kwargs['key']
+        """key of the message, the same for the same notifications"""
+        self.chat_id = kwargs['chat_id']
+        """chat or channel to send the message to"""
+        self.text = kwargs['text']
+        """the formatted text"""
+        self.events = kwargs.get('events', [])
+        """list of (event id, advance) tuples of the notifications in the message"""
+        self.created_at = kwargs.get('created_at', time.time())
+        """unix time when the message was written to the outbox"""
+        self.attempts = kwargs.get('attempts', 0)
+        """number of failed attempts to send the message"""
+        self.next_attempt_at = kwargs.get('next_attempt_at', 0)
+        """unix time before which the message is not retried"""
+
+    @classmethod
+    def of(cls, chat_id, text, events):
+        """
+        Creates the message of the notifications.
+        :param chat_id: chat or channel to send the message to
+        :param text: the formatted text
+        :param events: list of Event instances with notified_for_advance set
+        :return: OutboxMessage instance
+        """
+        keys = '\t'.join([str(chat_id)] + [notification_key(event) for event in events])
+        return cls(
+            key=hashlib.blake2b(keys.encode('UTF-8'), digest_size=8).hexdigest(),
+            chat_id=chat_id,
+            text=text,
+            events=[(event.id, event.notified_for_advance) for event in events],
+        )
+
+
+def format_messages(config, events):
+    """
+    Formats the notifications of the events, one by one or as digests.
+    :param config: CalendarConfig instance
+    :param events: list of Event instances, with notified_for_advance set, in the order of notification
+    :return: list of OutboxMessage
+    """
+    texts = [format_event(config, event) for event in events]
+    if not config.digest:
+        return [OutboxMessage.of(config.channel_id, text, [event]) for text, event in zip(texts, events)]
+    return [OutboxMessage.of(config.channel_id, DIGEST_SEPARATOR.join(texts[index] for index in indexes),
+                             [events[index] for index in indexes])
+            for indexes in group_messages(texts)]
+
+
+class Outbox:
+    """
+    Outbox of the calendar.
+    Read and write it under the calendar lock.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        self.config_file = OutboxConfigFile(vardir, user_id, cal_id)
+        self.mark_path = os.path.join(vardir, OUTBOXES_DIR,
+                                      '%s@%s' % (quote(user_id, safe=''), quote(cal_id, safe='')))
+        """the file which marks the outbox with the messages"""
+
+    def messages(self):
+        """
+        Reads the messages waiting to be sent.
+        :return: list of OutboxMessage in the order they were written
+        """
+        config_parser = self.config_file.read_parser()
+        result = []
+        for section in config_parser.sections():
+            try:
+                result.append(OutboxMessage(
+                    key=section,
+                    chat_id=config_parser.get(section, 'chat_id'),
+                    text=json.loads(config_parser.get(section, 'text')),
+                    events=[tuple(event) for event in json.loads(config_parser.get(section, 'events'))],
+                    created_at=config_parser.getfloat(section, 'created_at'),
+                    attempts=config_parser.getint(section, 'attempts', fallback=0),
+                    next_attempt_at=config_parser.getfloat(section, 'next_attempt_at', fallback=0),
+                ))
+            except Exception:
+                logger.warning('Skipping broken outbox message %s in %s', section, self.config_file.path,
+                               exc_info=True)
+        return result
+
+    def write(self, messages):
+        """
+        Replaces the messages, removes the outbox file and its mark if there are no messages.
+        :param messages: list of OutboxMessage
+        :return: None
+        """
+        if not messages:
+            for path in (self.config_file.path, self.mark_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return
+        config_parser = ConfigParser(interpolation=None)
+        for message in messages:
+            config_parser.add_section(message.key)
+            config_parser.set(message.key, 'chat_id', str(message.chat_id))
+            config_parser.set(message.key, 'text', json.dumps(message.text))   # keeps the lines indentation
+            config_parser.set(message.key, 'events', json.dumps(message.events))
+            config_parser.set(message.key, 'created_at', '%.3f' % message.created_at)
+            config_parser.set(message.key, 'attempts', str(message.attempts))
+            config_parser.set(message.key, 'next_attempt_at', '%.3f' % message.next_attempt_at)
+        self.config_file.write(config_parser)
+        if not os.path.exists(self.mark_path):
+            os.makedirs(os.path.dirname(self.mark_path), exist_ok=True)
+            open(self.mark_path, 'w').close()
+
+    def exists(self):
+        return os.path.exists(self.config_file.path)
+
+
+def enqueue(config, messages):
+    """
+    Writes the messages to the outbox of the calendar, then marks their events as notified.
+    The messages already in the outbox are not added again.
+    :param config: CalendarConfig instance
+    :param messages: list of OutboxMessage
+    :return: None
+    """
+    if not messages:
+        return
+    outbox = Outbox(config.vardir, config.user_id, config.id)
+    with calendar_lock(config.vardir, config.user_id, config.id):
+        queued = outbox.messages()
+        keys = set(message.key for message in queued)
+        outbox.write(queued + [message for message in messages if message.key not in keys])
+        for message in messages:
+            for event_id, advance in message.events:
+                config.event(event_id).last_notified = advance
+        config.save_events()
+
+
+def drain(bot, config, now=None, profile=None):
+    """
+    Sends the due messages of the calendar outbox in order, removes the sent ones.
+    The failed message is retried later, or dropped after too many attempts,
+    the next messages to the same chat wait for it. The message rejected by Telegram is dropped at once.
+    :param bot: Bot instance
+    :param config: CalendarConfig instance
+    :param now: unix time, current by default
+    :param profile: ProcessingProfile to measure sending, can be None
+    :return: number of messages left in the outbox
+    """
+    now = time.time() if now is None else now
+    profile = profile or ProcessingProfile()
+    outbox = Outbox(config.vardir, config.user_id, config.id)
+    with calendar_lock(config.vardir, config.user_id, config.id):
+        messages = outbox.messages()
+        left = list(messages)
+        waiting = set()     # the chats with the failed or not due message, the messages to them are sent in order
+        for message in messages:
+            if message.chat_id in waiting:
+                continue
+            if message.next_attempt_at > now:
+                waiting.add(message.chat_id)
+                continue
+            logger.info('Sending message %s of %s events to %s', message.key, len(message.events), message.chat_id)
+            try:
+                with profile.phase('send'), metrics.measure_send():
+                    bot.sendMessage(chat_id=message.chat_id, text=message.text)
+            except Exception as e:
+                message.attempts += 1
+                if is_permanent(e) or message.attempts >= max_attempts:
+                    logger.error('Dropping message %s to %s after %s attempts',
+                                 message.key, message.chat_id, message.attempts, exc_info=True)
+                    left.remove(message)
+                    metrics.OUTBOX_DROPPED.inc()
+                else:
+                    logger.warning('Failed to send message %s to %s, attempt %s',
+                                   message.key, message.chat_id, message.attempts, exc_info=True)
+                    delay = retry_delay(message.attempts, retry_interval, RETRY_MAX_INTERVAL)
+                    message.next_attempt_at = now + delay.total_seconds()
+                    waiting.add(message.chat_id)
+                outbox.write(left)
+                continue
+            left.remove(message)
+            outbox.write(left)
+            metrics.OUTBOX_LATENCY.observe(max(time.time() - message.created_at, 0))
+        return len(left)
+
+
+def is_permanent(error):
+    """
+    Checks whether the message can't be sent by the retry.
+    The telegram.error classes are checked by names, not to import telegram here.
+    :param error: the exception raised by Bot.sendMessage()
+    :return: True if the message is rejected by Telegram
+    """
+    return any(cls.__name__ in PERMANENT_ERRORS for cls in type(error).__mro__)
+
+
+def drain_outboxes(bot, config):
+    """
+    Sends the due messages of the outboxes of all calendars which have messages waiting.
+    Updates the outbox backlog metrics.
+    :param bot: Bot instance
+    :param config: main config
+    :return: number of messages left in the outboxes
+    """
+    try:
+        names = os.listdir(os.path.join(config.vardir, OUTBOXES_DIR))
+    except FileNotFoundError:
+        names = []
+    backlog = 0
+    for name in names:
+        user_id, _, calendar_id = name.partition('@')
+        user_id, calendar_id = unquote(user_id), unquote(calendar_id)
+        try:
+            calendar = config.load_calendar(user_id, calendar_id)
+        except KeyError:
+            Outbox(config.vardir, user_id, calendar_id).write([])     # the calendar is deleted
+            continue
+        except Exception:
+            logger.warning('Failed to load calendar %s of user %s', calendar_id, user_id, exc_info=True)
+            continue
+        try:
+            backlog += drain(bot, calendar)
+        except Exception:
+            logger.warning('Failed to drain outbox of calendar %s of user %s',
+                           calendar.id, calendar.user_id, exc_info=True)
+    metrics.QUEUE_SIZE.set(backlog, queue='outbox')
+    return backlog
+
+
+class OutboxConfigFile(ConfigFile):
+    """
+    Reads and writes outbox config file.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        :param user_id: user ID as string
+        :param cal_id: ID of the calendar
+        """
+        super().__init__(os.path.join(vardir, user_id, cal_id, 'outbox.cfg'))
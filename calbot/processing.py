@@ -18,12 +18,22 @@
 # along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
 
 import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
-from calbot.formatting import format_event
+from calbot.backoff import is_transient
+from calbot.budget import ExpansionBudgetExceeded
+from calbot import dedup
+from calbot import metrics
 from calbot.ical import Calendar
+from calbot.locks import calendar_lock
+from calbot import outbox
 from calbot.stats import update_stats
+from calbot.timings import ProcessingProfile
 
-__all__ = ['update_calendars_job', 'update_calendars', 'update_calendar']
+__all__ = ['update_calendars_job', 'update_calendars', 'update_calendars_on_workers', 'update_calendar',
+           'warmup_calendar', 'notify_due_events', 'notify_events', 'dry_run_calendar']
 
 logger = logging.getLogger('processing')
 
@@ -41,55 +51,161 @@ def update_calendars_job(bot, job):
     update_calendars(bot, config)
 
 
-def update_calendars(bot, config):
+def update_calendars(bot, config, wheel=None, breaker=None, slow_lane=None):
     """
     Runs the update of all calendars one by one.
+    The slow calendars are queued to the slow lane, if it's given.
     Finally, updates statistics.
     :param bot: Bot instance
     :param config: main config
+    :param wheel: NotificationWheel to schedule future notifications, can be None
+    :param breaker: CircuitBreaker to skip failing hosts, can be None
+    :param slow_lane: SlowLane to process the calendars heavy to expand, can be None
     :return: None
     """
-    for calendar in config.all_calendars():
-        update_calendar(bot, calendar)
+    started = time.perf_counter()
+    for calendar in config.all_calendars(enabled=True):
+        if slow_lane is not None and calendar.slow:
+            slow_lane.submit(bot, calendar)
+            continue
+        update_calendar(bot, calendar, wheel, timedelta(seconds=config.interval), breaker)
+    metrics.PASS_DURATION.observe(time.perf_counter() - started)
     update_stats(config)
 
 
-def update_calendar(bot, config):
+def update_calendars_on_workers(config, supervisor, wheel=None):
+    """
+    Runs the update of all calendars on the worker processes.
+    Reloads the future notifications of processed calendars into the wheel.
+    Finally, updates statistics.
+    :param config: main config
+    :param supervisor: Supervisor instance with started workers
+    :param wheel: NotificationWheel to reload, can be None
+    :return: None
+    """
+    started = time.perf_counter()
+    calendars = supervisor.run_pass()
+    metrics.PASS_DURATION.observe(time.perf_counter() - started)
+    for user_id, calendar_id in calendars:
+        if wheel is not None:
+            wheel.remove_calendar(user_id, calendar_id)
+            try:
+                wheel.restore_calendar(config.load_calendar(user_id, calendar_id))
+            except Exception:
+                logger.warning('Failed to reload notifications of calendar %s of user %s',
+                               calendar_id, user_id, exc_info=True)
+    update_stats(config)
+
+
+def warmup_calendar(bot, config, calendar, wheel=None, breaker=None):
+    """
+    Processes the calendar overdue after the start.
+    The calendar is reloaded, it can be changed or deleted since the warm-up was planned.
+    :param bot: Bot instance
+    :param config: main config
+    :param calendar: CalendarConfig instance of the overdue calendar
+    :param wheel: NotificationWheel to schedule future notifications, can be None
+    :param breaker: CircuitBreaker to skip failing hosts, can be None
+    :return: None
+    """
+    try:
+        calendar = config.load_calendar(calendar.user_id, calendar.id)
+    except KeyError:
+        return
+    update_calendar(bot, calendar, wheel, timedelta(seconds=config.interval), breaker)
+
+
+def update_calendar(bot, config, wheel=None, lookahead=None, breaker=None, force=False):
     """
     Update data from the calendar.
     Reads ical file and notifies events if necessary.
+    The events of the calendar are loaded under the calendar lock, only if the read calendar has events to notify.
     After the first successful read the calendar is marked as validated.
+    Calendars postponed after transient errors and calendars of hosts with open circuit are skipped,
+    the skip is not counted as an error.
     :param bot: Bot instance
     :param config: CalendarConfig instance to persist and update events notification status
+    :param wheel: NotificationWheel to schedule future notifications, can be None
+    :param lookahead: how long after the advance to read events for the wheel, usually the calendars read interval
+    :param breaker: CircuitBreaker to skip failing hosts, can be None
+    :param force: process the calendar even if it's postponed, on the user's request
     :return: None
     """
+    with calendar_lock(config.vardir, config.user_id, config.id):
+        if config.events_loaded:
+            config.load_events()    # could be changed while waiting for the lock
+        _update_calendar(bot, config, wheel, lookahead, breaker, force)
+
+
+def _update_calendar(bot, config, wheel, lookahead, breaker, force=False):
     if not config.enabled:
         logger.info('Skipping processing of disabled calendar %s of user %s', config.id, config.user_id)
         return
 
+    from dateutil.parser import parse   # imported on first use, it's slow to import
+
+    if not force and config.next_attempt_at is not None and parse(config.next_attempt_at) > datetime.utcnow():
+        logger.info('Postponing processing of calendar %s of user %s till %s',
+                    config.id, config.user_id, config.next_attempt_at)
+        return
+
+    if breaker is not None and not breaker.allow(config.url, time.time()):
+        logger.info('Skipping processing of calendar %s of user %s, the host circuit is open',
+                    config.id, config.user_id)
+        return
+
+    transient = False
     try:
-        calendar = Calendar(config)
+        try:
+            calendar = Calendar(config, lookahead if wheel is not None else None)
+        except Exception as e:
+            transient = is_transient(e)
+            if transient and breaker is not None:
+                breaker.failure(config.url, time.time())
+            elif breaker is not None:
+                breaker.success(config.url)     # the host answered, the calendar itself is wrong
+            raise
+        if breaker is not None:
+            breaker.success(config.url)
+
+        # the calendar is expanded here, once, only the due events and the events for the wheel are kept
+        future = [] if wheel is not None else None
+        due = list(calendar.due_events(config, future))
+        config.count_read(calendar.profile.budget)
+
+        profile = calendar.profile
+        metrics.FETCH_DURATION.observe(profile.timings['connect'] + profile.timings['download'])
+        metrics.PARSE_DURATION.observe(profile.timings['parse'])
+        metrics.EXPAND_DURATION.observe(profile.timings['expand'])
 
         if not config.verified:
             bot.sendMessage(chat_id=config.channel_id,
                             text='Events from %s will be notified here' % calendar.name)
-            config.save_calendar(calendar)
+            with profile.phase('persist'):
+                config.save_calendar(calendar)
             bot.sendMessage(chat_id=config.user_id,
                             text='''Verified calendar %s
 Name: %s
 URL: %s
 Channel: %s''' % (config.id, config.name, config.url, config.channel_id))
 
-        for event in calendar.events:
-            send_event(bot, config, event)
-            config.event_notified(event)
-            config.save_events()
+        notify_events(bot, config, due, profile)
+
+        if wheel is not None:
+            with profile.phase('persist'):
+                wheel.schedule_calendar(config, future)
+
+        with profile.phase('persist'):
+            config.save_cursors(calendar.cursors)
 
+        config.profile = profile
         config.save_error(None)  # successful processing completion
     except Exception as e:
         logger.warning('Failed to process calendar %s of user %s', config.id, config.user_id, exc_info=True)
+        if isinstance(e, ExpansionBudgetExceeded):
+            config.count_read(1.0)
         was_enabled = config.enabled
-        config.save_error(e)  # unsuccessful completion
+        config.save_error(e, transient)  # unsuccessful completion
 
         if was_enabled and not config.verified:  # still enabled
             try:
@@ -106,13 +222,96 @@ Channel: %s''' % (config.id, config.name, config.url, config.channel_id))
                 logger.error('Failed to send message to user %s', config.user_id, exc_info=True)
 
 
-def send_event(bot, config, event):
+def dry_run_calendar(config):
+    """
+    Reads the calendar and formats its due notifications, as update_calendar() does,
+    but sends nothing and saves nothing.
+    :param config: CalendarConfig instance
+    :return: tuple of ProcessingProfile and the number of messages which would be sent
+    """
+    calendar = Calendar(config)
+    due = list(calendar.due_events(config))
+    with calendar.profile.phase('format'):
+        messages = outbox.format_messages(config, due)
+    return calendar.profile, len(messages)
+
+
+def notify_due_events(bot, config, wheel):
+    """
+    Sends notifications which are due in the wheel.
+    The calendar is not read, the events are taken as they were scheduled by the last calendar read.
+    Skips events of deleted and disabled calendars and events which are already notified.
+    :param bot: Bot instance
+    :param config: main config
+    :param wheel: NotificationWheel instance
+    :return: None
+    """
+    calendars = OrderedDict()
+    for moment in wheel.pop_due():
+        calendars.setdefault((moment.user_id, moment.calendar_id), []).append(moment)
+
+    for (user_id, calendar_id), moments in calendars.items():
+        try:
+            calendar_config = config.load_calendar(user_id, calendar_id)
+        except KeyError:
+            wheel.remove_calendar(user_id, calendar_id)
+            continue
+        if not calendar_config.enabled:
+            wheel.remove_calendar(user_id, calendar_id)
+            continue
+
+        try:
+            with calendar_lock(config.vardir, user_id, calendar_id):     # the events are loaded under the lock
+                events = []
+                for moment in moments:
+                    event = moment.event
+                    last_notified = calendar_config.event(event.id).last_notified
+                    if last_notified is not None and last_notified <= moment.advance:
+                        continue
+                    event.notified_for_advance = moment.advance
+                    events.append(event)
+                notify_events(bot, calendar_config, events)
+                wheel.save_calendar(calendar_config)
+        except Exception:
+            # the notifications are retried by the next calendar read
+            logger.warning('Failed to notify events of calendar %s of user %s',
+                           calendar_id, user_id, exc_info=True)
+
+
+def notify_events(bot, config, events, profile=None):
     """
-    Sends the event notification to the channel
+    Writes the notifications of the events to the calendar outbox, one by one or as digests,
+    marks the events as notified, then sends the outbox.
+    The messages failed to be sent stay in the outbox to be retried later, they don't fail the calendar.
+    Skips the events already notified to the same channel from other calendars, if the dedup is started.
     :param bot: Bot instance
     :param config: CalendarConfig instance
-    :param event: Event instance, read from ical
+    :param events: iterable of Event instances, with notified_for_advance set, in the order of notification
+    :param profile: ProcessingProfile to measure formatting, sending and persisting, can be None
     :return: None
     """
-    logger.info('Sending event %s "%s" to %s', event.id, event.title, config.channel_id)
-    bot.sendMessage(chat_id=config.channel_id, text=format_event(config, event))
+    profile = profile or ProcessingProfile()
+    events = list(events)
+    channel_dedup = dedup.channel_dedup
+    duplicates = []
+    if channel_dedup is not None:
+        events, duplicates = channel_dedup.claim_all(config.channel_id, events)
+    if duplicates:
+        logger.info('Skipping %s events already notified to %s', len(duplicates), config.channel_id)
+        with profile.phase('persist'):
+            for event in duplicates:
+                config.event_notified(event)
+            config.save_events()
+
+    pending = list(events)
+    try:
+        with profile.phase('format'):
+            messages = outbox.format_messages(config, events)
+        with profile.phase('persist'):
+            outbox.enqueue(config, messages)
+        pending = []
+    finally:
+        if channel_dedup is not None:     # not queued, can be sent by this or other calendar later
+            channel_dedup.release_all(config.channel_id, pending)
+
+    outbox.drain(bot, config, profile=profile)
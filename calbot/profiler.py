@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+On-demand profiling of the running bot.
+
+The admin requests to profile the next processing passes, with cProfile or with tracemalloc snapshots,
+the report is sent to the admin as a text document after the last profiled pass.
+In the supervisor mode the calendars are processed by the worker processes,
+the profile of the pass shows only the main process.
+"""
+
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+__all__ = ['Profiler', 'profile_call', 'profile_calendar', 'format_profile', 'format_allocations']
+
+logger = logging.getLogger('profiler')
+
+TOP_COUNT = 40
+
+
+class Profiler:
+    """
+    Profiles the requested number of the processing passes.
+    """
+
+    def __init__(self):
+        self.request = None
+        """ProfileRequest of the next passes, None if nothing to profile"""
+        self.lock = threading.Lock()
+
+    def request_passes(self, chat_id, passes, memory=False):
+        """
+        Requests to profile the next passes. Replaces the previous request.
+        :param chat_id: chat to send the report to
+        :param passes: number of passes to profile
+        :param memory: take tracemalloc snapshots instead of cProfile
+        :return: None
+        """
+        with self.lock:
+            self.request = ProfileRequest(chat_id=chat_id, passes=passes, memory=memory)
+
+    @contextmanager
+    def profile_pass(self, bot):
+        """
+        Profiles the processing pass in the block if it was requested.
+        Sends the report after the last requested pass.
+        :param bot: Bot instance to send the report
+        """
+        with self.lock:
+            request = self.request
+        if request is None:
+            yield
+            return
+
+        collector = AllocationsCollector() if request.memory else StatsCollector()
+        collector.start()
+        try:
+            yield
+        finally:
+            collector.stop()
+            request.reports.append(collector.report())
+            request.passes -= 1
+            if request.passes <= 0:
+                with self.lock:
+                    if self.request is request:
+                        self.request = None
+                send_report(bot, request.chat_id, 'passes', '\n\n'.join(request.reports))
+
+
+class ProfileRequest:
+    """
+    The request of the admin to profile the passes.
+    """
+
+    def __init__(self, **kwargs):
+        self.chat_id = kwargs['chat_id']
+        """chat to send the report to"""
+        self.passes = kwargs['passes']
+        """number of passes left to profile"""
+        self.memory = kwargs.get('memory', False)
+        """take memory snapshots instead of cProfile"""
+        self.reports = []
+        """reports of the profiled passes"""
+
+
+class StatsCollector:
+    """
+    Collects cProfile stats of the current thread.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def report(self):
+        return format_profile(self.profile)
+
+
+class AllocationsCollector:
+    """
+    Compares the tracemalloc snapshots taken before and after.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.before = None
+        self.after = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started = True
+        self.before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        self.after = tracemalloc.take_snapshot()
+        if self.started:
+            tracemalloc.stop()
+
+    def report(self):
+        return format_allocations(self.before, self.after)
+
+
+def profile_call(function, memory=False):
+    """
+    Profiles the call of the function.
+    :param function: callable without arguments
+    :param memory: take tracemalloc snapshots instead of cProfile
+    :return: text of the report
+    """
+    collector = AllocationsCollector() if memory else StatsCollector()
+    collector.start()
+    try:
+        function()
+    finally:
+        collector.stop()
+    return collector.report()
+
+
+def profile_calendar(bot, chat_id, calendar_config):
+    """
+    Profiles the dry run of the calendar processing and sends the report.
+    Nothing is sent to the calendar channel and nothing is saved, see calbot.processing.dry_run_calendar().
+    :param bot: Bot instance to send the report
+    :param chat_id: chat to send the report to
+    :param calendar_config: CalendarConfig instance
+    :return: None
+    """
+    from calbot.processing import dry_run_calendar
+    result = []
+    try:
+        report = profile_call(lambda: result.append(dry_run_calendar(calendar_config)))
+    except Exception as e:
+        logger.warning('Failed to profile calendar %s of user %s',
+                       calendar_config.id, calendar_config.user_id, exc_info=True)
+        try:
+            bot.sendMessage(chat_id=chat_id, text='Failed to profile calendar %s:\n%s' % (calendar_config.id, e))
+        except Exception:
+            logger.error('Failed to send message to %s', chat_id, exc_info=True)
+        return
+    profile, messages = result[0]
+    summary = 'Dry run of calendar %s of user %s: %s, %s messages to send\n\n' % (
+        calendar_config.id, calendar_config.user_id, profile, messages)
+    send_report(bot, chat_id, 'cal%s' % calendar_config.id, summary + report)
+
+
+def format_profile(profile, limit=TOP_COUNT):
+    """
+    Formats the top functions of the profile.
+    :param profile: cProfile.Profile instance
+    :param limit: number of functions to print
+    :return: text
+    """
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+    stats.sort_stats('tottime').print_stats(limit)
+    return stream.getvalue()
+
+
+def format_allocations(before, after, limit=TOP_COUNT):
+    """
+    Formats the top allocation sites which grew between the snapshots.
+    :param before: tracemalloc.Snapshot taken first
+    :param after: tracemalloc.Snapshot taken last
+    :param limit: number of allocation sites to print
+    :return: text
+    """
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    differences = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    total = sum(stat.size for stat in after.filter_traces(filters).statistics('filename'))
+    lines = ['Traced memory: %s bytes' % total, 'Top allocation sites by growth:']
+    lines.extend(str(difference) for difference in differences[:limit])
+    return '\n'.join(lines) + '\n'
+
+
+def send_report(bot, chat_id, name, text):
+    """
+    Sends the report to the chat as a document.
+    :param bot: Bot instance
+    :param chat_id: chat to send to
+    :param name: name of the report, used in the filename
+    :param text: the report
+    :return: None
+    """
+    try:
+        bot.sendDocument(chat_id=chat_id, document=io.BytesIO(text.encode('UTF-8')),
+                         filename='profile-%s.txt' % name)
+    except Exception:
+        logger.error('Failed to send profile to %s', chat_id, exc_info=True)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Incremental expansion of the recurring events.
+
+The rule of a recurring event is expanded from its DTSTART, so a daily event started years ago
+costs thousands of iterations on every read just to reach today.
+The expansion cursor of the series remembers the last occurrence of the rule before the read window
+and the number of the occurrences before it.
+The next read moves DTSTART (and DTEND) of the series to the cursor and decreases its COUNT,
+so the rule is expanded from the cursor and gives the same occurrences in the window.
+
+The cursor is valid while the SEQUENCE and the content of the series are the same,
+otherwise the series is expanded from its original DTSTART and the cursor is recalculated.
+"""
+
+import hashlib
+import logging
+from datetime import datetime, date, timedelta
+
+from calbot.budget import ExpansionBudgetExceeded
+
+__all__ = ['Cursor', 'apply_cursors', 'format_start', 'parse_start']
+
+logger = logging.getLogger('recurrence')
+
+WINDOW_MARGIN = timedelta(days=1)
+"""the expansion starts from the beginning of the day of the window start, so the cursor is kept before it"""
+
+
+class Cursor:
+    """
+    Expansion cursor of the recurring series.
+    Holds only plain values, to be passed between processes.
+    """
+
+    def __init__(self, **kwargs):
+        self.sequence = kwargs.get('sequence', 0)
+        """SEQUENCE of the series when the cursor was calculated"""
+        self.digest = kwargs['digest']
+        """hash of the original content of the series"""
+        self.start = kwargs['start']
+        """start of the last occurrence before the window, date or naive local datetime"""
+        self.skipped = kwargs.get('skipped', 0)
+        """number of the occurrences of the rule before the start"""
+
+    def __eq__(self, other):
+        return isinstance(other, Cursor) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return 'Cursor(sequence=%s, digest=%s, start=%s, skipped=%s)' % (
+            self.sequence, self.digest, self.start, self.skipped)
+
+
+def apply_cursors(vcalendar, after, cursors, budget=None):
+    """
+    Moves the recurring series of the calendar to their cursors and calculates the new cursors.
+    Modifies VEVENT components of the calendar, call it before the expansion.
+    :param vcalendar: icalendar.Calendar
+    :param after: start of the read window, aware datetime
+    :param cursors: dict of known Cursor by the UID of the series
+    :param budget: calbot.budget.ExpansionBudget to count the iterated occurrences, can be None
+    :return: dict of the new Cursor by the UID
+    :raise ExpansionBudgetExceeded: if the iteration is over the budget
+    """
+    from recurring_ical_events import RepeatedEvent, compare_greater    # heavy, imported on first parse
+
+    masters = {}
+    for vevent in vcalendar.walk('VEVENT'):
+        if isinstance(vevent.get('RRULE'), dict) and 'RECURRENCE-ID' not in vevent and 'DTSTART' in vevent:
+            uid = str(vevent.get('UID'))
+            masters[uid] = None if uid in masters else vevent   # duplicated series are expanded fully
+
+    result = {}
+    for uid, vevent in masters.items():
+        if vevent is None:
+            continue
+        series = Series(vevent)
+        try:
+            cursor = cursors.get(uid)
+            threshold = after - WINDOW_MARGIN - series.duration()
+            if cursor is not None and cursor.sequence == series.sequence and cursor.digest == series.digest \
+                    and not compare_greater(series.localize(cursor.start), threshold):
+                series.move(cursor.start, cursor.skipped)
+            else:
+                cursor = Cursor(sequence=series.sequence, digest=series.digest, start=None)
+            start, skipped = cursor.start, cursor.skipped
+            for occurrence in RepeatedEvent(vevent).rrule or ():
+                if budget is not None:
+                    budget.tick()
+                if compare_greater(occurrence, threshold):
+                    break
+                start = occurrence
+                skipped += 1
+            if start is None:
+                continue    # the series is not started before the window
+            start = series.unlocalize(start)
+            skipped -= 1    # the occurrence at the cursor is not skipped
+            if start != cursor.start:
+                series.move(start, skipped)
+            result[uid] = Cursor(sequence=series.sequence, digest=series.digest, start=start, skipped=skipped)
+        except ExpansionBudgetExceeded:
+            series.restore()
+            raise
+        except Exception:
+            logger.warning('Failed to apply expansion cursor to %s, expanding it fully', uid, exc_info=True)
+            series.restore()
+    return result
+
+
+class Series:
+    """
+    Master VEVENT of the recurring series with its original start and end.
+    """
+
+    def __init__(self, vevent):
+        self.vevent = vevent
+        """VEVENT component"""
+        self.digest = hashlib.sha1(vevent.to_ical()).hexdigest()
+        """hash of the original content"""
+        self.sequence = int(vevent.get('SEQUENCE', 0))
+        """SEQUENCE of the series"""
+        self.original_start = vevent['DTSTART'].dt
+        """the original DTSTART"""
+        self.original_end = vevent['DTEND'].dt if 'DTEND' in vevent else None
+        """the original DTEND, None if it's not defined"""
+        rule = vevent['RRULE']
+        self.original_count = int(rule['COUNT'][0]) if 'COUNT' in rule else None
+        """the original COUNT of the rule, None if it's not defined"""
+
+    def duration(self):
+        if self.original_end is not None:
+            return self.original_end - self.original_start
+        if 'DURATION' in self.vevent:
+            return self.vevent['DURATION'].dt
+        return timedelta()
+
+    def localize(self, start):
+        """
+        Converts the cursor start to the type and timezone of DTSTART.
+        """
+        if not isinstance(self.original_start, datetime):
+            return start
+        tzinfo = self.original_start.tzinfo
+        if tzinfo is None:
+            return start
+        if hasattr(tzinfo, 'localize'):     # pytz
+            return tzinfo.localize(start)
+        return start.replace(tzinfo=tzinfo)
+
+    def unlocalize(self, occurrence):
+        """
+        Converts the occurrence of the rule to the cursor start: date or naive local datetime.
+        """
+        if not isinstance(self.original_start, datetime):
+            return occurrence.date() if isinstance(occurrence, datetime) else occurrence
+        return occurrence.replace(tzinfo=None)
+
+    def move(self, start, skipped):
+        """
+        Moves the series to start from the occurrence.
+        :param start: start of the occurrence, as in cursor
+        :param skipped: number of the occurrences of the rule before it
+        """
+        new_start = self.localize(start)
+        self.vevent['DTSTART'].dt = new_start
+        if self.original_end is not None:
+            self.vevent['DTEND'].dt = new_start + (self.original_end - self.original_start)
+        if self.original_count is not None:
+            self.vevent['RRULE']['COUNT'] = [self.original_count - skipped]
+
+    def restore(self):
+        """
+        Returns the series to the original start.
+        """
+        self.vevent['DTSTART'].dt = self.original_start
+        if self.original_end is not None:
+            self.vevent['DTEND'].dt = self.original_end
+        if self.original_count is not None:
+            self.vevent['RRULE']['COUNT'] = [self.original_count]
+
+
+def format_start(start):
+    """
+    Formats the cursor start to be persisted.
+    :param start: date or naive datetime
+    :return: string
+    """
+    return start.isoformat()
+
+
+def parse_start(value):
+    """
+    Parses the persisted cursor start.
+    :param value: string returned by format_start()
+    :return: date or naive datetime
+    """
+    if 'T' not in value:
+        return date(*map(int, value.split('-')))
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Processing of the calendars on the user's request, out of the regular passes.
+
+The requests are queued by the URL of the calendar. The request for the URL which is already queued
+joins the queued task, so all calendars of the URL are processed with one download.
+Each user can queue a limited number of the tasks per window, the joined requests are not counted.
+The refreshed calendar is read even if it's postponed after transient errors.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from calbot import ical
+from calbot.processing import update_calendar
+
+__all__ = ['Refresher', 'QUEUED', 'COALESCED', 'LIMITED']
+
+logger = logging.getLogger('refresh')
+
+QUEUED = 'queued'
+"""the calendar is queued to be processed"""
+
+COALESCED = 'coalesced'
+"""the calendar joined the already queued processing of the same URL"""
+
+LIMITED = 'limited'
+"""the user queued too many refreshes, the request is rejected"""
+
+
+class Refresher:
+    """
+    Runs the requested refreshes in the thread pool with the per-user rate limit.
+    """
+
+    def __init__(self, config, workers, limit, window=3600, wheel=None):
+        self.config = config
+        """main config"""
+        self.limit = limit
+        """maximum number of the refreshes queued by one user in the window, 0 for no limit"""
+        self.window = window
+        """the window of the rate limit, in seconds"""
+        self.wheel = wheel
+        """NotificationWheel to schedule future notifications, can be None"""
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        """the pool to run the refreshes, and the profiling of the calendars requested by the admins"""
+        self.pending = OrderedDict()
+        """the calendars waiting for the refresh: dict of Bot by (user_id, calendar_id), by the URL"""
+        self.requests = defaultdict(deque)
+        """times of the queued refreshes by the user id"""
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def submit(self, bot, calendar, now=None):
+        """
+        Queues the calendar for the refresh.
+        :param bot: Bot instance to send the messages
+        :param calendar: CalendarConfig instance
+        :param now: unix time, current by default
+        :return: QUEUED, COALESCED or LIMITED
+        """
+        now = time.time() if now is None else now
+        key = (calendar.user_id, calendar.id)
+        with self.lock:
+            task = self.pending.get(calendar.url)
+            if task is not None:
+                task.setdefault(key, bot)
+                logger.info('Refresh of calendar %s of user %s joined the queued refresh of %s',
+                            calendar.id, calendar.user_id, calendar.url)
+                return COALESCED
+            requests = self.requests[calendar.user_id]
+            while requests and requests[0] <= now - self.window:
+                requests.popleft()
+            if self.limit and len(requests) >= self.limit:
+                logger.info('Refresh of calendar %s of user %s is rejected after %s refreshes',
+                            calendar.id, calendar.user_id, len(requests))
+                return LIMITED
+            requests.append(now)
+            self.pending[calendar.url] = OrderedDict([(key, bot)])
+        self.executor.submit(self._run, calendar.url)
+        return QUEUED
+
+    def stop(self):
+        """
+        Waits for the running refreshes and stops the pool.
+        :return: None
+        """
+        self.executor.shutdown(wait=True)
+
+    def _run(self, url):
+        with self.lock:
+            task = self.pending.pop(url)    # the next requests queue the new download
+        lookahead = timedelta(seconds=self.config.interval) if self.wheel is not None else None
+        with ical.shared_downloads():
+            for (user_id, calendar_id), bot in task.items():
+                try:
+                    # reloaded, the calendar can be changed or deleted while it was waiting
+                    calendar = self.config.load_calendar(user_id, calendar_id)
+                except KeyError:
+                    continue
+                try:
+                    update_calendar(bot, calendar, self.wheel, lookahead, force=True)    # even if postponed
+                except Exception:
+                    logger.error('Failed to refresh calendar %s of user %s', calendar_id, user_id, exc_info=True)
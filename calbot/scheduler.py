@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Resuming of the processing schedule after the restart.
+
+The time of the next pass of all calendars is persisted in `var/scheduler.cfg`,
+the time of the last processing of each calendar is persisted in its `calendars.cfg`
+and in the global index of calendars, which tells which calendars are overdue,
+the pending notifications are persisted by the NotificationWheel.
+After the restart the next pass starts when it was planned before the restart.
+Calendars which are overdue, i.e. were not processed for the interval, or their retry time has come,
+are processed one by one, spread over the warm-up window, instead of all at once.
+"""
+
+import logging
+import os
+from datetime import datetime
+
+from calbot.calindex import read_index
+from calbot.conf import ConfigFile
+
+__all__ = ['save_next_pass', 'first_pass_delay', 'plan_warmup']
+
+logger = logging.getLogger('scheduler')
+
+
+def save_next_pass(config, next_pass_at):
+    """
+    Persists the time of the next pass of all calendars.
+    :param config: main config
+    :param next_pass_at: naive UTC datetime
+    :return: None
+    """
+    config_file = SchedulerConfigFile(config.vardir)
+    parser = config_file.read_parser()
+    if not parser.has_section('scheduler'):
+        parser.add_section('scheduler')
+    parser.set('scheduler', 'next_pass_at', next_pass_at.isoformat())
+    config_file.write(parser)
+
+
+def load_next_pass(config):
+    """
+    Reads the time of the next pass of all calendars.
+    :param config: main config
+    :return: naive UTC datetime or None if no pass was run yet
+    """
+    parser = SchedulerConfigFile(config.vardir).read_parser()
+    value = parser.get('scheduler', 'next_pass_at', fallback=None)
+    return _parse(value) if value else None
+
+
+def first_pass_delay(config, now=None):
+    """
+    Returns the delay of the first pass of all calendars after the start.
+    :param config: main config
+    :param now: current naive UTC datetime
+    :return: seconds to wait, it's the interval if the planned pass is overdue or unknown,
+        the overdue calendars are processed in the warm-up
+    """
+    now = now or datetime.utcnow()
+    next_pass_at = load_next_pass(config)
+    if next_pass_at is None or next_pass_at <= now:
+        return config.interval
+    return min((next_pass_at - now).total_seconds(), config.interval)
+
+
+def plan_warmup(config, now=None):
+    """
+    Selects the overdue calendars and spreads their processing over the warm-up window.
+    The calendars overdue the most are processed first.
+    :param config: main config
+    :param now: current naive UTC datetime
+    :return: list of (delay in seconds, CalendarConfig), events of the calendars are not loaded
+    """
+    now = now or datetime.utcnow()
+    entries = [entry for entry in read_index(config)
+               if entry.enabled and (entry.next_due is None or entry.next_due <= now)]
+    due_at = dict((entry.key, entry.next_due or datetime.min) for entry in entries)
+    overdue = [(due_at[(calendar.user_id, calendar.id)], calendar)
+               for calendar in config.indexed_calendars(entries) if calendar.enabled]
+    overdue.sort(key=lambda item: item[0])
+    window = min(config.warmup, config.interval)
+    step = window / len(overdue) if overdue else 0
+    logger.info('%s calendars are overdue, processing them in %s seconds', len(overdue), window)
+    return [(index * step, calendar) for index, (_, calendar) in enumerate(overdue)]
+
+
+def _parse(value):
+    from dateutil.parser import parse   # imported on first use, it's slow to import
+    return parse(value)
+
+
+class SchedulerConfigFile(ConfigFile):
+    """
+    Reads and writes scheduler state file.
+    """
+
+    def __init__(self, vardir):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        """
+        super().__init__(os.path.join(vardir, 'scheduler.cfg'))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Processing of the calendars which are heavy to expand, apart from the others.
+
+The pass of all calendars only queues the slow calendars, see CalendarConfig.slow,
+they are processed one by one in the background thread, so they don't delay the other calendars.
+Their ical files are parsed in the separate process with the lower priority.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from calbot import ical
+from calbot.processing import update_calendar
+
+__all__ = ['SlowLane']
+
+logger = logging.getLogger('slowlane')
+
+
+class SlowLane:
+    """
+    Runs the slow calendars in the single background thread.
+    """
+
+    def __init__(self, config, wheel=None, breaker=None):
+        self.config = config
+        """main config"""
+        self.wheel = wheel
+        """NotificationWheel to schedule future notifications, can be None"""
+        self.breaker = breaker
+        """CircuitBreaker to skip failing hosts, can be None"""
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        """the thread to process the calendars"""
+        self.queued = set()
+        """(user_id, calendar_id) of the queued and running calendars"""
+        self.lock = threading.Lock()
+        ical.start_slow_parse_pool(config.parse_tasks_per_worker)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queued)
+
+    def submit(self, bot, calendar):
+        """
+        Queues the calendar, if it's not queued yet.
+        :param bot: Bot instance
+        :param calendar: CalendarConfig instance
+        :return: None
+        """
+        key = (calendar.user_id, calendar.id)
+        with self.lock:
+            if key in self.queued:
+                logger.info('Slow calendar %s of user %s is still in the lane', calendar.id, calendar.user_id)
+                return
+            self.queued.add(key)
+        self.executor.submit(self._run, bot, calendar)
+
+    def stop(self):
+        """
+        Waits for the running calendar and stops the lane.
+        :return: None
+        """
+        self.executor.shutdown(wait=True)
+        ical.stop_slow_parse_pool()
+
+    def _run(self, bot, calendar):
+        try:
+            try:
+                # reloaded, the calendar can be changed or deleted while it was waiting
+                calendar = self.config.load_calendar(calendar.user_id, calendar.id)
+            except KeyError:
+                return
+            update_calendar(bot, calendar, self.wheel, timedelta(seconds=self.config.interval), self.breaker)
+        except Exception:
+            logger.error('Failed to process slow calendar %s of user %s', calendar.id, calendar.user_id, exc_info=True)
+        finally:
+            with self.lock:
+                self.queued.discard((calendar.user_id, calendar.id))
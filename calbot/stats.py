@@ -22,7 +22,11 @@ import datetime
 import logging
 from configparser import ConfigParser
 
+from calbot import metrics
+from calbot.calindex import read_index
 from calbot.conf import ConfigFile
+from calbot.dedup import CHANNELS_DIR
+from calbot.outbox import OUTBOXES_DIR
 
 
 __all__ = ['update_stats', 'get_stats']
@@ -34,7 +38,13 @@ Active calendars: {}
 Disabled calendars: {}
 Notified events: {}
 Last calendars processed:
-{} - {}"""
+{} - {}
+Heaviest calendars:
+{}"""
+
+HEAVIEST_COUNT = 5
+
+CALENDAR_STATES = ('ok', 'unverified', 'failing', 'postponed', 'disabled')
 
 
 def update_stats(config):
@@ -48,39 +58,82 @@ def update_stats(config):
         parser = ConfigParser(interpolation=None)
         parser.add_section('stats')
 
-        users = 0
         calendars = 0
-        disabled_calendars = 0
         events = 0
         last_process_min = datetime.datetime.utcnow().isoformat()
         last_process_max = datetime.datetime.utcfromtimestamp(0).isoformat()
-
-        for name in os.listdir(config.vardir):
-            if os.path.isdir(os.path.join(config.vardir, name)):
-                users += 1
-                user_id = name
-                for calendar in config.load_calendars(user_id):
-                    if calendar.enabled:
-                        calendars += 1
-                        last_process_min = min(calendar.last_process_at or last_process_min, last_process_min)
-                        last_process_max = max(calendar.last_process_at or last_process_max, last_process_max)
-                        calendar.load_events()
-                        events += len(calendar.events)
-                    else:
-                        disabled_calendars += 1
-
-        parser.set('stats', 'users', str(users))
+        heaviest = []
+        states = dict((state, 0) for state in CALENDAR_STATES)
+
+        entries = read_index(config)
+        disabled_calendars = sum(1 for entry in entries if not entry.enabled)
+        states['disabled'] = disabled_calendars
+
+        # disabled calendars are counted by the index, only the enabled are read
+        for calendar in config.indexed_calendars(entry for entry in entries if entry.enabled):
+            states[calendar_state(calendar)] += 1
+            if calendar.enabled:
+                calendars += 1
+                last_process_min = min(calendar.last_process_at or last_process_min, last_process_min)
+                last_process_max = max(calendar.last_process_at or last_process_max, last_process_max)
+                events += calendar.events_count()
+                if calendar.profile is not None:
+                    heaviest.append((calendar.profile.total, calendar.profile.bytes,
+                                     calendar.user_id, calendar.id))
+
+        for state, count in states.items():
+            metrics.CALENDARS.set(count, state=state)
+
+        parser.set('stats', 'users', str(count_users(config)))
         parser.set('stats', 'calendars', str(calendars))
         parser.set('stats', 'disabled_calendars', str(disabled_calendars))
         parser.set('stats', 'events', str(events))
         parser.set('stats', 'last_process_min', last_process_min)
         parser.set('stats', 'last_process_max', last_process_max)
 
+        parser.add_section('heaviest')
+        heaviest.sort(reverse=True)
+        for index, (total, size, user_id, calendar_id) in enumerate(heaviest[:HEAVIEST_COUNT]):
+            parser.set('heaviest', str(index), '%s %s %.6f %s' % (user_id, calendar_id, total, size))
+
         config_file.write(parser)
     except Exception as e:
         logger.warning('Failed to update stats', exc_info=True)
 
 
+def count_users(config):
+    """
+    Counts the users directories in var, including the users without calendars, which are not in the index.
+    :param config: Main config object
+    :return: int
+    """
+    service_dirs = set(os.path.abspath(path) for path in (os.path.join(config.vardir, CHANNELS_DIR),
+                                                          os.path.join(config.vardir, OUTBOXES_DIR),
+                                                          config.feeds_dir))
+    if not os.path.isdir(config.vardir):
+        return 0
+    with os.scandir(config.vardir) as entries:
+        return sum(1 for entry in entries
+                   if entry.is_dir() and os.path.abspath(entry.path) not in service_dirs)
+
+
+def calendar_state(calendar):
+    """
+    Returns the state of the calendar for the metrics.
+    :param calendar: CalendarConfig instance
+    :return: one of CALENDAR_STATES
+    """
+    if not calendar.enabled:
+        return 'disabled'
+    if not calendar.verified:
+        return 'unverified'
+    if calendar.next_attempt_at is not None:
+        return 'postponed'
+    if calendar.last_errors_count > 0:
+        return 'failing'
+    return 'ok'
+
+
 def get_stats(config):
     """
     Reads stats object from the stats.cfg file
@@ -109,6 +162,8 @@ class Stats:
         """Timestamp of the calendar processed, min value"""
         self.last_process_max = kwargs['last_process_max']
         """Timestamp of the calendar processed, max value"""
+        self.heaviest = kwargs.get('heaviest', [])
+        """List of (user_id, calendar_id, seconds, bytes) of the calendars with the longest processing"""
 
     @classmethod
     def load(cls, stats_config):
@@ -116,13 +171,19 @@ class Stats:
         Loads stats from the stats.cfg file
         """
         parser = stats_config.read_parser()
+        heaviest = []
+        if parser.has_section('heaviest'):
+            for _, value in sorted(parser.items('heaviest'), key=lambda item: int(item[0])):
+                user_id, calendar_id, total, size = value.split()
+                heaviest.append((user_id, calendar_id, float(total), int(size)))
         return cls(
             users=parser.getint('stats', 'users', fallback=0),
             calendars=parser.getint('stats', 'calendars', fallback=0),
             disabled_calendars=parser.getint('stats', 'disabled_calendars', fallback=0),
             events=parser.getint('stats', 'events', fallback=0),
             last_process_min=parser.get('stats', 'last_process_min', fallback=None),
-            last_process_max=parser.get('stats', 'last_process_max', fallback=None)
+            last_process_max=parser.get('stats', 'last_process_max', fallback=None),
+            heaviest=heaviest
         )
 
     def __str__(self):
@@ -131,7 +192,9 @@ class Stats:
                                            self.disabled_calendars,
                                            self.events,
                                            self.last_process_min,
-                                           self.last_process_max)
+                                           self.last_process_max,
+                                           '\n'.join('%s/cal%s - %.3f s - %s bytes' % calendar
+                                                     for calendar in self.heaviest) or 'None')
 
 
 class StatsConfigFile(ConfigFile):
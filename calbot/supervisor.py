@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Supervisor mode: calendars are processed by several worker processes.
+
+The main process keeps the Telegram polling or webhook, the worker processes read and process calendars.
+Each worker owns a shard of users, selected by a stable hash of the user id.
+The workers do not talk to Telegram, they send the messages to the main process and wait for the result.
+
+The number of shards is sent to the workers with every pass, and the passes never overlap,
+so a user is never processed by two workers at once, even when the number of workers is changed.
+The current number of shards is persisted in `var/supervisor.cfg`.
+"""
+
+import logging
+import os
+import threading
+import time
+import zlib
+import multiprocessing
+
+from calbot import metrics
+from calbot.calindex import read_index
+from calbot.conf import ConfigFile
+
+__all__ = ['Supervisor', 'shard_of']
+
+logger = logging.getLogger('supervisor')
+
+STOP_TIMEOUT = 60
+"""seconds to wait for the workers to finish their passes on stop, the hung workers are terminated after it"""
+
+
+def shard_of(user_id, shards):
+    """
+    Returns the shard of the user.
+    :param user_id: ID of the user, as string
+    :param shards: total number of shards
+    :return: shard index, from 0 to shards - 1
+    """
+    return zlib.crc32(user_id.encode('UTF-8')) % shards
+
+
+def shard_calendars(config, shard, shards):
+    """
+    Returns calendars of the users of the shard, events are loaded by update_calendar()
+    :param config: main config
+    :param shard: index of the shard
+    :param shards: total number of shards
+    :return: yields CalendarConfig instances
+    """
+    entries = (entry for entry in read_index(config) if entry.enabled and shard_of(entry.user_id, shards) == shard)
+    for calendar in config.indexed_calendars(entries):
+        yield calendar
+
+
+class Supervisor:
+    """
+    Starts the worker processes and runs the passes of calendars processing on them.
+    """
+
+    def __init__(self, config, workers):
+        self.config = config
+        """main config"""
+        self.shards = workers
+        """number of workers and shards"""
+        self.context = multiprocessing.get_context('spawn')
+        """multiprocessing context, workers must not inherit the threads of the bot"""
+        self.requests = self.context.Queue()
+        """queue of the messages from the workers to the main process"""
+        self.workers = []
+        """list of WorkerHandle"""
+        self.bot = None
+        """Bot to send messages requested by the workers"""
+        self.pass_id = 0
+        """ID of the current pass"""
+        self.done = {}
+        """results of the current pass, by the worker index"""
+        self.condition = threading.Condition()
+        """notified when a worker completes the pass"""
+
+    def start(self, bot):
+        """
+        Starts the workers and the thread which serves their requests.
+        :param bot: Bot instance
+        :return: None
+        """
+        self.bot = bot
+        self._save_shards()
+        for index in range(self.shards):
+            self.workers.append(self._start_worker(index))
+        thread = threading.Thread(target=self._serve, name='supervisor', daemon=True)
+        thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Stops the workers, terminates the workers which don't stop in time.
+        :param timeout: seconds to wait for all workers
+        :return: None
+        """
+        for worker in self.workers:
+            worker.tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for index, worker in enumerate(self.workers):
+            worker.process.join(max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                logger.warning('Worker %s did not stop in %s seconds, terminating', index, timeout)
+                worker.process.terminate()
+                worker.process.join()
+        self.requests.put(None)
+
+    def run_pass(self):
+        """
+        Runs the processing of all calendars on the workers and waits for its completion.
+        :return: list of (user_id, calendar_id) of processed calendars
+        """
+        with self.condition:
+            self.pass_id += 1
+            self.done = {}
+            for index, worker in enumerate(self.workers):
+                if not worker.process.is_alive():
+                    logger.warning('Worker %s is dead, restarting', index)
+                    self.workers[index] = worker = self._start_worker(index)
+                worker.tasks.put((self.pass_id, self.shards))
+            while len(self.done) < len(self.workers):
+                self.condition.wait(timeout=60)
+                for index, worker in enumerate(self.workers):
+                    if index not in self.done and not worker.process.is_alive():
+                        logger.error('Worker %s died during pass %s', index, self.pass_id)
+                        self.done[index] = []
+        return [calendar for calendars in self.done.values() for calendar in calendars]
+
+    def _start_worker(self, index):
+        tasks = self.context.Queue()
+        replies = self.context.Queue()
+        process = self.context.Process(target=run_worker, name='calbot-worker-%s' % index,
+                                       args=(self.config, index, tasks, self.requests, replies),
+                                       daemon=True)
+        process.start()
+        logger.info('Started worker %s, pid %s', index, process.pid)
+        return WorkerHandle(process, tasks, replies)
+
+    def _serve(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            kind, index = request[0], request[1]
+            if kind == 'send':
+                _, _, request_id, kwargs = request
+                try:
+                    with metrics.measure_send():
+                        self.bot.sendMessage(**kwargs)
+                    result = None
+                except Exception as e:
+                    result = str(e) or e.__class__.__name__
+                self.workers[index].replies.put((request_id, result))
+            elif kind == 'done':
+                _, _, pass_id, calendars = request
+                with self.condition:
+                    if pass_id == self.pass_id:
+                        self.done[index] = calendars
+                        self.condition.notify_all()
+
+    def _save_shards(self):
+        config_file = SupervisorConfigFile(self.config.vardir)
+        parser = config_file.read_parser()
+        previous = parser.getint('supervisor', 'shards', fallback=None)
+        if previous is not None and previous != self.shards:
+            logger.info('Rebalancing users from %s to %s shards', previous, self.shards)
+        if not parser.has_section('supervisor'):
+            parser.add_section('supervisor')
+        parser.set('supervisor', 'shards', str(self.shards))
+        config_file.write(parser)
+
+
+class WorkerHandle:
+    """
+    The worker process as it is seen by the supervisor.
+    """
+
+    def __init__(self, process, tasks, replies):
+        self.process = process
+        """the process"""
+        self.tasks = tasks
+        """queue of passes to run by the worker"""
+        self.replies = replies
+        """queue of the results of the worker's requests"""
+
+
+class WorkerBot:
+    """
+    Replacement of the Bot in the worker process. Forwards the messages to the supervisor.
+    """
+
+    def __init__(self, index, requests, replies):
+        self.index = index
+        self.requests = requests
+        self.replies = replies
+        self.request_id = 0
+
+    def sendMessage(self, **kwargs):
+        self.request_id += 1
+        self.requests.put(('send', self.index, self.request_id, kwargs))
+        while True:
+            request_id, error = self.replies.get()
+            if request_id == self.request_id:
+                break
+        if error is not None:
+            raise WorkerSendError(error)
+
+
+class WorkerSendError(Exception):
+    """
+    Failure to send the message, as it was reported by the supervisor.
+    """
+    pass
+
+
+def run_worker(config, index, tasks, requests, replies):
+    """
+    The worker process main loop.
+    Processes calendars of the shard on each pass received from the supervisor.
+    :param config: main config
+    :param index: index of the worker, it's the shard it owns
+    :param tasks: queue of (pass_id, shards) tuples, None to stop
+    :param requests: queue of the messages to the supervisor
+    :param replies: queue of the replies from the supervisor
+    :return: None
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    from calbot import dedup, ical
+    from calbot.backoff import CircuitBreaker
+    from calbot.locks import configure_locks
+    from calbot.outbox import configure_outbox
+    from calbot.processing import update_calendar
+    from calbot.wheel import NotificationWheel
+    from datetime import timedelta
+
+    configure_locks(config.file_locks)
+    configure_outbox(config.outbox_max_attempts, config.outbox_retry_interval)
+    ical.configure_expansion_budget(config.expansion_cpu_time, config.expansion_occurrences)
+    if config.parse_workers > 0:
+        ical.start_parse_pool(config.parse_workers, config.parse_tasks_per_worker)
+    if config.feeds_mode in ('record', 'replay'):
+        ical.start_feed_store(config.feeds_dir, config.feeds_max_size, replay=(config.feeds_mode == 'replay'))
+    if config.dedup_window > 0:
+        dedup.start_channel_dedup(config.vardir, config.dedup_window)
+
+    bot = WorkerBot(index, requests, replies)
+    wheel = NotificationWheel(config) if config.notify_tick > 0 else None
+    lookahead = timedelta(seconds=config.interval)
+    breaker = CircuitBreaker(config.circuit_failures, config.circuit_cooldown)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        pass_id, shards = task
+        calendars = []
+        try:
+            for calendar in shard_calendars(config, index, shards):
+                update_calendar(bot, calendar, wheel, lookahead, breaker)
+                if wheel is not None:
+                    wheel.remove_calendar(calendar.user_id, calendar.id)    # kept in schedule.cfg
+                calendars.append((calendar.user_id, calendar.id))
+        except Exception:
+            logger.error('Worker %s failed pass %s', index, pass_id, exc_info=True)
+        requests.put(('done', index, pass_id, calendars))
+
+    ical.stop_parse_pool()
+    ical.stop_feed_store()
+    dedup.stop_channel_dedup()
+
+
+class SupervisorConfigFile(ConfigFile):
+    """
+    Reads and writes supervisor config file.
+    """
+
+    def __init__(self, vardir):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        """
+        super().__init__(os.path.join(vardir, 'supervisor.cfg'))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+import time
+from contextlib import contextmanager
+
+__all__ = ['ProcessingProfile']
+
+
+class ProcessingProfile:
+    """
+    Cost of the last processing of the calendar: time of each phase and size of the data.
+    """
+
+    PHASES = ('connect', 'download', 'parse', 'expand', 'filter', 'format', 'send', 'persist')
+    """processing phases, in order of their execution"""
+
+    def __init__(self, **kwargs):
+        self.timings = dict((phase, kwargs.get(phase, 0.0)) for phase in self.PHASES)
+        """seconds spent in each phase"""
+        self.bytes = kwargs.get('bytes', 0)
+        """size of the downloaded ical file"""
+        self.vevents = kwargs.get('vevents', 0)
+        """number of VEVENT components in the ical file"""
+        self.occurrences = kwargs.get('occurrences', 0)
+        """number of events, including repetitions, expanded in the processing window"""
+        self.budget = kwargs.get('budget', 0.0)
+        """part of the expansion budget used, see calbot.budget"""
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures the time of the block and adds it to the phase.
+        :param name: name of the phase
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.perf_counter() - started
+
+    @property
+    def total(self):
+        """
+        Total time of all phases, in seconds
+        """
+        return sum(self.timings.values())
+
+    @classmethod
+    def load(cls, config_parser, section):
+        """
+        Reads the profile from the calendars.cfg section.
+        :param config_parser: ConfigParser which read calendars.cfg file
+        :param section: the section of the calendar
+        :return: ProcessingProfile instance or None if the calendar was not processed yet
+        """
+        if not config_parser.has_option(section, 'profile_bytes'):
+            return None
+        kwargs = dict((phase, config_parser.getfloat(section, 'profile_%s' % phase, fallback=0.0))
+                      for phase in cls.PHASES)
+        return cls(
+            bytes=config_parser.getint(section, 'profile_bytes', fallback=0),
+            vevents=config_parser.getint(section, 'profile_vevents', fallback=0),
+            occurrences=config_parser.getint(section, 'profile_occurrences', fallback=0),
+            budget=config_parser.getfloat(section, 'profile_budget', fallback=0.0),
+            **kwargs
+        )
+
+    def save(self, config_parser, section):
+        """
+        Writes the profile to the calendars.cfg section.
+        :param config_parser: ConfigParser which read calendars.cfg file
+        :param section: the section of the calendar
+        :return: None
+        """
+        for phase in self.PHASES:
+            config_parser.set(section, 'profile_%s' % phase, '%.6f' % self.timings[phase])
+        config_parser.set(section, 'profile_bytes', str(self.bytes))
+        config_parser.set(section, 'profile_vevents', str(self.vevents))
+        config_parser.set(section, 'profile_occurrences', str(self.occurrences))
+        config_parser.set(section, 'profile_budget', '%.3f' % self.budget)
+
+    def __str__(self):
+        return '%.3f s (%s), %s bytes, %s VEVENTs, %s occurrences' % (
+            self.total,
+            ', '.join('%s %.3f' % (phase, self.timings[phase]) for phase in self.PHASES),
+            self.bytes, self.vevents, self.occurrences)
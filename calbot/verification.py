@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Verification of new and changed calendars in the background.
+
+The command handlers only queue the calendar, so a slow feed doesn't block the dispatcher for other users.
+Each user can have a limited number of verifications running at once, the rest wait in the user's queue.
+"""
+
+import logging
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from calbot.processing import update_calendar
+
+__all__ = ['Verifier']
+
+logger = logging.getLogger('verification')
+
+
+class Verifier:
+    """
+    Runs the verifications in the thread pool with the per-user concurrency limit.
+    """
+
+    def __init__(self, config, workers, per_user):
+        self.config = config
+        """main config"""
+        self.per_user = per_user
+        """maximum number of the verifications of one user running at once"""
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        """the pool to run the verifications"""
+        self.running = defaultdict(int)
+        """number of the running verifications by the user id"""
+        self.pending = defaultdict(deque)
+        """queues of (bot, CalendarConfig) waiting for the run, by the user id"""
+        self.lock = threading.Lock()
+
+    def submit(self, bot, calendar):
+        """
+        Queues the calendar for verification.
+        :param bot: Bot instance to send the verification messages
+        :param calendar: CalendarConfig instance
+        :return: None
+        """
+        with self.lock:
+            if self.running[calendar.user_id] >= self.per_user:
+                self.pending[calendar.user_id].append((bot, calendar))
+                logger.info('Verification of calendar %s of user %s is waiting for %s running',
+                            calendar.id, calendar.user_id, self.running[calendar.user_id])
+                return
+            self.running[calendar.user_id] += 1
+        self.executor.submit(self._run, bot, calendar)
+
+    def stop(self):
+        """
+        Waits for the running verifications and stops the pool.
+        :return: None
+        """
+        self.executor.shutdown(wait=True)
+
+    def _run(self, bot, calendar):
+        while calendar is not None:
+            try:
+                self._verify(bot, calendar)
+            except Exception:
+                logger.error('Failed to verify calendar %s of user %s', calendar.id, calendar.user_id, exc_info=True)
+            with self.lock:
+                pending = self.pending[calendar.user_id]
+                if pending:
+                    bot, next_calendar = pending.popleft()
+                else:
+                    self.running[calendar.user_id] -= 1
+                    del self.pending[calendar.user_id]
+                    if self.running[calendar.user_id] <= 0:
+                        del self.running[calendar.user_id]
+                    next_calendar = None
+            calendar = next_calendar
+
+    def _verify(self, bot, calendar):
+        try:
+            # reloaded, the calendar can be changed or deleted while it was waiting
+            calendar = self.config.load_calendar(calendar.user_id, calendar.id)
+        except KeyError:
+            return
+        update_calendar(bot, calendar)
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Future notification moments of the calendar events.
+
+Each calendar read computes `notify_datetime - advance` for every event and every configured advance.
+The moments are kept in the hierarchical timing wheel, so the due notifications can be sent
+at the right minute between the calendar reads.
+The moments and the events data are also persisted into `schedule.cfg` file of the calendar,
+so the wheel is restored after the bot restart.
+
+```
+var/
+    user1_chat_id/
+        calendar1_id/
+            events.cfg
+            schedule.cfg - the events to be notified in the future
+```
+"""
+
+import logging
+import os
+import threading
+from collections import defaultdict
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+
+import pytz
+from dateutil.parser import parse
+
+from calbot.conf import ConfigFile
+from calbot.ical import Event
+
+__all__ = ['TimingWheel', 'NotificationWheel']
+
+logger = logging.getLogger('wheel')
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel of the moments, with one minute precision.
+    The first level has a slot per minute of the current hour,
+    the second level has a slot per hour of the current day,
+    the third level has a slot per day.
+    Moments which are too far in the future wait in the overflow list.
+    Slots of the higher level are cascaded to the lower level when the wheel time reaches them.
+    """
+
+    LEVELS = ((60, 1), (24, 60), (64, 1440))
+    """(number of slots, minutes per slot) of each level"""
+
+    def __init__(self, now=None):
+        self.current = _minute(now or datetime.now(tz=pytz.UTC))
+        """current wheel time, in minutes since the epoch"""
+        self.levels = [[[] for _ in range(slots)] for slots, _ in self.LEVELS]
+        """slots of each level, each slot is a list of entries"""
+        self.overflow = []
+        """entries which are too far in the future for the levels"""
+        self.due = []
+        """entries which are already due"""
+        self.entries = {}
+        """actual entries by their key, removed entries stay in slots until the wheel reaches them"""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, moment, value):
+        """
+        Adds the entry to the wheel. Replaces the entry with the same key.
+        :param key: unique key of the entry
+        :param moment: datetime when the entry becomes due
+        :param value: any value associated with the entry
+        :return: None
+        """
+        entry = WheelEntry(key, _minute(moment), value)
+        self.entries[key] = entry
+        self._place(entry)
+
+    def remove(self, key):
+        """
+        Removes the entry from the wheel.
+        :param key: key of the entry
+        :return: None
+        """
+        self.entries.pop(key, None)
+
+    def pop_due(self, now=None):
+        """
+        Moves the wheel to the specified moment and removes all entries which are due.
+        :param now: current datetime
+        :return: list of values of the due entries, ordered by their moments
+        """
+        target = _minute(now or datetime.now(tz=pytz.UTC))
+        if target - self.current >= self.LEVELS[1][0] * self.LEVELS[1][1]:
+            self._rebuild(target)
+        while self.current < target:
+            self._tick()
+
+        due = [entry for entry in self.due if self.entries.get(entry.key) is entry]
+        self.due = []
+        for entry in due:
+            del self.entries[entry.key]
+        due.sort(key=lambda e: e.minute)
+        return [entry.value for entry in due]
+
+    def _tick(self):
+        self.current += 1
+        minute = self.current
+        if minute % 1440 == 0:
+            day_slot = self.levels[2][(minute // 1440) % self.LEVELS[2][0]]
+            self.levels[2][(minute // 1440) % self.LEVELS[2][0]] = []
+            overflow = self.overflow
+            self.overflow = []
+            for entry in day_slot + overflow:
+                self._place(entry)
+        if minute % 60 == 0:
+            hour_slot = self.levels[1][(minute // 60) % self.LEVELS[1][0]]
+            self.levels[1][(minute // 60) % self.LEVELS[1][0]] = []
+            for entry in hour_slot:
+                self._place(entry)
+        minute_slot = self.levels[0][minute % self.LEVELS[0][0]]
+        self.levels[0][minute % self.LEVELS[0][0]] = []
+        self.due.extend(minute_slot)
+
+    def _place(self, entry):
+        if self.entries.get(entry.key) is not entry:
+            return      # removed or replaced
+        if entry.minute <= self.current:
+            self.due.append(entry)
+        elif entry.minute - self.current < self.LEVELS[0][0]:
+            self.levels[0][entry.minute % self.LEVELS[0][0]].append(entry)
+        elif entry.minute // 60 - self.current // 60 < self.LEVELS[1][0]:
+            self.levels[1][(entry.minute // 60) % self.LEVELS[1][0]].append(entry)
+        elif entry.minute // 1440 - self.current // 1440 < self.LEVELS[2][0]:
+            self.levels[2][(entry.minute // 1440) % self.LEVELS[2][0]].append(entry)
+        else:
+            self.overflow.append(entry)
+
+    def _rebuild(self, target):
+        self.current = target
+        self.levels = [[[] for _ in range(slots)] for slots, _ in self.LEVELS]
+        self.overflow = []
+        self.due = []
+        for entry in list(self.entries.values()):
+            self._place(entry)
+
+
+class WheelEntry:
+    """
+    Entry of the timing wheel.
+    """
+
+    def __init__(self, key, minute, value):
+        self.key = key
+        """unique key of the entry"""
+        self.minute = minute
+        """moment when the entry is due, in minutes since the epoch"""
+        self.value = value
+        """value associated with the entry"""
+
+
+class NotificationWheel:
+    """
+    Timing wheel of the future notifications of all calendars, backed by schedule.cfg files.
+    Calendars can be scheduled from several threads, like the slow lane.
+    """
+
+    def __init__(self, config, now=None):
+        self.config = config
+        """main config"""
+        self.wheel = TimingWheel(now)
+        """the timing wheel with NotifyMoment values"""
+        self.calendars = defaultdict(set)
+        """keys of the wheel entries by (user_id, calendar_id)"""
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def restore(self):
+        """
+        Reads schedule.cfg files of all enabled calendars and fills the wheel.
+        :return: None
+        """
+        for calendar in self.config.all_calendars(enabled=True):
+            try:
+                self.restore_calendar(calendar)
+            except Exception:
+                logger.warning('Failed to restore notifications of calendar %s of user %s',
+                               calendar.id, calendar.user_id, exc_info=True)
+        logger.info('Restored %s notification moments', len(self))
+
+    def restore_calendar(self, calendar_config):
+        """
+        Reads schedule.cfg file of the calendar and puts its moments to the wheel.
+        Moments which were passed while the bot was stopped become due immediately.
+        :param calendar_config: CalendarConfig instance
+        :return: None
+        """
+        config_file = ScheduleConfigFile(calendar_config.vardir, calendar_config.user_id, calendar_config.id)
+        parser = config_file.read_parser()
+        with self.lock:
+            for event_id in parser.sections():
+                event = read_event(parser, event_id)
+                advances = map(int, parser.get(event_id, 'advances', fallback='').split())
+                for advance in advances:
+                    self._add(calendar_config, event, advance)
+
+    def schedule_calendar(self, calendar_config, events, now=None):
+        """
+        Replaces the moments of the calendar in the wheel and persists them.
+        Skips the moments which are in the past.
+        The notified events are not looked up: the moment in the future can't be notified yet,
+        the notified events are skipped when their moments are due, see calbot.processing.notify_due_events().
+        :param calendar_config: CalendarConfig instance
+        :param events: iterable of Event read from ical
+        :param now: current datetime
+        :return: None
+        """
+        now = now or datetime.now(tz=pytz.UTC)
+        with self.lock:
+            self.remove_calendar(calendar_config.user_id, calendar_config.id)
+            for event in events:
+                for advance in calendar_config.advance:
+                    if event.notify_datetime - timedelta(hours=advance) <= now:
+                        continue
+                    self._add(calendar_config, event, advance)
+            self.save_calendar(calendar_config)
+
+    def remove_calendar(self, user_id, calendar_id):
+        """
+        Removes all moments of the calendar from the wheel.
+        :param user_id: ID of the user
+        :param calendar_id: ID of the calendar
+        :return: None
+        """
+        with self.lock:
+            for key in self.calendars.pop((user_id, calendar_id), ()):
+                self.wheel.remove(key)
+
+    def pop_due(self, now=None):
+        """
+        Removes due moments from the wheel.
+        :param now: current datetime
+        :return: list of NotifyMoment ordered by their moments
+        """
+        with self.lock:
+            due = self.wheel.pop_due(now)
+            for moment in due:
+                keys = self.calendars.get((moment.user_id, moment.calendar_id))
+                if keys is not None:
+                    keys.discard(moment.key)
+        return due
+
+    def save_calendar(self, calendar_config):
+        """
+        Writes the moments of the calendar which are still in the wheel to schedule.cfg file.
+        :param calendar_config: CalendarConfig instance
+        :return: None
+        """
+        config_file = ScheduleConfigFile(calendar_config.vardir, calendar_config.user_id, calendar_config.id)
+        parser = ConfigParser(interpolation=None)
+        advances = defaultdict(list)
+        with self.lock:
+            for key in self.calendars.get((calendar_config.user_id, calendar_config.id), ()):
+                moment = self.wheel.entries[key].value
+                if not parser.has_section(moment.event.id):
+                    write_event(parser, moment.event)
+                advances[moment.event.id].append(moment.advance)
+        for event_id, event_advances in advances.items():
+            parser.set(event_id, 'advances', ' '.join(map(str, sorted(event_advances, reverse=True))))
+        config_file.write(parser)
+
+    def _add(self, calendar_config, event, advance):
+        moment = NotifyMoment(calendar_config.user_id, calendar_config.id, event, advance)
+        self.wheel.add(moment.key, moment.moment, moment)
+        self.calendars[(calendar_config.user_id, calendar_config.id)].add(moment.key)
+
+
+class NotifyMoment:
+    """
+    The moment when the event should be notified for the specific advance.
+    """
+
+    def __init__(self, user_id, calendar_id, event, advance):
+        self.user_id = user_id
+        """Chat ID of the user to whom the calendar belongs to"""
+        self.calendar_id = calendar_id
+        """ID of the calendar"""
+        self.event = event
+        """Event instance, as it was read from ical"""
+        self.advance = advance
+        """hours in advance for which the event should be notified"""
+
+    @property
+    def key(self):
+        return self.user_id, self.calendar_id, self.event.id, self.advance
+
+    @property
+    def moment(self):
+        return self.event.notify_datetime - timedelta(hours=self.advance)
+
+
+def write_event(parser, event):
+    """
+    Writes the event data required for formatting to the ConfigParser section named by the event id.
+    :param parser: ConfigParser
+    :param event: Event instance
+    :return: None
+    """
+    section = event.id
+    parser.add_section(section)
+    parser.set(section, 'uid', event.uid)
+    parser.set(section, 'title', str(event.title))
+    parser.set(section, 'location', str(event.location))
+    parser.set(section, 'description', str(event.description))
+    parser.set(section, 'notify_datetime', event.notify_datetime.isoformat())
+    if event.time is not None:
+        start = datetime.combine(event.date, event.time)
+        parser.set(section, 'start', start.isoformat())
+        timezone = getattr(event.time.tzinfo, 'zone', None)
+        if timezone is not None:
+            parser.set(section, 'timezone', timezone)
+    else:
+        parser.set(section, 'date', event.date.isoformat())
+
+
+def read_event(parser, section):
+    """
+    Reads the event written by write_event()
+    :param parser: ConfigParser
+    :param section: the section name, it's the event id
+    :return: Event instance
+    """
+    notify_datetime = parse(parser.get(section, 'notify_datetime'))
+    if parser.has_option(section, 'start'):
+        start = parse(parser.get(section, 'start'))
+        if parser.has_option(section, 'timezone'):
+            start = start.astimezone(pytz.timezone(parser.get(section, 'timezone')))
+        event_date = start.date()
+        event_time = start.timetz()
+    else:
+        event_date = parse(parser.get(section, 'date')).date()
+        event_time = None
+    uid = parser.get(section, 'uid')
+    return Event(
+        id=section,
+        uid=uid,
+        instance_id=(uid, notify_datetime),
+        title=parser.get(section, 'title'),
+        location=parser.get(section, 'location'),
+        description=parser.get(section, 'description'),
+        date=event_date,
+        time=event_time,
+        notify_datetime=notify_datetime
+    )
+
+
+def _minute(moment):
+    """
+    Rounds the moment up to the whole minute.
+    :param moment: aware datetime
+    :return: minutes since the epoch
+    """
+    return -(-int(moment.timestamp()) // 60)
+
+
+class ScheduleConfigFile(ConfigFile):
+    """
+    Reads and writes schedule config file.
+    """
+
+    def __init__(self, vardir, user_id, cal_id):
+        """
+        Creates the config
+        :param vardir: basic var dir
+        :param user_id: user ID as string
+        :param cal_id: ID of the calendar
+        """
+        super().__init__(os.path.join(vardir, user_id, cal_id, 'schedule.cfg'))
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+Micro-benchmarks of the calendars processing.
+
+Run all benchmarks and save the results:
+
+    python calbot_bench.py --output bench.json
+
+Compare with the saved results, exits with non-zero code if some benchmark is slower than the threshold:
+
+    python calbot_bench.py --compare bench.json --threshold 1.2
+
+The `import_modules` benchmark measures the startup of the interpreter importing the processing modules,
+exits with non-zero code if it's over the budget:
+
+    python calbot_bench.py import_modules --import-budget 0.3
+
+The `read_recorded` benchmark reads all ical files recorded in production (see the [feeds] section of the config),
+without the network, or a synthetic recorded file if the directory is not given:
+
+    python calbot_bench.py read_recorded --feeds var/feeds
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARKS = []
+
+IMPORT_BUDGET = 0.3
+"""maximum seconds to start the interpreter and import the processing modules"""
+
+recorded_feeds = None
+"""directory of the recorded ical files for read_recorded, set by --feeds"""
+
+
+def benchmark(**params):
+    """
+    Registers the benchmark function.
+    The function receives the params and returns the callable to be measured.
+    :param params: parameters of the benchmark, saved with the results
+    """
+    def register(func):
+        BENCHMARKS.append((func.__name__, func, params))
+        return func
+    return register
+
+
+def synthetic_ical(events=100, rrules=10, exdates=0, overrides=0, description_size=100, start=None,
+                   frequency='DAILY'):
+    """
+    Generates the content of ical file.
+    :param events: number of single events, spread over the next days
+    :param rrules: number of repeating events, started a year ago
+    :param exdates: number of excluded dates of each repeating event
+    :param overrides: number of overridden occurrences of each repeating event
+    :param description_size: length of the events description, in characters
+    :param start: datetime of the first event, now by default
+    :param frequency: FREQ of the repeating events
+    :return: bytes of ical file
+    """
+    start = (start or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+    description = ('<p>Some <b>description</b> with <a href="https://example.com">link</a></p>' *
+                   (description_size // 70 + 1))[:description_size]
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Calendar Bot//Benchmark//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:Benchmark',
+        'X-WR-TIMEZONE:Asia/Omsk',
+    ]
+
+    def vevent(uid, dtstart, *extra):
+        lines.extend([
+            'BEGIN:VEVENT',
+            'UID:%s' % uid,
+            'DTSTART;TZID=Asia/Omsk:%s' % dtstart.strftime('%Y%m%dT%H%M%S'),
+            'DTEND;TZID=Asia/Omsk:%s' % (dtstart + timedelta(hours=1)).strftime('%Y%m%dT%H%M%S'),
+            'SUMMARY:Event %s' % uid,
+            'LOCATION:Somewhere',
+            'DESCRIPTION:%s' % description,
+        ])
+        lines.extend(extra)
+        lines.append('END:VEVENT')
+
+    for i in range(events):
+        vevent('single-%s@bench' % i, start + timedelta(hours=i % 96, minutes=i % 60))
+
+    series_start = start - timedelta(days=365)
+    for i in range(rrules):
+        extra = ['RRULE:FREQ=%s' % frequency]
+        for d in range(exdates):
+            extra.append('EXDATE;TZID=Asia/Omsk:%s' %
+                         (series_start + timedelta(days=365 + d * 2)).strftime('%Y%m%dT%H%M%S'))
+        vevent('series-%s@bench' % i, series_start + timedelta(minutes=i), *extra)
+        for d in range(overrides):
+            recurrence_id = series_start + timedelta(days=365 + d * 2 + 1, minutes=i)
+            vevent('series-%s@bench' % i, recurrence_id + timedelta(hours=2),
+                   'RECURRENCE-ID;TZID=Asia/Omsk:%s' % recurrence_id.strftime('%Y%m%dT%H%M%S'))
+
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines).encode('UTF-8')
+
+
+def synthetic_vardir(vardir, users=100, calendars=2, events=50, disabled=0.1, url='file:///dev/null',
+                     advance='48 24'):
+    """
+    Generates the var directory with users, calendars and notified events.
+    :param vardir: the directory to fill
+    :param users: number of users
+    :param calendars: number of calendars of each user
+    :param events: number of notified events of each calendar
+    :param disabled: the fraction of disabled calendars
+    :param url: URL of all calendars, {user} and {calendar} are replaced with the ids
+    :param advance: hours in advance to notify the events, of each user
+    :return: None
+    """
+    from calbot.conf import CalendarsConfigFile, UserConfigFile
+    from calbot.eventindex import event_key, write_index
+    from configparser import ConfigParser
+
+    for user in range(users):
+        user_id = str(100000 + user)
+        settings = ConfigParser(interpolation=None)
+        settings.add_section('settings')
+        settings.set('settings', 'advance', advance)
+        UserConfigFile(vardir, user_id).write(settings)
+
+        calendars_parser = ConfigParser(interpolation=None)
+        calendars_parser.add_section('settings')
+        calendars_parser.set('settings', 'last_id', str(calendars))
+        for calendar in range(1, calendars + 1):
+            calendar_id = str(calendar)
+            calendars_parser.add_section(calendar_id)
+            calendars_parser.set(calendar_id, 'url', url.format(user=user_id, calendar=calendar_id))
+            calendars_parser.set(calendar_id, 'name', 'Calendar %s' % calendar_id)
+            calendars_parser.set(calendar_id, 'channel_id', '@channel%s' % user_id)
+            calendars_parser.set(calendar_id, 'verified', 'true')
+            enabled = (user * calendars + calendar) % 100 >= disabled * 100
+            calendars_parser.set(calendar_id, 'enabled', str(enabled))
+            calendars_parser.set(calendar_id, 'last_process_at', datetime.utcnow().isoformat())
+
+            write_index(os.path.join(vardir, user_id, calendar_id, 'events.idx'),
+                        [(event_key(_event_id(event)), 24) for event in range(events)])
+        CalendarsConfigFile(vardir, user_id).write(calendars_parser)
+
+
+def _event_id(index):
+    return 'event-%s@bench_%s' % (index, datetime(2020, 1, 1, 10).isoformat())
+
+
+def _main_config(vardir):
+    from calbot.conf import Config
+    config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calbot.cfg.sample'))
+    config.vardir = vardir
+    return config
+
+
+def _calendar_config(vardir, url):
+    from calbot.conf import CalendarConfig, UserConfig
+    return CalendarConfig.new(UserConfig.new(_main_config(vardir), 'BENCH'), '1', url, 'BENCH')
+
+
+def _events(count):
+    import pytz
+    from calbot.ical import Event
+    now = datetime.now(tz=pytz.UTC)
+    result = []
+    for i in range(count):
+        notify_datetime = now + timedelta(minutes=(i * 7919) % (72 * 60))
+        result.append(Event(id='event-%s' % i, title='Event %s' % i, location='Somewhere',
+                            description='Description', date=notify_datetime.date(), time=notify_datetime.timetz(),
+                            notify_datetime=notify_datetime))
+    return result
+
+
+@benchmark(events=1000, rrules=50, exdates=20, overrides=5, description_size=1000)
+def read_ical(tmpdir, **params):
+    path = os.path.join(tmpdir, 'bench.ics')
+    with open(path, 'wb') as f:
+        f.write(synthetic_ical(**params))
+    from calbot.ical import Calendar
+    from calbot.timings import ProcessingProfile
+    config = _calendar_config(tmpdir, 'file://' + path)
+    calendar = Calendar.__new__(Calendar)
+    calendar.day_start = config.day_start
+    calendar.profile = ProcessingProfile()
+    calendar.slow = False
+    after = datetime.now().astimezone()
+    before = after + timedelta(hours=48)
+    return lambda: list(calendar.read_ical(config.url, after, before))
+
+
+@benchmark(events=1000, rrules=50, exdates=20, overrides=5, description_size=1000)
+def read_ical_incremental(tmpdir, **params):
+    path = os.path.join(tmpdir, 'bench.ics')
+    with open(path, 'wb') as f:
+        f.write(synthetic_ical(**params))
+    from calbot.ical import Calendar
+    from calbot.timings import ProcessingProfile
+    config = _calendar_config(tmpdir, 'file://' + path)
+    calendar = Calendar.__new__(Calendar)
+    calendar.day_start = config.day_start
+    calendar.profile = ProcessingProfile()
+    calendar.slow = False
+    after = datetime.now().astimezone()
+    before = after + timedelta(hours=48)
+    list(calendar.read_ical(config.url, after, before, {}))    # the previous pass
+    cursors = calendar.cursors
+    return lambda: list(calendar.read_ical(config.url, after, before, cursors))
+
+
+@benchmark(events=100, rrules=50, exdates=20, overrides=5, description_size=100, frequency='HOURLY')
+def read_ical_hourly(tmpdir, **params):
+    path = os.path.join(tmpdir, 'bench.ics')
+    with open(path, 'wb') as f:
+        f.write(synthetic_ical(**params))
+    from calbot.ical import Calendar
+    from calbot.timings import ProcessingProfile
+    config = _calendar_config(tmpdir, 'file://' + path)
+    calendar = Calendar.__new__(Calendar)
+    calendar.day_start = config.day_start
+    calendar.profile = ProcessingProfile()
+    calendar.slow = False
+    after = datetime.now().astimezone()
+    before = after + timedelta(hours=48)
+    return lambda: list(calendar.read_ical(config.url, after, before))
+
+
+@benchmark(events=1000, rrules=50, exdates=20, overrides=5, description_size=1000)
+def read_recorded(tmpdir, **params):
+    from calbot import ical
+    from calbot.feedstore import FeedStore
+    from calbot.timings import ProcessingProfile
+    store = FeedStore(recorded_feeds or os.path.join(tmpdir, 'feeds'))
+    if recorded_feeds is None:
+        store.record('https://example.com/bench.ics', synthetic_ical(**params))
+    config = _calendar_config(tmpdir, 'file:///dev/null')
+    calendar = ical.Calendar.__new__(ical.Calendar)
+    calendar.day_start = config.day_start
+    calendar.profile = ProcessingProfile()
+    calendar.slow = False
+    after = datetime.now().astimezone()
+    before = after + timedelta(hours=48)
+    urls = store.urls()
+
+    def read_all():
+        ical.start_feed_store(store.path, replay=True)
+        try:
+            for url in urls:
+                list(calendar.read_ical(url, after, before))
+        finally:
+            ical.stop_feed_store()
+    return read_all
+
+
+@benchmark(events=10000, notified=5000)
+def filter_notified_events(tmpdir, events, notified):
+    from calbot.ical import filter_notified_events
+    config = _calendar_config(tmpdir, 'file:///dev/null')
+    event_list = _events(events)
+    for event in event_list[:notified]:
+        config.event(event.id).last_notified = 24
+    return lambda: list(filter_notified_events(event_list, config))
+
+
+@benchmark(events=10000, lookups=10000)
+def event_index_lookup(tmpdir, events, lookups):
+    from calbot.eventindex import EventIndex, event_key, write_index
+    path = os.path.join(tmpdir, 'events.idx')
+    write_index(path, [(event_key(_event_id(i)), 24) for i in range(events)])
+    index = EventIndex(path)
+    keys = [event_key(_event_id(i * 2)) for i in range(lookups)]     # half of them are unknown
+    return lambda: [index.get(key) for key in keys]
+
+
+@benchmark(events=10000)
+def sort_events(tmpdir, events):
+    from calbot.ical import sort_events
+    event_list = _events(events)
+    return lambda: sort_events(event_list)
+
+
+@benchmark(events=10000, notified=5000)
+def due_events(tmpdir, events, notified):
+    from calbot.ical import Calendar
+    from calbot.timings import ProcessingProfile
+    config = _calendar_config(tmpdir, 'file:///dev/null')
+    event_list = _events(events)
+    for event in event_list[:notified]:
+        config.event(event.id).last_notified = 24
+    calendar = Calendar.__new__(Calendar)
+    calendar.profile = ProcessingProfile()
+    calendar.occurrences = [event.to_tuple() for event in event_list]
+    return lambda: list(calendar.due_events(config))
+
+
+@benchmark(description_size=10000)
+def format_event(tmpdir, description_size):
+    from calbot.formatting import format_event
+    config = _calendar_config(tmpdir, 'file:///dev/null')
+    config.language = 'C.UTF-8'
+    event = _events(1)[0]
+    event.description = ('<p>Some <b>description</b> with <a href="https://example.com">link</a></p>' *
+                         (description_size // 70 + 1))[:description_size]
+    return lambda: format_event(config, event)
+
+
+@benchmark(description_size=10000)
+def strip_tags(tmpdir, description_size):
+    from calbot.formatting import strip_tags
+    html = ('<p>Some <b>description</b> with <a href="https://example.com">link</a></p><ul><li>item</li></ul>' *
+            (description_size // 90 + 1))[:description_size]
+    return lambda: strip_tags(html)
+
+
+@benchmark(users=300, calendars=2, events=50)
+def all_calendars(tmpdir, **params):
+    from calbot.calindex import rebuild_index
+    synthetic_vardir(tmpdir, **params)
+    config = _main_config(tmpdir)
+    rebuild_index(config)   # maintained by the writers of calbot.conf in the real var dir
+    return lambda: list(config.all_calendars())
+
+
+@benchmark(users=300, calendars=2, events=50)
+def update_stats(tmpdir, **params):
+    from calbot.calindex import rebuild_index
+    from calbot.stats import update_stats
+    synthetic_vardir(tmpdir, **params)
+    config = _main_config(tmpdir)
+    rebuild_index(config)
+    return lambda: update_stats(config)
+
+
+@benchmark(modules='calbot.conf calbot.processing calbot.supervisor calbot.wheel')
+def import_modules(tmpdir, modules):
+    command = [sys.executable, '-c', 'import %s' % ', '.join(modules.split())]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    return lambda: subprocess.check_call(command, cwd=cwd)
+
+
+def run_benchmark(name, func, params, repeat, scale):
+    """
+    Prepares and measures the benchmark.
+    :return: dict of the results
+    """
+    params = dict((key, max(1, int(value * scale)) if isinstance(value, int) else value)
+                  for key, value in params.items())
+    tmpdir = tempfile.mkdtemp(prefix='calbot-bench-')
+    try:
+        target = func(tmpdir, **params)
+        target()    # warm up
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            target()
+            times.append(time.perf_counter() - started)
+        return dict(name=name, params=params, repeat=repeat,
+                    min=min(times), median=statistics.median(times), mean=statistics.mean(times))
+    except Exception as e:
+        return dict(name=name, params=params, error='%s: %s' % (e.__class__.__name__, e))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the results with the baseline by the median time.
+    :return: list of (name, baseline median, current median) of slower benchmarks
+    """
+    previous = dict((result['name'], result) for result in baseline['results'] if 'median' in result)
+    regressions = []
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None or 'median' not in result or old['params'] != result['params']:
+            continue
+        if result['median'] > old['median'] * threshold:
+            regressions.append((result['name'], old['median'], result['median']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calendar Bot micro-benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements of each benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier of the benchmarks sizes')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    parser.add_argument('--compare', help='JSON results of the previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio treated as regression')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help='maximum seconds of the import_modules benchmark')
+    parser.add_argument('--feeds', help='directory of the recorded ical files to read in read_recorded benchmark')
+    args = parser.parse_args(argv)
+
+    global recorded_feeds
+    recorded_feeds = args.feeds
+
+    results = []
+    for name, func, params in BENCHMARKS:
+        if args.names and name not in args.names:
+            continue
+        result = run_benchmark(name, func, params, args.repeat, args.scale)
+        print('%-24s %s' % (name, ('%.6f s' % result['median']) if 'median' in result else result['error']),
+              file=sys.stderr)
+        results.append(result)
+
+    report = dict(timestamp=datetime.utcnow().isoformat(), python=platform.python_version(), results=results)
+    if args.output:
+        with open(args.output, 'wt', encoding='UTF-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    status = 0
+    for result in results:
+        if result['name'] == 'import_modules' and result.get('median', 0) > args.import_budget:
+            print('OVER BUDGET import_modules: %.6f s > %.6f s' % (result['median'], args.import_budget),
+                  file=sys.stderr)
+            status = 1
+
+    if args.compare:
+        with open(args.compare, 'rt', encoding='UTF-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print('REGRESSION %s: %.6f s -> %.6f s' % (name, old, new), file=sys.stderr)
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
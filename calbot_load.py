@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 Denis Nelubin.
+#
+# This file is part of Calendar Bot.
+#
+# Calendar Bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Calendar Bot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Calendar Bot.  If not, see http://www.gnu.org/licenses/.
+
+"""
+End-to-end load test of the calendars processing.
+
+Starts, in a separate process, a local HTTP server of synthetic ical feeds
+and a local fake of the Telegram Bot API `sendMessage` method, which answers 429 on flood.
+Generates the var directory of users whose calendars are read from the fake feeds,
+and runs the passes of update_calendars() in this process, sending the notifications to the fake API.
+
+    python calbot_load.py --users 1000 --calendars 2 --latency 0.05 --error-rate 0.01 --passes 2
+
+Each feed has events which are due exactly at the start of the pass,
+so the notification lateness is the time from the pass start to the accepted sendMessage.
+Reports the throughput, the lateness percentiles and the peak memory of the processing, in JSON.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+TOKEN = '123456:LOAD'
+ADVANCE = 1
+"""hours in advance to notify the events, of the generated users"""
+
+
+def feed_ical(name, due_at, due_events=2, events=20, description_size=200):
+    """
+    Generates the feed content.
+    :param name: name of the feed, used in UIDs
+    :param due_at: unix time when the due events should be notified
+    :param due_events: number of events to notify at due_at
+    :param events: number of the future events, not notified in the pass
+    :param description_size: length of the events description, in characters
+    :return: bytes of ical file
+    """
+    description = ('Some <b>description</b> with <a href="https://example.com">link</a>. ' *
+                   (description_size // 70 + 1))[:description_size]
+    start = datetime.utcfromtimestamp(due_at) + timedelta(hours=ADVANCE)
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Calendar Bot//Load//EN',
+        'X-WR-CALNAME:Load %s' % name,
+    ]
+    for i in range(due_events + events):
+        due = i < due_events
+        lines.extend([
+            'BEGIN:VEVENT',
+            'UID:%s-%s-%s@load' % (name, int(due_at), i),
+            # the due time is in the title to measure the lateness, see FakeBotApi
+            'SUMMARY:Load %s due %.3f' % (name, due_at) if due else 'SUMMARY:Load %s' % name,
+            'DTSTART:%s' % (start if due else start + timedelta(days=1 + i)).strftime('%Y%m%dT%H%M%SZ'),
+            'DESCRIPTION:%s' % description,
+            'END:VEVENT',
+        ])
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines).encode('UTF-8')
+
+
+class TokenBucket:
+    """
+    Allows the rate of events with bursts.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        """allowed events per second"""
+        self.burst = burst
+        """maximum number of events at once"""
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Takes one token.
+        :return: 0 if it's allowed, or seconds to wait for the next token
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def serve(options, due_at, ports, stop):
+    """
+    Runs the fake servers, the target of the servers process.
+    :param options: dict of the command line options
+    :param due_at: shared Value of the due time of the current pass
+    :param ports: Queue to put (feeds port, api port) to
+    :param stop: Event to stop the servers
+    :return: None
+    """
+    import hashlib
+    import math
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+
+    lock = threading.Lock()
+    feed_stats = dict(requests=0, errors=0, not_modified=0, bytes=0)
+    api_stats = dict(requests=0, accepted=0, flood=0, lateness=[])
+    global_bucket = TokenBucket(options['global_rate'], options['global_rate'])
+    chat_buckets = {}
+
+    class FeedHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            with lock:
+                feed_stats['requests'] += 1
+            time.sleep(max(0.0, random.gauss(options['latency'], options['latency'] / 4)))
+            if random.random() < options['error_rate']:
+                with lock:
+                    feed_stats['errors'] += 1
+                self.send_error(503)
+                return
+            name = os.path.basename(self.path).split('.')[0]
+            data = feed_ical(name, due_at.value, options['due_events'], options['events'],
+                             options['description_size'])
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            if options['etags'] and self.headers.get('If-None-Match') == etag:
+                with lock:
+                    feed_stats['not_modified'] += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/calendar; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            if options['etags']:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+            with lock:
+                feed_stats['bytes'] += len(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    class ApiHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            with lock:
+                self._reply(200, dict(feeds=feed_stats, api=api_stats))
+
+        def do_POST(self):
+            accepted_at = time.time()
+            if not self.path.endswith('/sendMessage'):
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('UTF-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params = json.loads(body)
+            else:
+                params = dict((key, values[0]) for key, values in parse_qs(body).items())
+            chat_id = str(params.get('chat_id'))
+            with lock:
+                api_stats['requests'] += 1
+                bucket = chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = chat_buckets[chat_id] = TokenBucket(options['chat_rate'], options['chat_burst'])
+                wait = bucket.take() or global_bucket.take()
+                if wait:
+                    api_stats['flood'] += 1
+                    retry_after = math.ceil(wait)
+                    self._reply(429, dict(ok=False, error_code=429,
+                                          description='Too Many Requests: retry after %s' % retry_after,
+                                          parameters=dict(retry_after=retry_after)))
+                    return
+                api_stats['accepted'] += 1
+                text = params.get('text', '')
+                if ' due ' in text:
+                    api_stats['lateness'].append(accepted_at - float(text.split(' due ')[1].split()[0]))
+                self._reply(200, dict(ok=True, result=dict(message_id=api_stats['accepted'], text=text)))
+
+        def _reply(self, code, result):
+            data = json.dumps(result).encode('UTF-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler), ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)]
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports.put(tuple(server.server_address[1] for server in servers))
+    stop.wait()
+    for server in servers:
+        server.shutdown()
+
+
+class ApiBot:
+    """
+    Sends messages to the Bot API with plain HTTP requests, waits and retries on 429.
+    """
+
+    def __init__(self, api_url, token, retries=3):
+        self.url = '%s/bot%s/' % (api_url, token)
+        """base url of the Bot API methods"""
+        self.retries = retries
+        """number of retries after 429, then the error is raised"""
+        self.waited = 0.0
+        """seconds waited after 429"""
+
+    def sendMessage(self, **kwargs):
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        request_data = json.dumps(kwargs).encode('UTF-8')
+        for attempt in range(self.retries + 1):
+            request = Request(self.url + 'sendMessage', data=request_data,
+                              headers={'Content-Type': 'application/json'})
+            try:
+                with urlopen(request) as f:
+                    return json.loads(f.read().decode('UTF-8'))['result']
+            except HTTPError as e:
+                if e.code != 429 or attempt == self.retries:
+                    raise
+                retry_after = json.loads(e.read().decode('UTF-8'))['parameters']['retry_after']
+                self.waited += retry_after
+                time.sleep(retry_after)
+
+
+def make_bot(api_url, options):
+    """
+    Creates the bot sending messages to the fake API.
+    :param api_url: url of the fake API
+    :param options: dict of the command line options
+    :return: python-telegram-bot Bot with --telegram option, or ApiBot
+    """
+    if options['telegram']:
+        from telegram import Bot
+        return Bot(TOKEN, base_url='%s/bot' % api_url)
+    return ApiBot(api_url, TOKEN, options['retries'])
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(options):
+    """
+    Runs the load test.
+    :param options: dict of the command line options
+    :return: dict of the results
+    """
+    import multiprocessing
+    from urllib.request import urlopen
+    from calbot import ical
+    from calbot.calindex import rebuild_index
+    from calbot.processing import update_calendars
+    from calbot_bench import synthetic_vardir, _main_config
+
+    context = multiprocessing.get_context('spawn')
+    due_at = context.Value('d', time.time())
+    ports = context.Queue()
+    stop = context.Event()
+    servers = context.Process(target=serve, args=(options, due_at, ports, stop), daemon=True)
+    servers.start()
+    vardir = options['vardir'] or tempfile.mkdtemp(prefix='calbot-load-')
+    try:
+        feeds_port, api_port = ports.get(timeout=30)
+        api_url = 'http://127.0.0.1:%s' % api_port
+        synthetic_vardir(vardir, users=options['users'], calendars=options['calendars'], events=0, disabled=0,
+                         url='http://127.0.0.1:%s/feeds/{user}-{calendar}.ics' % feeds_port, advance=str(ADVANCE))
+        config = _main_config(vardir)
+        config.parse_workers = options['parse_workers']
+        rebuild_index(config)
+        if config.parse_workers > 0:
+            ical.start_parse_pool(config.parse_workers, config.parse_tasks_per_worker)
+        bot = make_bot(api_url, options)
+        memory_before = _peak_memory()
+
+        passes = []
+        for _ in range(options['passes']):
+            due_at.value = started = time.time()
+            update_calendars(bot, config)
+            passes.append(time.time() - started)
+        with urlopen(api_url + '/stats') as f:
+            stats = json.loads(f.read().decode('UTF-8'))
+    finally:
+        ical.stop_parse_pool()
+        stop.set()
+        servers.join(10)
+        if not options['vardir']:
+            shutil.rmtree(vardir, ignore_errors=True)
+
+    calendars = options['users'] * options['calendars'] * options['passes']
+    lateness = stats['api'].pop('lateness')
+    duration = sum(passes)
+    return dict(
+        timestamp=datetime.utcnow().isoformat(),
+        python=platform.python_version(),
+        options=options,
+        passes=passes,
+        calendars_per_second=calendars / duration if duration else None,
+        messages_per_second=stats['api']['accepted'] / duration if duration else None,
+        notified=len(lateness),
+        expected=calendars * options['due_events'],
+        lateness=dict(p50=percentile(lateness, 0.5), p95=percentile(lateness, 0.95),
+                      p99=percentile(lateness, 0.99), max=max(lateness) if lateness else None),
+        waited_after_429=getattr(bot, 'waited', None),
+        feeds=stats['feeds'],
+        api=stats['api'],
+        memory_before=memory_before,
+        memory_peak=_peak_memory(),
+    )
+
+
+def _peak_memory():
+    """
+    Returns the peak resident memory of this process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calendar Bot load test')
+    parser.add_argument('--users', type=int, default=500, help='number of generated users')
+    parser.add_argument('--calendars', type=int, default=2, help='calendars of each user')
+    parser.add_argument('--passes', type=int, default=1, help='number of update_calendars passes')
+    parser.add_argument('--due-events', type=int, default=2, help='events of each feed due at the pass start')
+    parser.add_argument('--events', type=int, default=20, help='future events of each feed')
+    parser.add_argument('--description-size', type=int, default=200, help='length of the events description')
+    parser.add_argument('--latency', type=float, default=0.02, help='mean latency of the feeds, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of the feed requests failed with 503')
+    parser.add_argument('--etags', action='store_true', help='send ETag and answer 304 to If-None-Match')
+    parser.add_argument('--chat-rate', type=float, default=1.0, help='messages per second allowed to one chat')
+    parser.add_argument('--chat-burst', type=int, default=3, help='messages at once allowed to one chat')
+    parser.add_argument('--global-rate', type=float, default=30.0, help='messages per second allowed to the bot')
+    parser.add_argument('--retries', type=int, default=3, help='retries of sendMessage after 429')
+    parser.add_argument('--telegram', action='store_true', help='send with python-telegram-bot, not plain HTTP')
+    parser.add_argument('--parse-workers', type=int, default=0, help='processes to parse the feeds in')
+    parser.add_argument('--vardir', help='keep the generated var directory here, temporary by default')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    options = vars(parser.parse_args(argv))
+
+    result = run(options)
+    print('%s calendars/s, %s messages/s, lateness p95 %s s, peak memory %.1f MB' % (
+        _round(result['calendars_per_second']), _round(result['messages_per_second']),
+        _round(result['lateness']['p95']), result['memory_peak'] / 1024 / 1024), file=sys.stderr)
+    if options['output']:
+        with open(options['output'], 'wt', encoding='UTF-8') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,18 +19,33 @@
 
 
 import datetime
+import importlib.util
+import json
 import os
 import unittest
 import pytz
 import shutil
+import time
 from dateutil.parser import parse
 
 from icalendar.cal import Component
 
 from calbot.formatting import normalize_locale, format_event, strip_tags
 from calbot.conf import CalendarConfig, Config, UserConfig, UserConfigFile, DEFAULT_FORMAT, CalendarsConfigFile
-from calbot.ical import Event, Calendar, filter_notified_events, sort_events
+from calbot.ical import Event, Calendar, filter_notified_events, sort_events, stream_sorted_events, start_parse_pool, \
+    stop_parse_pool
 from calbot.stats import update_stats, get_stats
+from calbot.wheel import TimingWheel, NotificationWheel
+from calbot.supervisor import Supervisor, shard_of
+from calbot.backoff import CircuitBreaker, is_transient
+from calbot.processing import update_calendar
+from calbot import metrics
+from calbot.profiler import Profiler, profile_call
+from calbot.verification import Verifier
+from calbot import locks
+from calbot.eventindex import EventIndex, event_key, write_index
+from calbot.calindex import read_index
+from calbot.scheduler import save_next_pass, first_pass_delay, plan_warmup
 
 
 def _get_component():
@@ -67,33 +82,40 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual('Тест', calendar.name)
         self.assertEqual('Just a test calendar', calendar.description)
 
-        for e in calendar.all_events:
+        self.assertNotIsInstance(calendar.occurrences, list)     # expanded on demand, not kept
+        events = list(calendar.iter_events())
+        self.assertEqual([e.to_tuple() for e in events], [e.to_tuple() for e in calendar.iter_events()])
+        for e in events:
             print(e)
-        self.assertEqual(2, len(calendar.all_events))
+        self.assertEqual(2, len(events))
         # events in the past are skipped, daily event is repeated for 48 hours to future
 
         # event in the past, skipped
-        # event = calendar.all_events[0]
+        # event = events[0]
         # self.assertEqual(datetime.date(2016, 6, 24), event.date)
         # self.assertEqual(datetime.time(6, 0, 0, tzinfo=pytz.timezone('Asia/Omsk')), event.time)
         # self.assertEqual('Событие по-русски', event.title)
 
         # event in the past, skipped
-        # event = calendar.all_events[1]
+        # event = events[1]
         # self.assertEqual(datetime.date(2016, 6, 23), event.date)
         # self.assertEqual(datetime.time(6, 0, 0, tzinfo=pytz.timezone('Asia/Omsk')), event.time)
         # self.assertEqual('Event title', event.title)
 
         today = datetime.date.today()
-        event = calendar.all_events[0]
+        event = events[0]
         self.assertEqual(today + datetime.timedelta(days=1), event.date)
         self.assertEqual(datetime.time(10, 0, 0, tzinfo=pytz.timezone('Asia/Omsk')), event.time)
         self.assertEqual('Daily event', event.title)
-        event = calendar.all_events[1]
+        event = events[1]
         self.assertTrue(today + datetime.timedelta(days=2), event.date)
         self.assertEqual(datetime.time(10, 0, 0, tzinfo=pytz.timezone('Asia/Omsk')), event.time)
         self.assertEqual('Daily event', event.title)
 
+        due = list(calendar.due_events(config))     # nothing is notified yet, all events are due
+        self.assertEqual([e.id for e in sorted(events, key=lambda e: e.notify_datetime)], [e.id for e in due])
+        self.assertTrue(all(event.notified_for_advance is not None for event in due))
+
     def test_filter_notified_events(self):
         timezone = pytz.UTC
         component_now = _get_component()
@@ -213,6 +235,7 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual(events[2], result[0])
         self.assertEqual(events[1], result[1])
         self.assertEqual(events[0], result[2])
+        self.assertEqual(result, list(stream_sorted_events(events)))
 
     def test_format_date_only_event(self):
         timezone = pytz.UTC
@@ -259,7 +282,12 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual(1, (stats2.users - stats1.users))
         self.assertEqual(1, (stats2.calendars - stats1.calendars))
         self.assertEqual(stats2.events, stats1.events)
+        os.makedirs('var/TEST2')     # the user without calendars is not in the index
+        os.makedirs('var/channels', exist_ok=True)
+        update_stats(config)
+        self.assertEqual(1, get_stats(config).users - stats2.users)
         shutil.rmtree('var/TEST')
+        shutil.rmtree('var/TEST2')
 
     def test_calendar_save_error(self):
         calendar_config = CalendarConfig.new(
@@ -727,3 +755,979 @@ class CalbotTestCase(unittest.TestCase):
         self.assertEqual(datetime.time(19, 0, 0, tzinfo=timezone), event.time)
         self.assertEqual('Дата Ужин (OML)', event.title)
         self.assertRegex(event.description, r'Пиццот')
+
+    def test_timing_wheel(self):
+        now = datetime.datetime(2020, 3, 23, 23, 30, 15, tzinfo=pytz.UTC)
+        wheel = TimingWheel(now)
+        wheel.add('past', now - datetime.timedelta(minutes=5), 'past')
+        wheel.add('minute', now + datetime.timedelta(minutes=10), 'minute')
+        wheel.add('hour', now + datetime.timedelta(hours=3), 'hour')
+        wheel.add('day', now + datetime.timedelta(days=3), 'day')
+        wheel.add('far', now + datetime.timedelta(days=100), 'far')
+        wheel.add('removed', now + datetime.timedelta(minutes=20), 'removed')
+        wheel.remove('removed')
+
+        self.assertEqual(['past'], wheel.pop_due(now))
+        self.assertEqual([], wheel.pop_due(now + datetime.timedelta(minutes=9)))
+        self.assertEqual(['minute'], wheel.pop_due(now + datetime.timedelta(minutes=10)))
+        self.assertEqual([], wheel.pop_due(now + datetime.timedelta(minutes=30)))
+        self.assertEqual(['hour'], wheel.pop_due(now + datetime.timedelta(hours=3)))
+        self.assertEqual(['day'], wheel.pop_due(now + datetime.timedelta(days=3, minutes=1)))
+        self.assertEqual(1, len(wheel))
+        self.assertEqual(['far'], wheel.pop_due(now + datetime.timedelta(days=101)))
+        self.assertEqual(0, len(wheel))
+
+    def test_notification_wheel(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = CalendarConfig.new(
+            UserConfig.new(config, 'TEST'),
+            '1', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST')
+        calendar = Calendar(calendar_config)
+        calendar_config.save_calendar(calendar)
+
+        timezone = pytz.timezone('Asia/Omsk')
+        component = _get_component()
+        component.add('dtstart', datetime.datetime.now(tz=timezone) + datetime.timedelta(hours=30))
+        event = Event.from_vevent(component, timezone)
+
+        wheel = NotificationWheel(config)
+        calendar_config = config.load_calendar('TEST', '1')
+        wheel.schedule_calendar(calendar_config, [event])
+        self.assertEqual(1, len(wheel))     # 24 hours in advance only, 48 hours is already passed
+        self.assertFalse(calendar_config.events_loaded)     # the notified events are not looked up
+
+        restored = NotificationWheel(config)
+        restored.restore()
+        self.assertEqual(1, len(restored))
+        due = restored.pop_due(datetime.datetime.now(tz=pytz.UTC) + datetime.timedelta(hours=7))
+        self.assertEqual(1, len(due))
+        self.assertEqual(24, due[0].advance)
+        self.assertEqual(event.id, due[0].event.id)
+        self.assertEqual(event.time, due[0].event.time)
+        self.assertEqual('summary', due[0].event.title)
+        shutil.rmtree('var/TEST')
+
+    def test_shard_of(self):
+        self.assertEqual(shard_of('123456', 4), shard_of('123456', 4))
+        shards = set(shard_of(str(user_id), 4) for user_id in range(100))
+        self.assertEqual({0, 1, 2, 3}, shards)
+
+    def test_supervisor_pass(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+        bot = TestBot()
+        supervisor = Supervisor(config, 2)
+        supervisor.start(bot)
+        try:
+            calendars = supervisor.run_pass()
+        finally:
+            supervisor.stop()
+
+        self.assertIn(('TEST', calendar_config.id), calendars)
+        self.assertEqual('TEST_CHANNEL', bot.messages[0]['chat_id'])     # verification message
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertTrue(calendar_config.verified)
+        shutil.rmtree('var/TEST')
+
+    def test_supervisor_stop_hung_worker(self):
+        from calbot.supervisor import Supervisor, WorkerHandle
+        supervisor = Supervisor(Config('calbot.cfg.sample'), 1)
+        process = supervisor.context.Process(target=time.sleep, args=(600,), daemon=True)   # ignores the tasks
+        process.start()
+        supervisor.workers.append(WorkerHandle(process, supervisor.context.Queue(), supervisor.context.Queue()))
+        started = time.monotonic()
+        supervisor.stop(timeout=1)
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertFalse(process.is_alive())
+
+    def test_read_calendar_in_parse_pool(self):
+        config = CalendarConfig.new(
+            UserConfig.new(Config('calbot.cfg.sample'), 'TEST'),
+            '1', 'file://{}/test/repeat.ics'.format(os.path.dirname(__file__)), 'TEST')
+        calendar = Calendar(config)
+        timezone = pytz.timezone('Asia/Omsk')
+        after = datetime.datetime(2019, 1, 21, 0, 0, 0, tzinfo=timezone)
+        before = datetime.datetime(2019, 2, 10, 23, 59, 59, tzinfo=timezone)
+        expected = list(map(lambda e: e.to_tuple(), calendar.read_ical(calendar.url, after, before)))
+
+        start_parse_pool(1, 1)
+        try:
+            for _ in range(2):      # the process is replaced after each task
+                calendar = Calendar(config)
+                events = list(map(lambda e: e.to_tuple(), calendar.read_ical(calendar.url, after, before)))
+                self.assertEqual(expected, events)
+                self.assertEqual(timezone, calendar.timezone)
+                self.assertEqual('Omsk IT Events', calendar.name)
+        finally:
+            stop_parse_pool()
+
+    def test_is_transient(self):
+        from urllib.error import HTTPError, URLError
+        self.assertTrue(is_transient(HTTPError('http://example.com', 503, 'Unavailable', {}, None)))
+        self.assertTrue(is_transient(URLError(ConnectionRefusedError())))
+        self.assertTrue(is_transient(TimeoutError()))
+        self.assertFalse(is_transient(HTTPError('http://example.com', 404, 'Not Found', {}, None)))
+        self.assertFalse(is_transient(URLError('unknown url type: xxx')))
+        self.assertFalse(is_transient(ValueError('Content line could not be parsed into parts')))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(2, 100)
+        url = 'http://example.com/calendar.ics'
+        self.assertTrue(breaker.allow(url, 0))
+        breaker.failure(url, 0)
+        self.assertTrue(breaker.allow(url, 1))
+        breaker.failure('http://example.com/another.ics', 1)
+        self.assertFalse(breaker.allow(url, 2))
+        self.assertTrue(breaker.allow('http://example.org/calendar.ics', 2))
+        self.assertTrue(breaker.allow(url, 101))       # half-open, one trial
+        self.assertFalse(breaker.allow(url, 102))
+        breaker.failure(url, 102)
+        self.assertFalse(breaker.allow(url, 250))      # cooldown is doubled
+        self.assertTrue(breaker.allow(url, 302))
+        breaker.success(url)
+        self.assertTrue(breaker.allow(url, 303))
+        self.assertTrue(breaker.allow(url, 303))
+        breaker.failure(url, 400)
+        breaker.failure(url, 400)
+        self.assertTrue(breaker.allow(url, 500))
+        self.assertFalse(breaker.allow(url, 550))
+        self.assertTrue(breaker.allow(url, 600))       # the trial without outcome is expired
+
+    def test_circuit_breaker_permanent_error(self):
+        breaker = CircuitBreaker(1, 100)
+        config = Config('calbot.cfg.sample')
+        url = 'file://{}/README.md'.format(os.path.dirname(os.path.abspath(__file__)))  # not ical
+        calendar_config = config.add_calendar('TEST', url, 'TEST_CHANNEL')
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        calendar_config.verified = True     # do not send error messages
+        breaker.failure(url, time.time() - 1000)
+        update_calendar(None, calendar_config, breaker=breaker)    # the trial read
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertEqual(1, calendar_config.last_errors_count)
+        self.assertTrue(breaker.allow(url, time.time()))   # the trial is ended by the permanent error
+        shutil.rmtree('var/TEST')
+
+    def test_calendar_transient_error_backoff(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'http://127.0.0.1:9/calendar.ics', 'TEST_CHANNEL')
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        calendar_config.verified = True     # do not send error messages
+
+        update_calendar(None, calendar_config)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertEqual(1, calendar_config.last_errors_count)
+        self.assertIsNotNone(calendar_config.next_attempt_at)
+        self.assertTrue(parse(calendar_config.next_attempt_at) > datetime.datetime.utcnow())
+
+        update_calendar(None, calendar_config)     # postponed, not counted
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertEqual(1, calendar_config.last_errors_count)
+
+        calendar_config.save_error(ValueError('parse error'))
+        self.assertEqual(2, calendar_config.last_errors_count)
+        self.assertIsNone(calendar_config.next_attempt_at)
+        shutil.rmtree('var/TEST')
+
+    def test_synthetic_ical(self):
+        from calbot_bench import synthetic_ical
+        import icalendar
+        vcalendar = icalendar.Calendar.from_ical(synthetic_ical(events=5, rrules=2, exdates=3, overrides=1))
+        vevents = vcalendar.walk('VEVENT')
+        self.assertEqual(5 + 2 + 2, len(vevents))
+        self.assertEqual(3, len(vevents[5].get('EXDATE')))
+        self.assertIsNotNone(vevents[6].get('RECURRENCE-ID'))
+
+    def test_processing_profile(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+
+        class TestBot:
+
+            def sendMessage(self, **kwargs):
+                pass
+
+        for event in Calendar(calendar_config).iter_events():
+            event.notified_for_advance = 24     # nothing to format and send
+            calendar_config.event_notified(event)
+        update_calendar(TestBot(), calendar_config)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        profile = calendar_config.profile
+        self.assertEqual(os.path.getsize('test/test.ics'), profile.bytes)
+        self.assertEqual(3, profile.vevents)
+        self.assertEqual(2, profile.occurrences)
+        self.assertTrue(profile.timings['parse'] > 0)
+        self.assertTrue(profile.total >= profile.timings['parse'])
+
+        update_stats(config)
+        stats = get_stats(config)
+        self.assertIn(('TEST', calendar_config.id), [(user_id, cal_id) for user_id, cal_id, _, _ in stats.heaviest])
+        shutil.rmtree('var/TEST')
+
+    def test_group_messages(self):
+        from calbot.formatting import group_messages
+        self.assertEqual([], group_messages([]))
+        self.assertEqual([[0, 1], [2], [3, 4]], group_messages(['a' * 4, 'b' * 4, 'c' * 9, 'd' * 3, 'e'], limit=10))
+        self.assertEqual([[0], [1], [2]], group_messages(['a' * 20, 'b', 'c' * 20], limit=10))
+        emoji = '\U0001F389'     # two UTF-16 code units
+        self.assertEqual([[0, 1]], group_messages(['a' * 2046, 'b' * 2048]))
+        self.assertEqual([[0], [1]], group_messages([emoji + 'a' * 2045, 'b' * 2048]))
+        self.assertEqual([[0], [1]], group_messages(['Событие ' + emoji * 1020, emoji * 1024]))
+
+    def test_digest_notifications(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+        config.set_calendar_digest('TEST', calendar_config.id, True)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertTrue(calendar_config.digest)
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+        bot = TestBot()
+        update_calendar(bot, calendar_config)
+        channel_messages = [message for message in bot.messages if message['chat_id'] == 'TEST_CHANNEL']
+        self.assertEqual(2, len(channel_messages))     # the verification message and the digest
+        self.assertEqual(2, channel_messages[1]['text'].count('Daily event'))
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        for event in Calendar(calendar_config).iter_events():
+            self.assertIsNotNone(calendar_config.event(event.id).last_notified)
+        shutil.rmtree('var/TEST')
+
+    def test_channel_dedup(self):
+        from calbot import dedup
+        from calbot.processing import notify_events
+        config = Config('calbot.cfg.sample')
+        event = Event(id='1', uid='same@test', title='Event', notify_datetime=datetime.datetime(
+            2030, 1, 1, 10, 0, tzinfo=pytz.timezone('Asia/Omsk')).astimezone(pytz.UTC))
+        event.notified_for_advance = 24
+        channel_dedup = dedup.ChannelDedup(config.vardir, 100)
+        self.assertTrue(channel_dedup.claim('@test', event, now=1000))
+        self.assertFalse(channel_dedup.claim('@test', event, now=1050))
+        self.assertTrue(channel_dedup.claim('@other', event, now=1050))
+        self.assertTrue(channel_dedup.claim('@test', event, now=1101))     # forgotten after the window
+        channel_dedup.release('@test', event)
+        self.assertTrue(channel_dedup.claim('@test', event))
+
+        other = Event(id='2', uid='other@test', title='Other', notify_datetime=event.notify_datetime)
+        other.notified_for_advance = 24
+        self.assertEqual(([other], [event, event]), channel_dedup.claim_all('@test', [event, other, event]))
+        self.assertEqual(([], [other]), channel_dedup.claim_all('@test', [other]))
+        channel_dedup.release_all('@test', [event, other])
+        self.assertEqual(([event, other], []), channel_dedup.claim_all('@test', [event, other]))
+
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', '@test')
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+        bot = TestBot()
+        dedup.channel_dedup = channel_dedup
+        try:
+            notify_events(bot, calendar_config, [event])
+        finally:
+            dedup.stop_channel_dedup()
+        self.assertEqual([], bot.messages)     # the duplicate is not sent
+        self.assertEqual(24, config.load_calendar('TEST', calendar_config.id).event('1').last_notified)
+        shutil.rmtree('var/TEST')
+        shutil.rmtree('var/channels')
+
+    def test_outbox_retries(self):
+        from calbot import outbox
+        from calbot.processing import notify_events
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', '@test')
+        event = Event(id='1', uid='outbox@test', title='Event', notify_datetime=datetime.datetime(
+            2030, 1, 1, 10, 0, tzinfo=pytz.UTC))
+        event.notified_for_advance = 24
+        messages = outbox.format_messages(calendar_config, [event])
+        outbox.enqueue(calendar_config, messages)
+        outbox.enqueue(calendar_config, messages)   # written again after a crash
+        self.assertEqual(1, len(outbox.Outbox('var', 'TEST', calendar_config.id).messages()))
+        outbox.Outbox('var', 'TEST', calendar_config.id).write([])
+
+        class FailingBot:
+
+            def sendMessage(self, **kwargs):
+                raise ConnectionError('Telegram is down')
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+        notify_events(FailingBot(), calendar_config, [event])
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertEqual(0, calendar_config.last_errors_count)      # the calendar is not failed
+        self.assertEqual(24, calendar_config.event('1').last_notified)
+        queued = outbox.Outbox('var', 'TEST', calendar_config.id).messages()
+        self.assertEqual(1, queued[0].attempts)
+        self.assertEqual([('1', 24)], queued[0].events)
+
+        bot = TestBot()
+        self.assertEqual(1, outbox.drain(bot, calendar_config))     # not due yet
+        self.assertEqual(0, outbox.drain(bot, calendar_config, now=queued[0].next_attempt_at))
+        self.assertEqual([{'chat_id': '@test', 'text': queued[0].text}], bot.messages)
+        self.assertFalse(outbox.Outbox('var', 'TEST', calendar_config.id).exists())
+        self.assertEqual([], os.listdir('var/outboxes'))   # the mark is removed with the last message
+        self.assertEqual(0, outbox.drain_outboxes(bot, config))
+        shutil.rmtree('var/TEST')
+        shutil.rmtree('var/outboxes')
+
+    def test_outbox_failed_chats(self):
+        from calbot import outbox
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', '@test')
+
+        class BadRequest(Exception):    # as telegram.error.BadRequest
+            pass
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                if kwargs['chat_id'] == '@old':
+                    raise BadRequest('Chat not found')
+                if kwargs['chat_id'] == '@down':
+                    raise ConnectionError('Telegram is down')
+                self.messages.append(kwargs['text'])
+
+        box = outbox.Outbox('var', 'TEST', calendar_config.id)
+        box.write([outbox.OutboxMessage(key=str(index), chat_id=chat_id, text=str(index))
+                   for index, chat_id in enumerate(['@old', '@down', '@test', '@down', '@test'])])
+        self.assertEqual(['TEST@%s' % calendar_config.id], os.listdir('var/outboxes'))
+        bot = TestBot()
+        self.assertEqual(2, outbox.drain_outboxes(bot, config))
+        self.assertEqual(['2', '4'], bot.messages)      # not blocked by the other chats
+        self.assertEqual(['1', '3'], [message.text for message in box.messages()])     # waiting in order
+        self.assertEqual(1, box.messages()[0].attempts)
+        shutil.rmtree('var/TEST')
+        shutil.rmtree('var/outboxes')
+
+    def test_metrics_render(self):
+        registry = metrics.Registry()
+        counter = metrics.Counter('test_total', 'Test counter', labels=('kind',), registry=registry)
+        histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0), registry=registry)
+        gauge = metrics.Gauge('test_size', 'Test gauge', registry=registry)
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        histogram.observe(0.5)
+        histogram.observe(5)
+        gauge.set_function(lambda: 42)
+        text = metrics.render(registry)
+        self.assertIn('# TYPE test_total counter\ntest_total{kind="a"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 0\n', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 1\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_sum 5.5\n', text)
+        self.assertIn('test_size 42\n', text)
+
+    def test_metrics_endpoint(self):
+        from urllib.request import urlopen
+
+        class RetryAfter(Exception):
+            retry_after = 3
+
+        flood = metrics.SEND_FLOOD.values.get((), 0)
+        with self.assertRaises(RetryAfter):
+            with metrics.measure_send():
+                raise RetryAfter()
+        self.assertEqual(flood + 1, metrics.SEND_FLOOD.values[()])
+
+        server = metrics.start_metrics_server('127.0.0.1', 0)
+        try:
+            with urlopen('http://127.0.0.1:%s/metrics' % server.server_address[1]) as response:
+                text = response.read().decode('UTF-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('calbot_send_flood_total %s\n' % (flood + 1), text)
+        self.assertIn('calbot_process_resident_memory_bytes ', text)
+
+    def test_profiler_passes(self):
+
+        class TestBot:
+
+            def __init__(self):
+                self.documents = []
+
+            def sendDocument(self, **kwargs):
+                self.documents.append((kwargs['chat_id'], kwargs['filename'], kwargs['document'].read()))
+
+        bot = TestBot()
+        profiler = Profiler()
+        with profiler.profile_pass(bot):
+            sort_events([])
+        self.assertEqual([], bot.documents)
+
+        profiler.request_passes('ADMIN', 2)
+        with profiler.profile_pass(bot):
+            sort_events([])
+        self.assertEqual([], bot.documents)
+        with profiler.profile_pass(bot):
+            sort_events([])
+        self.assertEqual(1, len(bot.documents))
+        chat_id, filename, report = bot.documents[0]
+        self.assertEqual('ADMIN', chat_id)
+        self.assertIn(b'sort_events', report)
+        self.assertIsNone(profiler.request)
+
+    def test_profile_call_memory(self):
+        kept = []
+        report = profile_call(lambda: kept.extend(bytearray(1000) for _ in range(100)), memory=True)
+        self.assertIn('Top allocation sites', report)
+        self.assertIn('calbot_test.py', report)
+
+    def test_profile_calendar(self):
+        from calbot.profiler import profile_calendar
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+                self.documents = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+            def sendDocument(self, **kwargs):
+                self.documents.append(kwargs)
+
+        bot = TestBot()
+        profile_calendar(bot, 'ADMIN', calendar_config)
+        self.assertEqual([], bot.messages)     # dry run
+        self.assertEqual(['ADMIN'], [document['chat_id'] for document in bot.documents])
+        self.assertIn('2 messages to send', bot.documents[0]['document'].getvalue().decode('UTF-8'))
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertFalse(calendar_config.verified)
+        for event in Calendar(calendar_config).iter_events():
+            self.assertIsNone(calendar_config.event(event.id).last_notified)
+        shutil.rmtree('var/TEST')
+
+    def test_lazy_imports(self):
+        import subprocess
+        import sys
+        heavy = ['icalendar', 'recurring_ical_events', 'urllib.request', 'http.server', 'dateutil.parser', 'telegram',
+                 'numpy']
+        code = 'import sys, calbot.processing, calbot.supervisor; print(" ".join(sorted(sys.modules)))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        modules = output.decode('UTF-8').split()
+        for module in heavy:
+            self.assertNotIn(module, modules)
+
+    def test_resume_schedule(self):
+        config = Config('calbot.cfg.sample')
+        now = datetime.datetime.utcnow()
+        save_next_pass(config, now + datetime.timedelta(seconds=100))
+        self.assertAlmostEqual(100, first_pass_delay(config, now), delta=1)
+        save_next_pass(config, now - datetime.timedelta(seconds=100))
+        self.assertEqual(config.interval, first_pass_delay(config, now))
+
+        fresh = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        fresh.save_error(None)
+        never = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        failed = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        failed.save_error(OSError('timeout'), transient=True)
+        later = now + datetime.timedelta(seconds=failed.retry_max_interval + 1)
+
+        plan = [(delay, calendar.id) for delay, calendar in plan_warmup(config, now)]
+        self.assertEqual([(0, never.id)], plan)
+        plan = [(delay, calendar.id) for delay, calendar in plan_warmup(config, later)]
+        self.assertEqual([never.id, failed.id, fresh.id], [calendar_id for _, calendar_id in plan])
+        self.assertEqual([0, config.warmup / 3, config.warmup * 2 / 3], [delay for delay, _ in plan])
+        shutil.rmtree('var/TEST')
+        os.remove('var/scheduler.cfg')
+
+    def test_background_verification(self):
+        import threading
+        config = Config('calbot.cfg.sample')
+        url = 'file://{}/test/test.ics'.format(os.path.dirname(__file__))
+        first = config.add_calendar('TEST', url, 'TEST_CHANNEL1')
+        second = config.add_calendar('TEST', url, 'TEST_CHANNEL2')
+        deleted = config.add_calendar('TEST', url, 'TEST_CHANNEL3')
+
+        class TestBot:
+
+            def __init__(self):
+                self.release = threading.Event()
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.release.wait(10)
+                self.messages.append(kwargs)
+
+        bot = TestBot()
+        verifier = Verifier(config, workers=4, per_user=1)
+        for calendar in (first, second, deleted):
+            verifier.submit(bot, calendar)
+        self.assertEqual(1, verifier.running['TEST'])
+        self.assertEqual(2, len(verifier.pending['TEST']))
+        config.delete_calendar('TEST', deleted.id)
+        bot.release.set()
+        verifier.stop()
+
+        self.assertEqual({}, dict(verifier.running))
+        channels = [message['chat_id'] for message in bot.messages if message['text'].startswith('Events from')]
+        self.assertEqual(['TEST_CHANNEL1', 'TEST_CHANNEL2'], channels)
+        self.assertTrue(config.load_calendar('TEST', second.id).verified)
+        shutil.rmtree('var/TEST')
+
+    def test_concurrent_add_calendar(self):
+        import threading
+        config = Config('calbot.cfg.sample')
+        config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')     # creates the user dir
+        threads = [threading.Thread(target=config.add_calendar, args=('TEST', 'file:///dev/null', 'TEST_CHANNEL'))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(21, len(list(config.load_calendars('TEST'))))
+        shutil.rmtree('var/TEST')
+
+    def test_user_lock(self):
+        import threading
+        locks.configure_locks(file_locks=True)
+        try:
+            contended = locks.LOCK_CONTENDED.values.get(('user',), 0)
+            acquired = threading.Event()
+            release = threading.Event()
+
+            def hold():
+                with locks.user_lock('var', 'TEST'):
+                    with locks.user_lock('var', 'TEST'):    # reentrant
+                        acquired.set()
+                        release.wait(10)
+
+            thread = threading.Thread(target=hold)
+            thread.start()
+            acquired.wait(10)
+            self.assertTrue(os.path.exists('var/TEST/.lock'))
+            threading.Timer(0.1, release.set).start()
+            with locks.user_lock('var', 'TEST'):
+                self.assertTrue(release.is_set())
+            thread.join()
+            self.assertEqual(contended + 1, locks.LOCK_CONTENDED.values[('user',)])
+            self.assertEqual({}, locks.manager.locks)     # not kept after the last holder
+        finally:
+            locks.configure_locks(file_locks=False)
+            shutil.rmtree('var/TEST')
+
+    def test_event_index(self):
+        os.makedirs('var', exist_ok=True)
+        write_index('var/events.idx', [(event_key('event%s' % i), (i % 3 or None) and 24) for i in range(100)])
+        index = EventIndex('var/events.idx')
+        self.assertEqual(100, len(index))
+        self.assertEqual((True, 24), index.get(event_key('event1')))
+        self.assertEqual((True, None), index.get(event_key('event3')))
+        self.assertEqual((False, None), index.get(event_key('unknown')))
+        rejected = sum(1 for i in range(1000) if not index._maybe_contains(event_key('unknown%s' % i)))
+        self.assertGreater(rejected, 950)
+        index.close()
+        os.remove('var/events.idx')
+
+    def test_truncated_event_index(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        calendar_config.event('event1').last_notified = 24
+        calendar_config.save_events()
+        path = calendar_config._events_index_path()
+        with open(path, 'rb') as f:
+            data = f.read()
+        for size in (0, 10, len(data) - 1):     # crashed in the middle of the write
+            with open(path, 'wb') as f:
+                f.write(data[:size])
+            with self.assertRaises(ValueError):
+                EventIndex(path)
+            calendar_config = config.load_calendar('TEST', calendar_config.id)
+            self.assertIsNone(calendar_config.event('event1').last_notified)
+            calendar_config.event('event2').last_notified = 24
+            calendar_config.save_events()   # rewrites the index
+            self.assertEqual((True, 24), EventIndex(path).get(event_key('event2')))
+        shutil.rmtree('var/TEST')
+
+    def test_events_index_replaces_events_cfg(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        from calbot.conf import EventsConfigFile
+        from configparser import ConfigParser
+        parser = ConfigParser(interpolation=None)
+        parser.add_section('legacy')
+        parser.set('legacy', 'last_notified', '48')
+        EventsConfigFile(config.vardir, 'TEST', calendar_config.id).write(parser)
+
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        calendar_config.load_events()
+        self.assertEqual(48, calendar_config.event('legacy').last_notified)
+        calendar_config.event('new').last_notified = 24
+        calendar_config.save_events()
+        self.assertFalse(os.path.exists('var/TEST/%s/events.cfg' % calendar_config.id))
+
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        calendar_config.load_events()
+        self.assertEqual({}, calendar_config.events)
+        self.assertEqual(2, calendar_config.events_count())
+        self.assertEqual(48, calendar_config.event('legacy').last_notified)
+        self.assertEqual(24, calendar_config.event('new').last_notified)
+        self.assertIsNone(calendar_config.event('unknown').last_notified)
+        shutil.rmtree('var/TEST')
+
+    def test_incremental_expansion(self):
+        from calbot.ical import parse_ical
+        ics = '\r\n'.join([
+            'BEGIN:VCALENDAR', 'VERSION:2.0',
+            'BEGIN:VEVENT', 'UID:daily@test', 'SUMMARY:Daily',
+            'DTSTART;TZID=America/New_York:20150105T100000', 'DTEND;TZID=America/New_York:20150105T110000',
+            'RRULE:FREQ=DAILY;COUNT=6000', 'EXDATE;TZID=America/New_York:20300310T100000',
+            'END:VEVENT', 'END:VCALENDAR']).encode('UTF-8')
+        day_start = datetime.time(10, 0)
+        cursors = {}
+        after = datetime.datetime(2030, 3, 1, tzinfo=pytz.UTC)
+        for _ in range(20):    # across the DST change and the EXDATE
+            before = after + datetime.timedelta(hours=48)
+            full = parse_ical(ics, after, before, day_start)[3]
+            result = parse_ical(ics, after, before, day_start, cursors)
+            self.assertEqual(sorted(full), sorted(result[3]))
+            cursors = result[5]
+            after += datetime.timedelta(hours=25)
+        cursor = cursors['daily@test']
+        self.assertEqual(datetime.datetime(2030, 3, 19, 10, 0), cursor.start)
+        self.assertEqual((cursor.start.date() - datetime.date(2015, 1, 5)).days, cursor.skipped)
+
+        changed = ics.replace(b'SUMMARY:Daily', b'SUMMARY:Changed')
+        result = parse_ical(changed, after, after + datetime.timedelta(hours=48), day_start, cursors)
+        self.assertEqual(sorted(parse_ical(changed, after, after + datetime.timedelta(hours=48), day_start)[3]),
+                         sorted(result[3]))
+        self.assertNotEqual(cursor.digest, result[5]['daily@test'].digest)
+
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        calendar_config.save_cursors(cursors)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertEqual(cursors, calendar_config.load_cursors())
+        shutil.rmtree('var/TEST')
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'NumPy is not installed')
+    def test_vectorized_expansion(self):
+        import icalendar
+        import recurring_ical_events
+        from calbot.expansion import expand_between
+        monthly = '\r\n'.join([
+            'BEGIN:VCALENDAR', 'VERSION:2.0',
+            'BEGIN:VEVENT', 'UID:hourly@test', 'SUMMARY:Hourly',
+            'DTSTART;TZID=America/New_York:20300101T000000', 'DTEND;TZID=America/New_York:20300101T003000',
+            'RRULE:FREQ=HOURLY;INTERVAL=5;BYDAY=MO,WE;UNTIL=20300601T000000Z',
+            'EXDATE;TZID=America/New_York:20300311T050000',
+            'END:VEVENT',
+            'BEGIN:VEVENT', 'UID:hourly@test', 'SUMMARY:Moved',
+            'RECURRENCE-ID;TZID=America/New_York:20300311T150000', 'DTSTART;TZID=America/New_York:20300312T100000',
+            'END:VEVENT',
+            'BEGIN:VEVENT', 'UID:monthly@test', 'SUMMARY:Monthly',
+            'DTSTART:20300110T100000Z', 'RRULE:FREQ=MONTHLY;BYMONTHDAY=10',
+            'END:VEVENT', 'END:VCALENDAR']).encode('UTF-8')
+        with open('test/repeat.ics', 'rb') as f:
+            repeat = f.read()
+
+        def summary(events):
+            return sorted((str(event['UID']), str(event['SUMMARY']), event['DTSTART'].dt.isoformat())
+                          for event in events)
+
+        for data, after, step in ((repeat, datetime.datetime(2018, 12, 1, tzinfo=pytz.UTC), 7),
+                                  (monthly, datetime.datetime(2030, 3, 1, tzinfo=pytz.UTC), 3)):
+            for _ in range(80):     # across the DST change, EXDATE, overrides and UNTIL
+                before = after + datetime.timedelta(hours=72)
+                expected = summary(recurring_ical_events.of(icalendar.Calendar.from_ical(data)).between(after, before))
+                self.assertEqual(expected, summary(expand_between(icalendar.Calendar.from_ical(data), after, before)))
+                after += datetime.timedelta(days=step)
+
+    def test_expansion_budget(self):
+        from calbot.budget import ExpansionBudgetExceeded
+        from calbot.ical import parse_ical
+        data = '\r\n'.join([
+            'BEGIN:VCALENDAR', 'VERSION:2.0',
+            'BEGIN:VEVENT', 'UID:minutely@test', 'SUMMARY:Minutely',
+            'DTSTART:20100101T000000Z', 'RRULE:FREQ=MINUTELY',
+            'END:VEVENT', 'END:VCALENDAR']).encode('UTF-8')
+        after = datetime.datetime(2010, 1, 10, tzinfo=pytz.UTC)
+        before = after + datetime.timedelta(hours=1)
+        with self.assertRaises(ExpansionBudgetExceeded):
+            parse_ical(data, after, before, datetime.time(10, 0), limits=(0, 10000))
+        with self.assertRaises(ExpansionBudgetExceeded):
+            parse_ical(data, after, before, datetime.time(10, 0), cursors={}, limits=(0, 10000))
+        _, _, _, events, stats, _ = parse_ical(data, after, before, datetime.time(10, 0), limits=(0, 20000))
+        self.assertEqual(60, len(events))
+        self.assertTrue(0.5 < stats['budget'] < 1)
+
+    def test_expansion_budget_paused(self):
+        from calbot.budget import ExpansionBudget
+        from calbot.ical import Expansion, read_vcalendar
+        from calbot.timings import ProcessingProfile
+        data = '\r\n'.join([
+            'BEGIN:VCALENDAR', 'VERSION:2.0',
+            'BEGIN:VEVENT', 'UID:minutely@test', 'SUMMARY:Minutely',
+            'DTSTART:20100110T000000Z', 'RRULE:FREQ=MINUTELY;COUNT=60',
+            'END:VEVENT', 'END:VCALENDAR']).encode('UTF-8')
+        after = datetime.datetime(2010, 1, 10, tzinfo=pytz.UTC)
+        before = after + datetime.timedelta(hours=1)
+        _, _, timezone, vcalendar = read_vcalendar(data)
+        budget = ExpansionBudget(0.2, 10000)
+        budget.tick(5000)       # used by the cursors of the same read
+        budget.pause()
+        profile = ProcessingProfile()
+        expansion = Expansion(vcalendar, timezone, after, before, datetime.time(10, 0), budget, profile)
+        count = 0
+        for _ in expansion:
+            count += 1
+            started = time.thread_time()
+            while time.thread_time() - started < 0.01:     # the work of the caller is not counted
+                pass
+        self.assertEqual(60, count)
+        self.assertLess(budget.elapsed(), 0.2)
+        self.assertGreater(budget.count, 5060)
+        self.assertEqual(budget.used(), profile.budget)
+        self.assertTrue(0.5 < profile.budget < 1)
+
+    def test_slow_lane(self):
+        from calbot.slowlane import SlowLane
+        from calbot.processing import update_calendars
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+        for used in (0.9, 0.6, 0.1, 1.0, 0.7):
+            calendar_config.count_read(used)
+        self.assertEqual(3, calendar_config.heavy_reads)
+        calendar_config.save_error(None)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertTrue(calendar_config.slow)
+
+        class TestBot:
+
+            def __init__(self):
+                self.messages = []
+
+            def sendMessage(self, **kwargs):
+                self.messages.append(kwargs)
+
+        bot = TestBot()
+        slow_lane = SlowLane(config)
+        from calbot import ical
+        self.assertIsNone(ical.slow_parse_pool.executor)    # no process till the first slow calendar
+        try:
+            update_calendars(bot, config, slow_lane=slow_lane)
+        finally:
+            slow_lane.stop()
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertTrue(calendar_config.verified)       # processed in the lane
+        self.assertEqual(2, calendar_config.heavy_reads)    # the light read
+        self.assertFalse(calendar_config.slow)
+        shutil.rmtree('var/TEST')
+
+    def test_refresh(self):
+        import threading
+        from calbot import ical
+        from calbot.refresh import Refresher, QUEUED, COALESCED, LIMITED
+        config = Config('calbot.cfg.sample')
+        os.makedirs('var/TEST', exist_ok=True)
+        shutil.copy('test/test.ics', 'var/TEST/feed.ics')
+        url = 'file://{}/var/TEST/feed.ics'.format(os.path.dirname(os.path.abspath(__file__)))
+        other_url = 'file://{}/test/test.ics'.format(os.path.dirname(os.path.abspath(__file__)))
+        first = config.add_calendar('TEST', url, 'TEST_CHANNEL')
+        second = config.add_calendar('TEST', url, 'TEST_CHANNEL2')
+        other = config.add_calendar('TEST', other_url, 'TEST_CHANNEL')
+        shutil.copy('test/test.ics', 'var/TEST/third.ics')
+        third = config.add_calendar('TEST', url.replace('feed.ics', 'third.ics'), 'TEST_CHANNEL')
+
+        class TestBot:
+
+            def sendMessage(self, **kwargs):
+                pass
+
+        bot = TestBot()
+        refresher = Refresher(config, 1, 2)
+        blocked = threading.Event()
+        refresher.executor.submit(blocked.wait)     # keeps the refreshes queued
+        try:
+            self.assertEqual(QUEUED, refresher.submit(bot, first, now=1000))
+            self.assertEqual(COALESCED, refresher.submit(bot, first, now=1001))
+            self.assertEqual(COALESCED, refresher.submit(bot, second, now=1002))
+            self.assertEqual(QUEUED, refresher.submit(bot, other, now=1003))
+            self.assertEqual(2, len(refresher))
+            self.assertEqual(LIMITED, refresher.submit(bot, third, now=1004))
+            self.assertEqual(COALESCED, refresher.submit(bot, other, now=1005))     # joining is not limited
+            self.assertEqual(QUEUED, refresher.submit(bot, third, now=1000 + 3600))     # the window passed
+        finally:
+            blocked.set()
+            refresher.stop()
+        self.assertEqual(0, len(refresher))
+        for calendar in (first, second, other, third):
+            self.assertTrue(config.load_calendar('TEST', calendar.id).verified)
+
+        with ical.shared_downloads():
+            Calendar(first)
+            os.remove('var/TEST/feed.ics')
+            self.assertEqual(list(Calendar(first).occurrences), list(Calendar(second).occurrences))     # downloaded once
+        shutil.rmtree('var/TEST')
+
+    def test_refresh_postponed(self):
+        from calbot.refresh import Refresher, QUEUED
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar(
+            'TEST', 'file://{}/test/test.ics'.format(os.path.dirname(__file__)), 'TEST_CHANNEL')
+        calendar_config.save_error(TimeoutError('timed out'), transient=True)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertIsNotNone(calendar_config.next_attempt_at)
+
+        class TestBot:
+
+            def sendMessage(self, **kwargs):
+                pass
+
+        update_calendar(TestBot(), calendar_config)     # postponed
+        self.assertFalse(config.load_calendar('TEST', calendar_config.id).verified)
+        refresher = Refresher(config, 1, 1)
+        try:
+            self.assertEqual(QUEUED, refresher.submit(TestBot(), calendar_config))
+        finally:
+            refresher.stop()
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        self.assertTrue(calendar_config.verified)      # read on request, despite the postponement
+        self.assertIsNone(calendar_config.next_attempt_at)
+        shutil.rmtree('var/TEST')
+
+    def test_record_replay_feeds(self):
+        from calbot import ical
+        from calbot.feedstore import FeedStore
+        os.makedirs('var/TEST', exist_ok=True)
+        shutil.copy('test/test.ics', 'var/TEST/feed.ics')
+        url = 'file://{}/var/TEST/feed.ics'.format(os.path.dirname(os.path.abspath(__file__)))
+        config = CalendarConfig.new(UserConfig.new(Config('calbot.cfg.sample'), 'TEST'), '1', url, 'TEST')
+        try:
+            ical.start_feed_store('var/TEST/feeds')
+            recorded = Calendar(config)
+            Calendar(config)    # the same content is stored once
+            os.remove('var/TEST/feed.ics')
+            ical.start_feed_store('var/TEST/feeds', replay=True)
+            replayed = Calendar(config)
+        finally:
+            ical.stop_feed_store()
+        self.assertEqual(recorded.name, replayed.name)
+        self.assertEqual(list(recorded.occurrences), list(replayed.occurrences))
+        self.assertEqual(1, sum(len(files) for _, _, files in os.walk('var/TEST/feeds/objects')))
+
+        store = FeedStore('var/TEST/feeds', max_size=1)
+        store.record('file:///other.ics', b'BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n')
+        self.assertEqual([], FeedStore('var/TEST/feeds').urls())    # all evicted to fit the size
+        with self.assertRaises(KeyError):
+            FeedStore('var/TEST/feeds').replay(url)
+        shutil.rmtree('var/TEST')
+
+    def test_load_servers(self):
+        import queue
+        import threading
+        from types import SimpleNamespace
+        from urllib.request import Request, urlopen
+        from calbot_load import ApiBot, serve
+        options = dict(latency=0.0, error_rate=0.0, due_events=1, events=2, description_size=10, etags=True,
+                       chat_rate=10.0, chat_burst=1, global_rate=100.0)
+        due_at = SimpleNamespace(value=1500000000.0)
+        ports, stop = queue.Queue(), threading.Event()
+        threading.Thread(target=serve, args=(options, due_at, ports, stop), daemon=True).start()
+        feeds_port, api_port = ports.get(timeout=10)
+        try:
+            with urlopen('http://127.0.0.1:%s/feeds/1-1.ics' % feeds_port) as f:
+                etag = f.headers['ETag']
+                data = f.read()
+            self.assertIn(b'SUMMARY:Load 1-1 due 1500000000.000', data)
+            with self.assertRaises(Exception) as context:
+                urlopen(Request('http://127.0.0.1:%s/feeds/1-1.ics' % feeds_port, headers={'If-None-Match': etag}))
+            self.assertEqual(304, context.exception.code)
+
+            bot = ApiBot('http://127.0.0.1:%s' % api_port, 'TOKEN')
+            bot.sendMessage(chat_id='@channel', text='Load 1-1 due 1500000000.000')
+            bot.sendMessage(chat_id='@channel', text='Second')     # flood, retried after 429
+            self.assertEqual(1, bot.waited)
+            with urlopen('http://127.0.0.1:%s/stats' % api_port) as f:
+                stats = json.loads(f.read().decode('UTF-8'))
+            self.assertEqual((3, 2, 1), (stats['api']['requests'], stats['api']['accepted'], stats['api']['flood']))
+            self.assertEqual(1, len(stats['api']['lateness']))
+            self.assertEqual(1, stats['feeds']['not_modified'])
+        finally:
+            stop.set()
+
+    def test_lazy_events(self):
+        config = Config('calbot.cfg.sample')
+        calendar_config = config.add_calendar('TEST', 'file:///nonexistent.ics', 'TEST_CHANNEL')
+
+        class TestBot:
+
+            def sendMessage(self, **kwargs):
+                pass
+
+        update_calendar(TestBot(), calendar_config)
+        self.assertFalse(calendar_config.events_loaded)
+        config.enable_calendar('TEST', calendar_config.id, False)
+        calendar_config = config.load_calendar('TEST', calendar_config.id)
+        update_calendar(TestBot(), calendar_config)
+        self.assertFalse(calendar_config.events_loaded)
+        self.assertEqual(0, calendar_config.events_count())
+        self.assertTrue(calendar_config.events_loaded)
+        shutil.rmtree('var/TEST')
+
+    def test_calendar_index(self):
+        config = Config('calbot.cfg.sample')
+        first = config.add_calendar('TEST', 'http://example.com/a\tb.ics', 'TEST_CHANNEL')
+        second = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        third = config.add_calendar('TEST', 'file:///dev/null', 'TEST_CHANNEL')
+        first.save_error(None)
+        config.enable_calendar('TEST', second.id, False)
+        config.delete_calendar('TEST', third.id)
+
+        def indexed():
+            return dict((entry.calendar_id, entry) for entry in read_index(config) if entry.user_id == 'TEST')
+
+        entries = indexed()
+        self.assertEqual({first.id, second.id}, set(entries))
+        self.assertEqual('http://example.com/a\tb.ics', entries[first.id].url)
+        self.assertTrue(entries[first.id].enabled)
+        self.assertAlmostEqual(datetime.datetime.utcnow() + datetime.timedelta(seconds=config.interval),
+                               entries[first.id].next_due, delta=datetime.timedelta(seconds=10))
+        self.assertFalse(entries[second.id].enabled)
+        self.assertIsNone(entries[second.id].next_due)
+        self.assertEqual([first.id], [calendar.id for calendar in config.all_calendars(enabled=True)
+                                      if calendar.user_id == 'TEST'])
+
+        os.remove('var/calendars.idx')
+        rebuilt = indexed()
+        self.assertEqual(set(entries), set(rebuilt))
+        self.assertEqual(entries[first.id].next_due, rebuilt[first.id].next_due)
+        self.assertFalse(rebuilt[second.id].enabled)
+        shutil.rmtree('var/TEST')